@@ -461,7 +461,12 @@ class ProcessingLayer(ShadowableBlock):
         else:
             return None
 
-    def _get_variable(self, name, shape, initializer, trainable=True):
+    def _get_variable(self,
+                      name,
+                      shape,
+                      initializer,
+                      trainable=True,
+                      partitioner=None):
         """
         Allocate or retrieve tensorflow variables. If the variable has already
         existed, depending on `moving_average_decay`'s value, moving average of
@@ -469,22 +474,44 @@ class ProcessingLayer(ShadowableBlock):
         variable(when `moving_average_decay` is None) would be returned. Refer
         to `tf.get_variable()` to the details of a shared variable in
         tensorflow.
+
+        If `partitioner` is not None, the variable is partitioned into shards
+        by it, each of which is a variable of its own, and could be placed on
+        a different parameter server. Shards are what are added to
+        `var_list`, and the concatenation of them (or of their moving
+        averages) is returned.
         """
         var = tf.get_variable(name,
                               shape,
                               initializer=initializer,
-                              trainable=trainable)
+                              trainable=trainable,
+                              partitioner=partitioner)
+        if partitioner is None:
+            shards = [var]
+        else:
+            shards = list(var)
+            if not self.is_setup:
+                log.info("Partition {} into {} shards.".format(
+                    var.name, len(shards)))
 
         if self.is_setup:
             if self.moving_average_decay:
                 log.debug("Use moving average of paras {}".format(
-                    var.op.name))
-                var = self.moving_averages.average(var)
+                    shards[0].op.name))
+                shards = [self.moving_averages.average(v) for v in shards]
             else:
-                log.debug("Reuse paras {}".format(var.op.name))
+                log.debug("Reuse paras {}".format(shards[0].op.name))
         else:
             # Append it to the var list, do moving average later in
             # `_post_setup`.
-            self.var_list.append(var)
+            self.var_list.extend(shards)
+
+        if len(shards) == 1:
+            return shards[0]
 
-        return var
+        # Shards are sliced along one axis, which is the one they differ
+        # from the full shape.
+        shard_shape = shards[0].get_shape().as_list()
+        axis = [i for i in range(0, len(shape))
+                if shard_shape[i] != shape[i]][0]
+        return tf.concat(axis, shards, name=name)
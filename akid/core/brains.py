@@ -100,8 +100,17 @@ class Brain(GraphSystem, ProcessingLayer):
 
     Note if `do_summary` and `moving_average_decay` are specified, it would
     override that option of any layers attached to this brain.
+
+    If `mixed_precision` is True, floating inputs of the brain are cast to
+    float16, so activations, convolutions and matrix multiplications are
+    computed in float16, while variables are kept in float32 as master copies,
+    and losses are computed in float32. Otherwise, float16 inputs are cast to
+    float32. It is better used with `LossScalingKongFu`, so small gradients
+    do not underflow in float16. After set up, the memory footprint of each
+    block is available through `memory_report`, and is logged if
+    `mixed_precision` is True, or at debug level otherwise.
     """
-    def __init__(self, do_stat_on_norm=False, **kwargs):
+    def __init__(self, do_stat_on_norm=False, mixed_precision=False, **kwargs):
         """
         Note a `Brain` contains a tensorflow `Graph` class. It is used to build
         a graph when doing visualization. When visualization is factored out,
@@ -114,6 +123,7 @@ class Brain(GraphSystem, ProcessingLayer):
         ProcessingLayer.__init__(self, **kwargs)
         self.blocks = []
         self.do_stat_on_norm = do_stat_on_norm
+        self.mixed_precision = mixed_precision
 
     def attach(self, block_in):
         """
@@ -210,11 +220,27 @@ class Brain(GraphSystem, ProcessingLayer):
             log.info("Setting up val brain {} ...".format(self.name))
         else:
             log.info("Setting up brain {} ...".format(self.name))
+        data_in = self._cast_data_in(data_in)
         self._setup_graph(data_in)
         self._gather_loss_graphs()
         self._gather_eval_graphs()
         self._gather_train_ops()
 
+    def _cast_data_in(self, data_in):
+        """
+        Cast floating tensors in `data_in` to the dtype to compute in.
+        """
+        dtype = tf.float16 if self.mixed_precision else tf.float32
+        is_list = type(data_in) is list
+        data_list = data_in if is_list else [data_in]
+        casted_list = []
+        for d in data_list:
+            if d.dtype.is_floating and d.dtype.base_dtype != dtype:
+                d = tf.cast(d, dtype)
+            casted_list.append(d)
+
+        return casted_list if is_list else casted_list[0]
+
     def _setup_graph(self, data_in):
         """
         Build the net up to where it may be used for inference.
@@ -268,6 +294,69 @@ class Brain(GraphSystem, ProcessingLayer):
     def _post_setup(self):
         if self.do_summary:
             tf.summary.scalar(self.loss.op.name, self.loss)
+        if not self.is_val:
+            self._log_memory_report()
+
+    @property
+    def memory_report(self):
+        """
+        A list of dicts, one for each block, on the memory footprint of the
+        block, with keys:
+
+            * `name`: the name of the block.
+            * `dtype`: the dtype of outputs of the block.
+            * `para_bytes`: the number of bytes of variables of the block.
+            * `activation_bytes`: the number of bytes of outputs of the block
+              for one example.
+        """
+        report = []
+        for b in self.blocks:
+            para_bytes = 0
+            for v in b.var_list:
+                para_bytes += self._get_bytes(v, v.get_shape().as_list())
+            activation_bytes = 0
+            data = b.data if type(b.data) is list else [b.data]
+            for d in data:
+                if d is not None:
+                    shape = d.get_shape().as_list()
+                    activation_bytes += self._get_bytes(d, shape[1:])
+            report.append({"name": b.name,
+                           "dtype": data[0].dtype.base_dtype.name
+                           if data[0] is not None else None,
+                           "para_bytes": para_bytes,
+                           "activation_bytes": activation_bytes})
+
+        return report
+
+    def _get_bytes(self, tensor, shape):
+        size = tensor.dtype.base_dtype.size
+        for d in shape:
+            # Unknown dimensions are not counted.
+            if d:
+                size *= d
+        return size
+
+    def _log_memory_report(self):
+        # The report is mostly of interest when trading precision for
+        # memory, so it is only logged at debug level otherwise.
+        log_fn = log.info if self.mixed_precision else log.debug
+        log_fn("Memory footprint of brain {}:".format(self.name))
+        log_fn("{:<20}{:>10}{:>16}{:>24}".format(
+            "Block", "Dtype", "Paras(KB)", "Activations(KB/example)"))
+        total_para_bytes = total_activation_bytes = 0
+        for r in self.memory_report:
+            log_fn("{:<20}{:>10}{:>16.1f}{:>24.1f}".format(
+                r["name"],
+                r["dtype"],
+                r["para_bytes"] / 2.**10,
+                r["activation_bytes"] / 2.**10))
+            total_para_bytes += r["para_bytes"]
+            total_activation_bytes += r["activation_bytes"]
+        log_fn("{:<20}{:>10}{:>16.1f}{:>24.1f}".format(
+            "Total",
+            "",
+            total_para_bytes / 2.**10,
+            total_activation_bytes / 2.**10))
 
     def on_batch_finishes(self):
         # Max norm constrain.
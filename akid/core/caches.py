@@ -0,0 +1,226 @@
+"""
+This module contains caches that keep processed data across epochs for
+`Sensor`.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import inspect
+
+import numpy as np
+
+from ..utils import glog as log
+
+
+class MemmapValCache(object):
+    """
+    A cache that keeps processed validation data, that is batches of data and
+    labels as a sensor provides them, in memory mapped files, so validation
+    epochs after the first one do not read and process validation data again.
+
+    Batches are written in order by `write` while the first validation epoch
+    runs. When the last example has been written, the files are completed,
+    and later epochs `read` from them. Like `MemmapFeedSource`, files are
+    written under temporary names then renamed, and a JSON header holding
+    `config`, shapes and dtypes is written last, so a cache in `cache_dir` is
+    either complete or ignored. A cache written with a different `config`,
+    which holds whatever the processed data depend on, or with different
+    shapes or dtypes, is rewritten.
+
+    Data are stored in `dtype`. If it is "uint8", which takes a quarter of the
+    space of float32, data are supposed to be images with values in [0, 1],
+    such as those decoded from JPEG files, and are quantized in steps of
+    1/255. If data out of that range are met, caching is given up. Caching is
+    also given up if the files would take more than `max_bytes` bytes.
+    """
+    HEADER_FILENAME = "header.json"
+    SUPPORTED_DTYPES = ["uint8", "float16", "float32"]
+
+    def __init__(self,
+                 cache_dir,
+                 config,
+                 num,
+                 data_shape,
+                 data_dtype,
+                 label_shapes,
+                 label_dtypes,
+                 dtype="uint8",
+                 max_bytes=8 * 2**30):
+        """
+        Args:
+            cache_dir: str
+                The folder to keep cached data in.
+            config: dict
+                Options that processed data depend on. It should be JSON
+                serializable.
+            num: int
+                The number of examples to cache.
+            data_shape: list
+                The shape of an example of data.
+            data_dtype: numpy.dtype
+                The dtype data are read back in.
+            label_shapes: list
+                A list of shapes of an example of each label.
+            label_dtypes: list
+                A list of numpy dtypes of labels.
+            dtype: str
+                The dtype to store data in. Labels are stored in their own
+                dtypes.
+            max_bytes: int
+                The maximal number of bytes cached files could take.
+        """
+        if dtype not in MemmapValCache.SUPPORTED_DTYPES:
+            raise ValueError("Cache dtype {} is not supported.".format(dtype))
+
+        self.cache_dir = cache_dir
+        # Normalize the config as if it is read back from the header, so
+        # they could be compared.
+        self.config = json.loads(json.dumps(config,
+                                            sort_keys=True,
+                                            default=str))
+        self.num = num
+        self.dtype = np.dtype(dtype)
+        self.data_dtype = np.dtype(data_dtype)
+        self.fields = [("data", [num] + list(data_shape), self.dtype)]
+        for i, (shape, label_dtype) in enumerate(zip(label_shapes,
+                                                     label_dtypes)):
+            self.fields.append(("label_{}".format(i),
+                                [num] + list(shape),
+                                np.dtype(label_dtype)))
+
+        self.is_enabled = True
+        self.is_ready = False
+        self._arrays = None
+        self._next_start = 0
+
+        nbytes = sum(int(np.prod(shape)) * d.itemsize
+                     for _, shape, d in self.fields)
+        if nbytes > max_bytes:
+            log.info("Validation data take {} bytes in cache, more than {}"
+                     " bytes. Not cached.".format(nbytes, max_bytes))
+            self.is_enabled = False
+            return
+
+        header = self._read_header()
+        if header is not None and \
+           header["config"] == self.config and \
+           header["fields"] == self._get_header_fields():
+            self._map("r")
+            self.is_ready = True
+            log.info("Map cached validation data from {}.".format(
+                self.cache_dir))
+        else:
+            log.info("Cache validation data of {} bytes to {} in the first"
+                     " validation epoch.".format(nbytes, self.cache_dir))
+
+    def read(self, start, num):
+        """
+        Return data and the list of labels of `num` examples starting from
+        the `start`th one.
+        """
+        data = self._arrays[0][start:start+num]
+        if self.dtype == np.uint8:
+            data = data * np.array(1. / 255, dtype=self.data_dtype)
+        else:
+            data = data.astype(self.data_dtype)
+        return data, [a[start:start+num] for a in self._arrays[1:]]
+
+    def write(self, start, data, labels):
+        """
+        Write a batch of `data` and the list of `labels` of examples starting
+        from the `start`th one. Batches should be written in order, starting
+        from the first example; a batch of the first example restarts
+        writing.
+        """
+        if not self.is_enabled or self.is_ready:
+            return
+
+        if start == 0:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            self._map("w+", tmp=True)
+            self._next_start = 0
+        if start != self._next_start or self._arrays is None:
+            log.info("Validation batches are not in order. Give up caching.")
+            self._give_up()
+            return
+
+        if self.dtype == np.uint8:
+            if data.min() < 0 or data.max() > 1:
+                log.info("Validation data are out of [0, 1], thus could not"
+                         " be cached in uint8. Give up caching.")
+                self._give_up()
+                return
+            data = np.round(data * 255)
+
+        num = len(data)
+        for array, values in zip(self._arrays, [data] + list(labels)):
+            array[start:start+num] = values
+        self._next_start += num
+
+        if self._next_start == self.num:
+            self._complete()
+
+    def _complete(self):
+        for array, (name, _, _) in zip(self._arrays, self.fields):
+            array.flush()
+            filepath = self._get_path(name)
+            os.rename(self._get_tmp_path(filepath), filepath)
+        self._arrays = None
+        header = {"config": self.config, "fields": self._get_header_fields()}
+
+        filepath = os.path.join(self.cache_dir,
+                                MemmapValCache.HEADER_FILENAME)
+        tmp_filepath = self._get_tmp_path(filepath)
+        with open(tmp_filepath, "w") as f:
+            json.dump(header, f, indent=2, sort_keys=True)
+        os.rename(tmp_filepath, filepath)
+
+        self._map("r")
+        self.is_ready = True
+        log.info("Validation data cached to {}.".format(self.cache_dir))
+
+    def _get_header_fields(self):
+        """
+        Shapes and dtypes of fields, as they are read back from the header.
+        """
+        return {name: {"shape": shape, "dtype": dtype.str}
+                for name, shape, dtype in self.fields}
+
+    def _give_up(self):
+        self.is_enabled = False
+        self._arrays = None
+        for name, _, _ in self.fields:
+            tmp_filepath = self._get_tmp_path(self._get_path(name))
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+
+    def _map(self, mode, tmp=False):
+        self._arrays = []
+        for name, shape, dtype in self.fields:
+            filepath = self._get_path(name)
+            if tmp:
+                filepath = self._get_tmp_path(filepath)
+            self._arrays.append(np.memmap(filepath,
+                                          dtype=dtype,
+                                          mode=mode,
+                                          shape=tuple(shape)))
+
+    def _read_header(self):
+        filepath = os.path.join(self.cache_dir,
+                                MemmapValCache.HEADER_FILENAME)
+        if not os.path.exists(filepath):
+            return None
+        with open(filepath, "r") as f:
+            return json.load(f)
+
+    def _get_path(self, name):
+        return os.path.join(self.cache_dir, "{}.raw".format(name))
+
+    def _get_tmp_path(self, filepath):
+        return "{}.{}.tmp".format(filepath, os.getpid())
+
+
+__all__ = [name for name, x in locals().items() if
+           not inspect.ismodule(x) and not inspect.isabstract(x)]
@@ -4,9 +4,14 @@ A collection of functions that may attach to hooks of `Kid`.
 Each function is expected to take a `Kid` instance as an input that is
 supposed to hold all information needed.
 """
+import os
+import re
+
 import tensorflow as tf
+from tensorflow.python.client import timeline
 
 from ..utils import glog as log
+from . import sensors
 
 
 def on_train_log_step(kid):
@@ -14,10 +19,8 @@ def on_train_log_step(kid):
     evals = kid.evals
     duration = kid.forward_backward_time
     step = kid.step
-    sess = kid.sess
-    feed_dict = kid.feed_dict
 
-    name_to_print = [g.op.name for g in kid.engine.eval()]
+    name_to_print = kid.eval_names
     eval_value_to_print = ["%0.04f" % v for v in evals]
     eval_to_print = dict(zip(name_to_print, eval_value_to_print))
 
@@ -25,8 +28,9 @@ def on_train_log_step(kid):
     examples_per_sec = num_examples_per_step / duration
     sec_per_batch = float(duration)
 
+    # The decayed learning rate is fetched by the training step.
     from akid import LearningRateScheme
-    lr = kid.sess.run(kid.kongfu.learning_rate) \
+    lr = kid.lr_value \
         if kid.kongfu.lr_scheme["name"] is LearningRateScheme.exp_decay\
         else kid.kongfu.lr_value
 
@@ -39,14 +43,49 @@ def on_train_log_step(kid):
                  examples_per_sec,
                  sec_per_batch))
 
+    stats = kid.timing_stats
+    log.info("Step time p50/p90 (ms): feed {:.1f}/{:.1f}, queue wait"
+             " {:.1f}/{:.1f}, run {:.1f}/{:.1f}; {:.0%} on input,"
+             " {}".format(
+                 stats["feed_time"][0] * 1000,
+                 stats["feed_time"][1] * 1000,
+                 stats["queue_wait_time"][0] * 1000,
+                 stats["queue_wait_time"][1] * 1000,
+                 stats["run_time"][0] * 1000,
+                 stats["run_time"][1] * 1000,
+                 stats["input_fraction"],
+                 stats["verdict"]))
+    if stats["queue_size"]:
+        log.info("Training queue size p10/p50 = {:.0f}/{:.0f} (min after"
+                 " dequeue {})".format(
+                     stats["queue_size"][0],
+                     stats["queue_size"][1],
+                     kid.sensor.queues["train_data"]["min_after_dequeue"]))
+    if stats["reduction_time"]:
+        log.info("Gradient reduction time p50/p90 (ms): {:.1f}/{:.1f}".format(
+            stats["reduction_time"][0] * 1000,
+            stats["reduction_time"][1] * 1000))
+
+    if type(kid.sensor) is sensors.FeedSensor and kid.sensor.prefetch_num:
+        stats = kid.sensor.prefetch_stats
+        log.info("Prefetch queue depth = {}/{}; producer stalls = {}"
+                 " ({:.3f} sec); consumer stalls = {} ({:.3f} sec)".format(
+                     stats["queue_depth"],
+                     kid.sensor.prefetch_num,
+                     stats["producer_stall_num"],
+                     stats["producer_stall_time"],
+                     stats["consumer_stall_num"],
+                     stats["consumer_stall_time"]))
+
     if kid.do_summary:
         # Update the events file.
         summary = tf.Summary()
         summary.value.add(tag="Training Loss",
                           simple_value=float(loss_value))
         kid.summary_writer.add_summary(summary, step)
-        summary_str = sess.run(kid.summary_op, feed_dict=feed_dict)
-        kid.summary_writer.add_summary(summary_str, step)
+        # Summaries are fetched by the training step.
+        if kid.summary_str is not None:
+            kid.summary_writer.add_summary(kid.summary_str, step)
 
 
 def on_val_log_step(kid):
@@ -55,22 +94,19 @@ def on_val_log_step(kid):
         summary = tf.Summary()
         summary.value.add(tag="Validation Loss", simple_value=kid.loss_value)
         for i, v in enumerate(kid.evals):
-            summary.value.add(
-                tag=kid.engine.eval(get_val=True)[i].op.name,
-                simple_value=v)
+            summary.value.add(tag=kid.val_eval_names[i], simple_value=v)
         kid.summary_writer.add_summary(summary, kid.step)
     # Log.
 
     # Log current validation.
-    name_to_print = [g.op.name for g in kid.engine.eval(get_val=True)]
+    name_to_print = kid.val_eval_names
     eval_value_to_print = ["%0.04f" % v for v in kid.evals]
     eval_to_print = dict(zip(name_to_print, eval_value_to_print))
     log.info('  Num examples: {}  Evals : {}'.format(
         kid.sensor.source.num_val, eval_to_print))
 
     # Log current best validation.
-    name_to_print = [g.op.name + '_best'
-                     for g in kid.engine.eval(get_val=True)]
+    name_to_print = [n + '_best' for n in kid.val_eval_names]
     eval_value_to_print = ["%0.04f" % v for v in kid.best_val_evals]
     eval_to_print = dict(zip(name_to_print, eval_value_to_print))
     log.info('Current best evals : {}'.format(eval_to_print))
@@ -96,20 +132,20 @@ def on_train_begin(kid):
     kid.fill_train_feed_dict()
     fetch = [kid.engine.loss()]
     fetch.extend(kid.engine.eval())
+    if kid.do_summary:
+        fetch.append(kid.summary_op)
     result = kid.sess.run(fetch, feed_dict=kid.feed_dict)
     kid.loss_value = result[0]
-    kid.evals = result[1:]
+    kid.evals = result[1:1+len(kid.eval_names)]
 
     if kid.do_summary:
         summary = tf.Summary()
         summary.value.add(tag="Training Loss",
                           simple_value=float(kid.loss_value))
         kid.summary_writer.add_summary(summary, kid.step)
-        summary_str = kid.sess.run(kid.summary_op,
-                                   feed_dict=kid.feed_dict)
-        kid.summary_writer.add_summary(summary_str, kid.step)
+        kid.summary_writer.add_summary(result[-1], kid.step)
 
-    name_to_print = [g.op.name for g in kid.engine.eval()]
+    name_to_print = kid.eval_names
     eval_value_to_print = ["%0.04f" % v for v in kid.evals]
     eval_to_print = dict(zip(name_to_print, eval_value_to_print))
     log.info("Step {}: loss = {:.5f} eval = {}".format(
@@ -118,3 +154,80 @@ def on_train_begin(kid):
 
 def on_batch_begin(kid):
     pass
+
+
+def on_batch_end(kid):
+    if type(kid.sensor) is sensors.IntegratedSensor and kid.sensor.auto_tune:
+        kid.sensor.tune(kid.sess, kid.queue_sizes[-1], kid.run_step_num)
+
+
+def profile_blocks(kid):
+    """
+    Attribute run time and memory of a traced training step to blocks of the
+    brain, log them as a table, and save the trace in Chrome trace format to
+    `kid.log_dir`, which could be viewed at chrome://tracing.
+
+    It is supposed to be attached to hook `on_batch_end`, and does profiling
+    every `kid.trace_step` steps, when the step is traced::
+
+        kid.hooks.on_batch_end.append(profile_blocks)
+
+    An op belongs to a block if the name scope of the block is in its name.
+    Gradient ops are named after the ops they differentiate, so they are
+    attributed the same way, and counted as backward time. Ops outside any
+    block, such as the ones of the optimizer, are counted as "others".
+    """
+    if kid.run_metadata is None:
+        return
+
+    block_names = [b.name for b in kid.brain.blocks]
+    # Name scopes of replicas of the brain, such as towers of
+    # `DataParallelEngine`, are suffixed with numbers.
+    brain_scope_re = re.compile(r"{}(_\d+)?$".format(re.escape(
+        kid.brain.name)))
+    grad_scope_re = re.compile(r"gradients(_\d+)?$")
+
+    profile = {}
+    for dev_stats in kid.run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            scopes = node_stats.node_name.split("/")
+            block_name = "others"
+            for i, scope in enumerate(scopes[:-1]):
+                if brain_scope_re.match(scope) \
+                   and scopes[i+1] in block_names:
+                    block_name = scopes[i+1]
+                    break
+            backward = any(grad_scope_re.match(s) for s in scopes[:-1])
+
+            if block_name not in profile:
+                profile[block_name] = {"forward": 0, "backward": 0, "peak": 0}
+            p = profile[block_name]
+            p["backward" if backward else "forward"] \
+                += node_stats.all_end_rel_micros
+            for m in node_stats.memory:
+                p["peak"] = max(p["peak"], m.peak_bytes)
+
+    # With `steps_per_run` larger than one, the traced step is the last one
+    # of the run, not `kid.step`.
+    step = kid.traced_step
+    lines = ["Block profile of step {} (time in ms, memory in MB):".format(
+        step)]
+    lines.append("{:<30}{:>12}{:>12}{:>12}{:>12}".format(
+        "block", "forward", "backward", "total", "peak mem"))
+    for name, p in sorted(profile.items(),
+                          key=lambda x: x[1]["forward"] + x[1]["backward"],
+                          reverse=True):
+        lines.append("{:<30}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.2f}".format(
+            name,
+            p["forward"] / 1000.,
+            p["backward"] / 1000.,
+            (p["forward"] + p["backward"]) / 1000.,
+            p["peak"] / 2.**20))
+    log.info("\n".join(lines))
+
+    trace = timeline.Timeline(kid.run_metadata.step_stats)
+    filename = os.path.join(kid.log_dir,
+                            "timeline_step_{}.json".format(step))
+    with open(filename, "w") as f:
+        f.write(trace.generate_chrome_trace_format(show_memory=True))
+    log.info("Chrome trace of step {} saved to {}".format(step, filename))
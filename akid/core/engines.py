@@ -18,8 +18,13 @@ As an example, we could do data parallelism on multiple computing towers using::
         engine={"name": "data_parallel", "num_gpu": 2},
         log_dir="log",
         max_epoch=200)
+
+Training could also be distributed over a cluster of parameter servers and
+workers with between-graph replication, where each worker runs a kid with a
+"distributed" engine. See `DistributedEngine`.
 """
 import abc
+import time
 
 import tensorflow as tf
 
@@ -68,12 +73,76 @@ class Engine(object):
         raise NotImplementedError("Each engine should implement the interface"
                                   " to provide evaluation.")
 
+    @property
+    def cpu_device_num(self):
+        """
+        The number of CPU devices needed by the engine.
+        """
+        return 1
+
+    @property
+    def device(self):
+        """
+        The device, or device function, to build the whole graph of the kid
+        on. If None, no device is specified.
+        """
+        return None
+
+    @property
+    def session_target(self):
+        """
+        The execution engine the session of the kid connects to.
+        """
+        return ""
+
+    @property
+    def is_chief(self):
+        """
+        Whether the kid is the chief, which is responsible for initialization,
+        checkpointing and validation.
+        """
+        return True
+
+    def init_session(self, sess, init_variables):
+        """
+        Initialize `sess` for training, where `init_variables` is a function
+        that initializes or restores variables. If it is called with
+        `restore_if_any` True, variables are restored from the latest
+        checkpoint if there is one, even if the kid does not continue from
+        checkpoints.
+        """
+        init_variables()
+
+    def get_reduction_time(self, run_metadata):
+        """
+        Return the time in seconds spent reducing gradients across devices in
+        the step traced in `run_metadata`, or None if the engine does not
+        reduce gradients.
+        """
+        return None
+
+    def adapt_to_trace(self, sess, run_metadata):
+        """
+        Adapt the engine to the step traced in `run_metadata`, which is run
+        in `sess`. By default, nothing is done.
+        """
+        pass
+
     def setup(self):
         grads = self._setup_train_towers()
         self._post_setup_train(grads)
         self._setup_val_towers()
 
     def _post_setup_train(self, grads):
+        # If gradients are accumulated, `accum_op` adds gradients of a
+        # micro-batch to accumulators, and `train_op` applies the
+        # accumulated ones. See `KongFu.accumulate`.
+        self.accum_op = None
+        if self.kongfu.accumulation_num > 1:
+            log.info("Accumulate gradients over {} micro-batches.".format(
+                self.kongfu.accumulation_num))
+            self.accum_op, grads = self.kongfu.accumulate(grads)
+
         apply_grad_op = self.kongfu.opt.apply_gradients(
             grads, global_step=common.global_step_tensor)
 
@@ -84,6 +153,10 @@ class Engine(object):
             else:
                 self.train_op = apply_grad_op
 
+        if self.accum_op is not None:
+            with tf.control_dependencies([self.train_op]):
+                self.train_op = self.kongfu.get_clear_accumulators_op()
+
         for grad, var in grads:
             if grad is not None:
                 tf.summary.histogram(
@@ -171,6 +244,153 @@ class SingleGPUEngine(Engine):
         return layer
 
 
+class DistributedEngine(SingleGPUEngine):
+    """
+    An engine for between-graph replicated training: each worker of a cluster
+    runs a kid with this engine, which builds the whole graph of the kid, and
+    places variables on parameter servers by `tf.train.replica_device_setter`
+    and other ops on the worker. The engine starts the server of the worker,
+    and the session of the kid connects to it.
+
+    By default, workers apply gradients to the shared variables
+    asynchronously. If `sync_replicas` is True, gradients of
+    `replicas_to_aggregate` workers are aggregated and applied once by
+    `tf.train.SyncReplicasOptimizer`, in which case the optimizer of the
+    `KongFu` should be a `tf.train.Optimizer`.
+
+    The worker of task 0 is the chief, which initializes or restores
+    variables, and is the only one to save checkpoints and to validate. Other
+    workers wait till variables are initialized. If variables have been
+    initialized on parameter servers, for instance, when the chief is
+    restarted, they are left as they are. Otherwise, the chief restores the
+    latest checkpoint of the kid if there is one. Steps of `Kid` are counted
+    by each worker, starting from the global step when it starts.
+    Asynchronous validation of `Kid` is not supported, since it loads
+    variables into a local copy of the graph.
+
+    A cluster could be made up of in-process servers on localhost, for
+    example::
+
+        cluster = {"ps": ["localhost:2222"],
+                   "worker": ["localhost:2223", "localhost:2224"]}
+        ps_server = tf.train.Server(tf.train.ClusterSpec(cluster),
+                                    job_name="ps",
+                                    task_index=0)
+        kid = kids.Kid(
+            sensor,
+            brain,
+            MomentumKongFu(),
+            engine={"name": "distributed",
+                    "cluster": cluster,
+                    "task_index": 0},
+            max_steps=1000)
+    """
+    def __init__(self,
+                 cluster,
+                 task_index=0,
+                 sync_replicas=False,
+                 replicas_to_aggregate=None,
+                 **kwargs):
+        """
+        Args:
+            cluster: dict
+                A dict that maps "ps" and "worker" to lists of "host:port"
+                addresses of parameter servers and workers.
+            task_index: int
+                The index of the worker this kid runs as.
+            sync_replicas: Boolean
+                Whether to update variables synchronously.
+            replicas_to_aggregate: int
+                The number of replicas to aggregate gradients of for an
+                update. If None, it is the number of workers.
+        """
+        super(DistributedEngine, self).__init__(**kwargs)
+        if self.kid.async_val:
+            raise Exception("Asynchronous validation is not supported in"
+                            " distributed training.")
+        self.cluster = tf.train.ClusterSpec(cluster)
+        self.task_index = task_index
+        self.sync_replicas = sync_replicas
+        self.worker_num = len(cluster["worker"])
+        self.replicas_to_aggregate = replicas_to_aggregate \
+            if replicas_to_aggregate else self.worker_num
+
+        self.server = tf.train.Server(self.cluster,
+                                      job_name="worker",
+                                      task_index=task_index)
+        self.worker_device = "/job:worker/task:{}".format(task_index)
+        self._device = tf.train.replica_device_setter(
+            worker_device=self.worker_device,
+            cluster=self.cluster)
+        log.info("Run as worker {} of {} with {} parameter servers.".format(
+            task_index, self.worker_num, len(cluster["ps"])))
+
+    @property
+    def device(self):
+        return self._device
+
+    @property
+    def session_target(self):
+        return self.server.target
+
+    @property
+    def is_chief(self):
+        return self.task_index == 0
+
+    def _post_setup_train(self, grads):
+        if self.sync_replicas:
+            log.info("Aggregate gradients of {} of {} workers for an"
+                     " update.".format(self.replicas_to_aggregate,
+                                       self.worker_num))
+            sync_replicas_optimizer = getattr(
+                tf.train,
+                "SyncReplicasOptimizerV2",
+                tf.train.SyncReplicasOptimizer)
+            self.kongfu.opt = sync_replicas_optimizer(
+                self.kongfu.opt,
+                replicas_to_aggregate=self.replicas_to_aggregate,
+                total_num_replicas=self.worker_num)
+
+        super(DistributedEngine, self)._post_setup_train(grads)
+
+        if self.sync_replicas:
+            opt = self.kongfu.opt
+            self._local_init_op = opt.chief_init_op if self.is_chief \
+                else opt.local_step_init_op
+            if self.is_chief:
+                self._chief_queue_runner = opt.get_chief_queue_runner()
+                self._init_tokens_op = opt.get_init_tokens_op()
+        self._uninitialized_variables = tf.report_uninitialized_variables(
+            tf.global_variables())
+        self._local_variables_init_op = tf.local_variables_initializer()
+
+    def init_session(self, sess, init_variables):
+        if self.is_chief:
+            # Like `tf.train.SessionManager.prepare_session`, a chief
+            # restarted while parameter servers keep running leaves
+            # variables as they are, so progress made by other workers is
+            # not lost. Otherwise, variables are restored from the latest
+            # checkpoint if there is one, or initialized.
+            if len(sess.run(self._uninitialized_variables)) == 0:
+                log.info("Variables are initialized on parameter servers"
+                         " already.")
+            else:
+                init_variables(restore_if_any=True)
+        else:
+            log.info("Wait for the chief to initialize variables.")
+            while len(sess.run(self._uninitialized_variables)) != 0:
+                time.sleep(1)
+        sess.run(self._local_variables_init_op)
+
+        if self.sync_replicas:
+            sess.run(self._local_init_op)
+            if self.is_chief:
+                sess.run(self._init_tokens_op)
+                self._chief_queue_runner.create_threads(sess,
+                                                        daemon=True,
+                                                        start=True)
+
+
 class DataParallelEngine(Engine):
     """
     This engine will implement typical parallelism in training neural
@@ -179,10 +399,87 @@ class DataParallelEngine(Engine):
 
     Due to the known fact that communication between GPUs are slow, the average
     of gradient is done on CPU.
+
+    By default, towers are placed on `/gpu:0` to `/gpu:{num_gpu - 1}`. To place
+    them elsewhere, pass a list of `devices`, one for each tower. For example,
+    on hosts without GPUs, towers could be placed on CPU devices `/cpu:0`,
+    `/cpu:1` and so on, which are created by `Kid` when it makes the session,
+    so batches are split across CPU towers that run concurrently. CPU devices
+    of a process share the thread pool to run ops, so the speedup comes from
+    running towers in parallel, not from more threads.
+
+    By default, gradients are averaged variable by variable, which makes many
+    small ops and copies for networks with many small variables, such as
+    parameters of batch normalization. If `bucket_size` is given, gradients
+    of each tower are flattened and concatenated into buckets of at most
+    `bucket_size` bytes (a variable larger than that takes a bucket alone),
+    and each bucket is averaged by one `add_n` and one multiplication, then
+    split back to gradients.
+
+    Batches are split among towers proportionally to `tower_weights`, which
+    are equal by default, so towers on faster devices could take more
+    examples, and the batch size does not need to be divisible by the number
+    of towers. Loss, evaluation metrics and gradients of towers are averaged
+    weighted by the number of examples of towers, so they are exactly those
+    of the whole batch. If `adapt_tower_weights` is True, weights are adapted
+    to the speed of towers measured in traced steps (see `trace_step` of
+    `Kid`, which should be given then), in which case sizes of splits are only
+    known when running. The time of a tower is that of ops in its name scope,
+    including gradient ops, and adapted weights are kept at least one
+    example's share of the batch, so each tower gets at least one example.
     """
-    def __init__(self, num_gpu, **kwargs):
+    def __init__(self,
+                 num_gpu=None,
+                 devices=None,
+                 bucket_size=None,
+                 tower_weights=None,
+                 adapt_tower_weights=False,
+                 adapt_rate=0.5,
+                 **kwargs):
+        """
+        Args:
+            num_gpu: int
+                The number of GPUs to place towers on. It is ignored if
+                `devices` is given.
+            devices: list
+                A list of device names to place towers on.
+            bucket_size: int
+                The maximal number of bytes of a bucket to average gradients
+                in. If None, gradients are averaged variable by variable.
+            tower_weights: list
+                Relative shares of examples of towers in a batch.
+            adapt_tower_weights: Boolean
+                Whether to adapt tower weights to the measured speed of
+                towers.
+            adapt_rate: float
+                The fraction that weights move towards the measured speed of
+                towers each time they are adapted.
+        """
         super(DataParallelEngine, self).__init__(**kwargs)
-        self.num_gpu = num_gpu
+        if devices:
+            self.devices = list(devices)
+        else:
+            self.devices = ["/gpu:{}".format(i) for i in xrange(num_gpu)]
+        # The number of towers, which keeps the name for compatibility.
+        self.num_gpu = len(self.devices)
+        self.bucket_size = bucket_size
+        if tower_weights is None:
+            tower_weights = [1.] * self.num_gpu
+        assert len(tower_weights) == self.num_gpu, \
+            "There should be a weight for each tower."
+        self.tower_weights = [float(w) / sum(tower_weights)
+                              for w in tower_weights]
+        self.adapt_tower_weights = adapt_tower_weights
+        self.adapt_rate = adapt_rate
+
+    @property
+    def cpu_device_num(self):
+        cpu_indices = [0]
+        for d in self.devices:
+            spec = tf.DeviceSpec.from_string(d)
+            if spec.device_type and spec.device_type.upper() == "CPU":
+                cpu_indices.append(spec.device_index or 0)
+        return max(cpu_indices) + 1
 
     def get_layer_data(self, name, get_val=False):
         if get_val:
@@ -208,19 +505,66 @@ class DataParallelEngine(Engine):
 
     def _split_input(self, data, label):
         """
-        Given data and labels, split them and return.
+        Given data and labels, split them according to tower weights and
+        return, along with the fractions of the batch each tower takes.
         """
         with tf.variable_scope("data_split"):
-            splitted_data = tf.split(0, self.num_gpu, data)
+            bounds = self._get_split_bounds(data)
+            splitted_data = self._split(data, bounds)
             if type(label) is list:
                 splitted_labels = []
                 for i in xrange(0, len(label)):
-                    splitted_labels.append(tf.split(0, self.num_gpu, label[i]))
+                    splitted_labels.append(self._split(label[i], bounds))
                 splitted_labels = zip(*splitted_labels)
             else:
-                splitted_labels = tf.split(0, self.num_gpu, label)
+                splitted_labels = self._split(label, bounds)
+
+            batch_size = bounds[-1]
+            if type(batch_size) is int:
+                fractions = [float(bounds[i+1] - bounds[i]) / batch_size
+                             for i in xrange(0, self.num_gpu)]
+            else:
+                fractions = [tf.to_float(bounds[i+1] - bounds[i])
+                             / tf.to_float(batch_size)
+                             for i in xrange(0, self.num_gpu)]
+
+        return splitted_data, splitted_labels, fractions
+
+    def _get_split_bounds(self, data):
+        """
+        Return the list of indices in the batch where splits of towers start,
+        ended with the batch size. They are ints if the batch size is known
+        and weights are fixed, otherwise, tensors.
+        """
+        batch_size = data.get_shape().as_list()[0]
+        cum_weights = [sum(self.tower_weights[:i])
+                       for i in xrange(1, self.num_gpu)]
+        if batch_size is not None and not self.adapt_tower_weights:
+            bounds = [int(round(batch_size * w)) for w in cum_weights]
+            return [0] + bounds + [batch_size]
+
+        batch_size = tf.shape(data)[0]
+        if self.adapt_tower_weights:
+            weights = self.tower_weights_var / tf.reduce_sum(
+                self.tower_weights_var)
+            cum_weights = [tf.reduce_sum(weights[:i])
+                           for i in xrange(1, self.num_gpu)]
+        bounds = [tf.to_int32(tf.round(tf.to_float(batch_size) * w))
+                  for w in cum_weights]
+        return [0] + bounds + [batch_size]
+
+    def _split(self, data, bounds):
+        rank = len(data.get_shape().as_list())
+        splits = []
+        for i in xrange(0, self.num_gpu):
+            begin = [bounds[i]] + [0] * (rank - 1)
+            size = [bounds[i+1] - bounds[i]] + [-1] * (rank - 1)
+            if type(bounds[-1]) is not int:
+                begin = tf.pack(begin)
+                size = tf.pack(size)
+            splits.append(tf.slice(data, begin, size))
 
-        return splitted_data, splitted_labels
+        return splits
 
     def _setup_system_in(self, data, label):
         """
@@ -242,37 +586,66 @@ class DataParallelEngine(Engine):
             else system_in.append(label)
         return system_in
 
-    def _average_loss(self, towers):
+    def _average_loss(self, towers, fractions):
         """
-        Given a list of computing towers, average their loss, and return.
+        Given a list of computing towers, average their loss weighted by
+        `fractions` of the batch they take, and return.
         """
         with tf.variable_scope("loss_average"):
-            sum_of_loss = tf.add_n([t.loss for t in towers])
-            loss = tf.div(sum_of_loss, self.num_gpu, name="avg")
+            loss = self._weighted_sum([t.loss for t in towers],
+                                      fractions,
+                                      name="avg")
 
         return loss
 
-    def _average_eval(self, towers):
+    def _average_eval(self, towers, fractions):
         """
-        Given a list of computing towers, average their evaluation metrics and
-        return.
+        Given a list of computing towers, average their evaluation metrics
+        weighted by `fractions` of the batch they take, and return.
         """
         with tf.variable_scope("eval_average"):
             eval_list = []
             for i in xrange(0, len(towers[0].eval)):
-                sum_of_eval = tf.add_n([t.eval[i] for t in towers])
-                eval = tf.div(sum_of_eval,
-                              self.num_gpu,
-                              name="{}_avg".format(towers[0].eval[i].op.name))
+                eval = self._weighted_sum(
+                    [t.eval[i] for t in towers],
+                    fractions,
+                    name="{}_avg".format(towers[0].eval[i].op.name))
                 eval_list.append(eval)
 
         return eval_list
 
+    def _weighted_sum(self, tensors, fractions, name=None):
+        """
+        Sum `tensors` weighted by `fractions`. If fractions are equal, it is
+        the mean.
+        """
+        if self._is_even(fractions):
+            return tf.div(tf.add_n(tensors), self.num_gpu, name=name)
+
+        return tf.add_n([tf.mul(t, f) for t, f in zip(tensors, fractions)],
+                        name=name)
+
+    def _is_even(self, fractions):
+        return all([type(f) is float for f in fractions]) \
+            and max(fractions) == min(fractions)
+
     def _setup_train_towers(self):
         # Split the data.
+        if self.adapt_tower_weights:
+            with tf.device('/cpu:0'):
+                self.tower_weights_var = tf.Variable(self.tower_weights,
+                                                     trainable=False,
+                                                     name="tower_weights")
+                self._tower_weights_placeholder = tf.placeholder(
+                    tf.float32, [self.num_gpu])
+                self._assign_tower_weights_op = tf.assign(
+                    self.tower_weights_var,
+                    self._tower_weights_placeholder)
+
         data = self.sensor.data()
         label = self.sensor.labels()
-        splitted_data, splitted_labels = self._split_input(data, label)
+        splitted_data, splitted_labels, self._train_fractions \
+            = self._split_input(data, label)
 
         # Set up brains according to the number of gpus used.
 
@@ -280,12 +653,14 @@ class DataParallelEngine(Engine):
         # keep track of different brains, denoted as towers of the
         # brain. Similar with validation towers.
         self.train_towers = []
+        # Name scopes of towers, to attribute traced ops to towers.
+        self._tower_scopes = []
         tower_grads = []
         tower = self.brain
         kongfu = self.kongfu
         for i in xrange(0, self.num_gpu):
             log.info("Setting up tower {} for training".format(i))
-            with tf.device('/gpu:{}'.format(i)):
+            with tf.device(self.devices[i]):
                 # Set up a tower
                 system_in = self._setup_system_in(splitted_data[i],
                                                   splitted_labels[i])
@@ -293,6 +668,7 @@ class DataParallelEngine(Engine):
 
                 # Keep track of the new tower.
                 self.train_towers.append(tower)
+                self._tower_scopes.append(tower.loss.op.name.split("/")[0])
 
                 # Set up KongFu (optimizer).
                 # For now, we do not need to keep track of Kongfu, so just set
@@ -309,23 +685,26 @@ class DataParallelEngine(Engine):
 
         # Gather and reduce.
         with tf.device('/cpu:0'):
-            grads = self._average_grads(tower_grads)
-            self._train_loss = self._average_loss(self.train_towers)
-            self._train_eval = self._average_eval(self.train_towers)
+            grads = self._average_grads(tower_grads, self._train_fractions)
+            self._train_loss = self._average_loss(self.train_towers,
+                                                  self._train_fractions)
+            self._train_eval = self._average_eval(self.train_towers,
+                                                  self._train_fractions)
 
         return grads
 
     def _setup_val_towers(self):
         data = self.sensor.data(get_val=True)
         label = self.sensor.labels(get_val=True)
-        splitted_data, splitted_labels = self._split_input(data, label)
+        splitted_data, splitted_labels, fractions \
+            = self._split_input(data, label)
 
         # Set up val brains according to the number of gpus used.
         self.val_towers = []
         tower = self.val_brain
         for i in xrange(0, self.num_gpu):
             log.info("Setting up tower {} for validation".format(i))
-            with tf.device('/gpu:{}'.format(i)):
+            with tf.device(self.devices[i]):
                 system_in = self._setup_system_in(splitted_data[i],
                                                   splitted_labels[i])
                 tower.setup(system_in)
@@ -334,8 +713,8 @@ class DataParallelEngine(Engine):
                     tower = tower.get_shadow_copy()
 
         with tf.device('/cpu:0'):
-            self._val_loss = self._average_loss(self.val_towers)
-            self._val_eval = self._average_eval(self.val_towers)
+            self._val_loss = self._average_loss(self.val_towers, fractions)
+            self._val_eval = self._average_eval(self.val_towers, fractions)
 
     def loss(self, get_val=False):
         if not get_val:
@@ -349,10 +728,86 @@ class DataParallelEngine(Engine):
         else:
             return self._val_eval
 
-    def _average_grads(self, tower_grads):
+    def get_reduction_time(self, run_metadata):
+        # The time from the start of the first op to the end of the last op
+        # of the reduction.
+        start_micros = end_micros = None
+        for dev_stats in run_metadata.step_stats.dev_stats:
+            for node_stats in dev_stats.node_stats:
+                if not node_stats.node_name.startswith("gradient_average/"):
+                    continue
+                start = node_stats.all_start_micros
+                end = start + node_stats.all_end_rel_micros
+                if start_micros is None or start < start_micros:
+                    start_micros = start
+                if end_micros is None or end > end_micros:
+                    end_micros = end
+
+        if start_micros is None:
+            return 0
+        return (end_micros - start_micros) / 1e6
+
+    def adapt_to_trace(self, sess, run_metadata):
+        """
+        Move tower weights towards the measured speed of towers, if
+        `adapt_tower_weights` is True.
+        """
+        if not self.adapt_tower_weights:
+            return
+
+        times = self._get_tower_times(run_metadata)
+        if min(times) <= 0:
+            return
+        # Speeds are in shares of the batch per second.
+        speeds = [w / t for w, t in zip(self.tower_weights, times)]
+        weights = [
+            (1 - self.adapt_rate) * w + self.adapt_rate * s / sum(speeds)
+            for w, s in zip(self.tower_weights, speeds)]
+        # A tower with an empty split would have a NaN loss, which poisons
+        # the weighted sums of towers.
+        min_weight = 1. / self.sensor.batch_size
+        weights = [max(w, min_weight) for w in weights]
+        self.tower_weights = [w / sum(weights) for w in weights]
+        sess.run(self._assign_tower_weights_op,
+                 feed_dict={self._tower_weights_placeholder:
+                            self.tower_weights})
+        log.info("Tower times (ms): {}; tower weights are adapted to"
+                 " {}.".format(
+                     ", ".join(["{:.1f}".format(t * 1000) for t in times]),
+                     ", ".join(["{:.3f}".format(w)
+                                for w in self.tower_weights])))
+
+    def _get_tower_times(self, run_metadata):
+        """
+        Return the time in seconds each tower takes in the step traced in
+        `run_metadata`, which is the sum of the time of ops in the name scope
+        of the tower. Gradient ops are named after the ops they
+        differentiate, so they are counted as well. Ops shared by towers,
+        such as feeding, reduction of gradients and applying them, are left
+        out.
+        """
+        times = [0.] * self.num_gpu
+        for dev_stats in run_metadata.step_stats.dev_stats:
+            try:
+                dev_spec = tf.DeviceSpec.from_string(dev_stats.device)
+            except ValueError:
+                # Such as streams of GPUs, which duplicate ops of GPUs.
+                continue
+            if not dev_spec.device_type:
+                continue
+            for node_stats in dev_stats.node_stats:
+                scopes = node_stats.node_name.split("/")[:-1]
+                for i, tower_scope in enumerate(self._tower_scopes):
+                    if tower_scope in scopes:
+                        times[i] += node_stats.all_end_rel_micros / 1e6
+                        break
+
+        return times
+
+    def _average_grads(self, tower_grads, fractions):
         """
         Calculate the average gradient for each shared variable across all
-        towers.
+        towers, weighted by `fractions` of the batch towers take.
 
         Note that this function provides a synchronization point across all
         towers.
@@ -365,11 +820,21 @@ class DataParallelEngine(Engine):
             List of pairs of (gradient, variable), where the gradient has been
             averaged across all towers.
         """
+        if self.bucket_size:
+            return self._average_grads_in_buckets(tower_grads, fractions)
+
         with tf.variable_scope("gradient_average"):
             average_grads = []
             for grad_and_vars in zip(*tower_grads):
                 # Note that each grad_and_vars looks like the following:
                 #   ((grad0_gpu0, var0_gpu0), ... , (grad0_gpuN, var0_gpuN))
+                v = grad_and_vars[0][1]
+                if not self._is_even(fractions):
+                    grad = self._weighted_sum([g for g, _ in grad_and_vars],
+                                              fractions)
+                    average_grads.append((grad, v))
+                    continue
+
                 grads = []
                 for g, _ in grad_and_vars:
                     # Add 0 dimension to the gradients to represent the tower.
@@ -386,8 +851,69 @@ class DataParallelEngine(Engine):
                 # Keep in mind that the Variables are redundant because they
                 # are shared across towers. So .. we will just return the first
                 # tower's pointer to the Variable.
-                v = grad_and_vars[0][1]
                 grad_and_var = (grad, v)
                 average_grads.append(grad_and_var)
 
         return average_grads
+
+    def _average_grads_in_buckets(self, tower_grads, fractions):
+        """
+        The same with `_average_grads`, but gradients are averaged in
+        buckets. See the docstring of the class.
+        """
+        grads_and_vars = tower_grads[0]
+        average_grads = list(grads_and_vars)
+        buckets = self._get_buckets(grads_and_vars)
+        log.info("Average gradients of {} variables in {} buckets.".format(
+            sum([len(b) for b in buckets]), len(buckets)))
+
+        with tf.variable_scope("gradient_average"):
+            for i, bucket in enumerate(buckets):
+                with tf.variable_scope("bucket_{}".format(i)):
+                    flat_grads = []
+                    for grads in tower_grads:
+                        flat_grads.append(tf.concat(
+                            0, [tf.reshape(grads[j][0], [-1])
+                                for j in bucket]))
+                    grad = self._weighted_sum(flat_grads, fractions)
+
+                    offset = 0
+                    for j in bucket:
+                        v = grads_and_vars[j][1]
+                        shape = v.get_shape().as_list()
+                        size = v.get_shape().num_elements()
+                        average_grads[j] = (
+                            tf.reshape(tf.slice(grad, [offset], [size]),
+                                       shape),
+                            v)
+                        offset += size
+
+        return average_grads
+
+    def _get_buckets(self, grads_and_vars):
+        """
+        Group indices of gradients in `grads_and_vars` into buckets of at
+        most `bucket_size` bytes, in the order of variables. A bucket only
+        holds gradients of the same dtype. None gradients are left out.
+        """
+        buckets = []
+        bucket = []
+        bucket_bytes = 0
+        bucket_dtype = None
+        for i, (g, v) in enumerate(grads_and_vars):
+            if g is None:
+                continue
+            dtype = g.dtype.base_dtype
+            grad_bytes = v.get_shape().num_elements() * dtype.size
+            if bucket and (bucket_bytes + grad_bytes > self.bucket_size
+                           or dtype != bucket_dtype):
+                buckets.append(bucket)
+                bucket = []
+                bucket_bytes = 0
+            bucket.append(i)
+            bucket_bytes += grad_bytes
+            bucket_dtype = dtype
+        if bucket:
+            buckets.append(bucket)
+
+        return buckets
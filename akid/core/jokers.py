@@ -8,6 +8,7 @@ import abc
 import sys
 import inspect
 
+import numpy as np
 import tensorflow as tf
 
 from .blocks import Block
@@ -23,6 +24,13 @@ class Joker(Block):
 
     A Joker normally accepts one input -- so its `_setup` only takes one input,
     and gives out one output -- so the output is revealed via property `data`.
+
+    A Joker works on one example by default. When `batch_mode` is True, its
+    input is a batch of examples instead. Jokers that are able to process a
+    batch directly should override `_support_batch` to return True for inputs
+    they could handle, in which case `_setup` is called with the batch. For
+    other jokers, the per example `_setup` is mapped over the batch by
+    `tf.map_fn`, which is correct but slower.
     """
     def __init__(self, do_summary=False, **kwargs):
         """
@@ -36,6 +44,32 @@ class Joker(Block):
         # value, so we put the changed value in.
         kwargs["do_summary"] = do_summary
         super(Joker, self).__init__(**kwargs)
+        self.batch_mode = False
+
+    def setup(self, data_in):
+        if not self.batch_mode or self._support_batch(data_in):
+            super(Joker, self).setup(data_in)
+            return
+
+        log.info("{} does not support batch input. Apply it per"
+                 " example.".format(self.name))
+
+        def process_example(datum):
+            super(Joker, self).setup(datum)
+            return self._data
+
+        # `_setup` sees single examples when called by `tf.map_fn`.
+        self.batch_mode = False
+        data = tf.map_fn(process_example, data_in, back_prop=False)
+        self.batch_mode = True
+        self._data = data
+
+    def _support_batch(self, data_in):
+        """
+        Whether `_setup` could process `data_in`, which is a batch of examples,
+        directly.
+        """
+        return False
 
     @abc.abstractmethod
     def _setup(self, data_in):
@@ -54,7 +88,19 @@ class Joker(Block):
 class JokerSystem(LinkedSystem):
     """
     A system consists of linearly linked jokers to do data augmentation.
+
+    If `batch_mode` is True, the input is a batch of examples, and all jokers
+    in the system are set up in batch mode. See `Joker`.
     """
+    def __init__(self, batch_mode=False, **kwargs):
+        super(JokerSystem, self).__init__(**kwargs)
+        self.batch_mode = batch_mode
+
+    def _setup(self, data_in):
+        for j in self.blocks:
+            j.batch_mode = self.batch_mode
+        super(JokerSystem, self)._setup(data_in)
+
     def attach(self, joker):
         assert issubclass(type(joker), Joker),\
             "A `JokerSystem` should only contain `Joker`s."
@@ -85,8 +131,24 @@ class CropJoker(Joker):
         self.center = center
         self.central_fraction = central_fraction
 
+    def _support_batch(self, data_in):
+        # Only center cropping without padding is done the same way for all
+        # examples.
+        if not self.center or self.central_fraction:
+            return False
+        shape = data_in.get_shape().as_list()
+        return shape[1] >= self.height and shape[2] >= self.width
+
     def _setup(self, data_in):
-        if self.center:
+        if self.batch_mode:
+            log.info("Center crop image batches.")
+            shape = data_in.get_shape().as_list()
+            offset_height = (shape[1] - self.height) // 2
+            offset_width = (shape[2] - self.width) // 2
+            self._data = tf.slice(data_in,
+                                  [0, offset_height, offset_width, 0],
+                                  [-1, self.height, self.width, -1])
+        elif self.center:
             log.info("Center crop images.")
             if self.central_fraction:
                 self._data = tf.image.central_crop(
@@ -116,8 +178,23 @@ class FlipJoker(Joker):
         super(FlipJoker, self).__init__(**kwargs)
         self.flip_left_right = flip_left_right
 
+    def _support_batch(self, data_in):
+        return True
+
     def _setup(self, data_in):
-        if self.flip_left_right:
+        if self.batch_mode:
+            log.info("Randomly flip image batches {}.".format(
+                "left right" if self.flip_left_right else "up down"))
+            # Draw a coin for each example, and pick between the flipped and
+            # the original batch.
+            if self.flip_left_right:
+                dims = [False, False, True, False]
+            else:
+                dims = [False, True, False, False]
+            mirror = tf.less(
+                tf.random_uniform([tf.shape(data_in)[0]], 0, 1.0), 0.5)
+            self._data = tf.select(mirror, tf.reverse(data_in, dims), data_in)
+        elif self.flip_left_right:
             log.info("Randomly flip image left right.")
             self._data = tf.image.random_flip_left_right(data_in)
         else:
@@ -157,8 +234,26 @@ class WhitenJoker(Joker):
     """
     Per image whitening joke.
     """
+    def _support_batch(self, data_in):
+        return True
+
     def _setup(self, data_in):
-        self._data = tf.image.per_image_standardization(data_in)
+        if not self.batch_mode:
+            self._data = tf.image.per_image_standardization(data_in)
+            return
+
+        # The same computation as `tf.image.per_image_standardization`, but
+        # statistics are reduced per example.
+        shape = data_in.get_shape().as_list()
+        num_pixels = shape[1] * shape[2] * shape[3]
+        mean = tf.reduce_mean(data_in, [1, 2, 3], keep_dims=True)
+        variance = tf.reduce_mean(tf.square(data_in - mean),
+                                  [1, 2, 3],
+                                  keep_dims=True)
+        # Guard against division by zero on uniform images.
+        min_stddev = 1.0 / np.sqrt(num_pixels)
+        stddev = tf.maximum(tf.sqrt(variance), min_stddev)
+        self._data = (data_in - mean) / stddev
 
 
 class RescaleJoker(Joker):
@@ -193,7 +288,16 @@ class ResizeJoker(Joker):
         self.width = width
         self.resize_method = resize_method
 
+    def _support_batch(self, data_in):
+        return True
+
     def _setup(self, data_in):
+        if self.batch_mode:
+            self._data = tf.image.resize_images(data_in,
+                                                [self.height, self.width],
+                                                method=self.resize_method)
+            return
+
         shape = data_in.get_shape().as_list()
         if len(shape) == 3:
             data = tf.expand_dims(data_in, 0)
@@ -7,12 +7,16 @@ import os
 import time
 import sys
 import inspect
+import threading
+from collections import deque
 
+import numpy as np
 import tensorflow as tf
 
 from ..utils import glog as log
 from . import sensors
 from . import engines
+from . import savers
 from .kongfus import LearningRateScheme
 from . import common
 from .common import (
@@ -36,6 +40,7 @@ class Kid(object):
         * `on_val_log_step`
         * `on_train_begin`
         * `on_batch_begin`
+        * `on_batch_end`
 
     Refer to function that calls functions on hooks for detailed explanation on
     what does those hooks do. For example, to refer to method
@@ -54,6 +59,60 @@ class Kid(object):
     where `func` is the function you want it to be called. Functions added to
     hooks are supposed to take a `Kid` instance, which serves to provide
     information needed. That is also to say, no more information is available.
+
+    To tell whether training is limited by the input pipeline or by
+    computation, each training step is split into the time to build the feed
+    dict and the time to run the session. If `trace_step` is given, every
+    `trace_step` steps, the step is run with full tracing, and the time the
+    dequeue op of the sensor's training queue waits is read from
+    `tf.RunMetadata`. For `IntegratedSensor`, the size of the training queue
+    is read along with each step. Those are kept for the last `timing_window`
+    steps, and summarized by `timing_stats`, which are logged with training
+    statistics. The `tf.RunMetadata` of a traced step is kept in
+    `run_metadata`, and the index of the step in `traced_step`, till the next
+    step, so hooks on `on_batch_end` could use them, for example,
+    `profile_blocks` in `callbacks`.
+
+    For small models, the per step overhead in python, that is hook dispatch,
+    building the feed dict, fetching loss and evaluation metrics, is a large
+    part of the step time. If `steps_per_run` is larger than one, up to that
+    many steps are run by one `forward_backward`, where all steps but the last
+    one only run the training op. Runs never cross validation, logging or
+    epoch boundaries, so those happen at the same steps as running one step
+    at a time. Hooks on `on_batch_begin` and `on_batch_end` are called once
+    per run, with the number of steps of the run in `run_step_num`.
+
+    To keep per step overhead low further, what to fetch and feed in
+    training and validation steps is compiled once into a step plan at the
+    end of `setup`, instead of being rebuilt each step. If the session
+    supports `make_callable`, steps that do not feed are run through
+    callables made from the plan.
+
+    Saving checkpoints blocks training. If `async_save` is True, checkpoints
+    are written in the background by an `AsyncSaver`, which keeps the latest
+    `keep_last_ckpt_num` checkpoints and the one with the lowest validation
+    loss.
+
+    Validation pauses training as well. If `async_val` is True, weights are
+    snapshot into a second session on the same graph, and the validation
+    epoch runs on the validation brain in that session in a worker thread,
+    while training goes on. The second session uses `val_thread_num` threads
+    for ops. When the result is ready, hooks on `on_val_log_step` are called
+    from the training thread, with `step`, `loss_value` and `evals` of the
+    kid temporarily set to the ones of the validation. At most one
+    validation runs at a time.
+
+    Training could be recovered from failures, for instance, a parameter
+    server or worker of a distributed kid that is killed and restarted. If
+    `max_recovery_num` is larger than zero, on a `tf.OpError` in `practice`,
+    the session is rebuilt after `recovery_interval` seconds, variables are
+    restored from the latest checkpoint (or initialized if there is none),
+    `step` and `epoch` are derived from the restored global step, and
+    training resumes. Thus at most `val_log_step` steps are lost in a
+    recovery. Up to `max_recovery_num` recoveries are tried before giving
+    up, when the error is raised. Since workers of the asynchronous "distributed" engine only wait for
+    variables to be initialized before training, a worker could join, or
+    rejoin, a running cluster at any time.
     """
     def __init__(self,
                  sensor_in,
@@ -70,7 +129,19 @@ class Kid(object):
                  graph=None,
                  save_chk_point=True,
                  do_summary=True,
-                 summary_on_val=False):
+                 summary_on_val=False,
+                 trace_step=None,
+                 timing_window=100,
+                 input_bound_threshold=0.2,
+                 steps_per_run=1,
+                 async_save=False,
+                 max_pending_save_num=1,
+                 keep_last_ckpt_num=5,
+                 keep_best_ckpt=True,
+                 async_val=False,
+                 val_thread_num=None,
+                 max_recovery_num=0,
+                 recovery_interval=5):
         """
         Assemble a sensor, a brain, and a KongFu to start the survival game.
 
@@ -86,7 +157,7 @@ class Kid(object):
                 to use, which implements parallel scheme. Available engines
                 are:
 
-                    'single', 'data_parallel'
+                    'single', 'data_parallel', 'distributed'
 
                 Default parameters of that scheme will be used.
 
@@ -94,6 +165,18 @@ class Kid(object):
 
                     {"name": "single"}
                     {"name": "data_parallel", "num_gpu": 2}
+                    {"name": "data_parallel", "num_gpu": 2,
+                     "bucket_size": 2**22}
+                    {"name": "data_parallel",
+                     "devices": ["/cpu:0", "/cpu:1"]}
+                    {"name": "data_parallel", "num_gpu": 2,
+                     "tower_weights": [2, 1]}
+                    {"name": "distributed",
+                     "cluster": {"ps": ["localhost:2222"],
+                                 "worker": ["localhost:2223",
+                                            "localhost:2224"]},
+                     "task_index": 0,
+                     "sync_replicas": False}
 
                where the `name` key indicates the parallel scheme while other
                keys are parameters of that scheme. If parameters are not
@@ -136,6 +219,38 @@ class Kid(object):
                 validation source will reshuffle data after one epoch is
                 finished, some validation may be reused and some may not be
                 seen at all when doing the actual validation.
+            trace_step: int
+                After how many steps a training step is run with full tracing
+                to measure the time waiting on the input queue. Tracing slows
+                the traced step down, so it is off by default, that is, no
+                step is traced if it is None.
+            timing_window: int
+                The number of most recent steps to compute timing statistics
+                on.
+            input_bound_threshold: float
+                If the fraction of step time spent on getting input is larger
+                than this, training is considered input-bound.
+            steps_per_run: int
+                The maximal number of training steps run by one
+                `forward_backward`.
+            async_save: Boolean
+                Whether to write checkpoints in a background thread.
+            max_pending_save_num: int
+            keep_last_ckpt_num: int
+            keep_best_ckpt: Boolean
+                Options of `AsyncSaver`, used if `async_save` is True.
+            async_val: Boolean
+                Whether to validate in a second session concurrently with
+                training. It could not be used with `summary_on_val`.
+            val_thread_num: int
+                The number of threads the validation session uses for intra
+                and inter op parallelism. If None, decided by tensorflow.
+            max_recovery_num: int
+                The maximal number of times to recover training from
+                failures. If zero, errors are raised on failures.
+            recovery_interval: a real number
+                Seconds to wait before recovering, for failed servers to
+                restart.
             Other args are self-evident.
         """
         self.sensor = sensor_in
@@ -164,12 +279,32 @@ class Kid(object):
             "Only one of `max_steps` and `max_epoch` could be used."
         assert self.max_steps is not None or self.max_epoch is not None,\
             "At least one `max_steps` and `max_epoch` is needed."
+        # Validation data fed for summaries on training steps would be drawn
+        # from the source by the training thread, while the validation thread
+        # is reading it.
+        assert not (async_val and summary_on_val),\
+            "`summary_on_val` is not supported with `async_val`."
 
         self.train_log_step = train_log_step
         self.val_log_step = val_log_step
         self.summary_on_val = summary_on_val
         self.do_summary = do_summary
         self.save_chk_point = save_chk_point
+        self.trace_step = trace_step
+        self.input_bound_threshold = input_bound_threshold
+        self.steps_per_run = steps_per_run
+        self.async_save = async_save
+        self.max_pending_save_num = max_pending_save_num
+        self.keep_last_ckpt_num = keep_last_ckpt_num
+        self.keep_best_ckpt = keep_best_ckpt
+        self.async_saver = None
+        self.async_val = async_val
+        self.val_thread_num = val_thread_num
+        self.val_sess = None
+        self._val_thread = None
+        self._val_result = None
+        self.max_recovery_num = max_recovery_num
+        self.recovery_interval = recovery_interval
 
         # A tensorflow computational graph to hold training and validating
         # graphs.
@@ -182,6 +317,7 @@ class Kid(object):
         # since both training and validation may start this, while it should
         # only be started once.
         self.initialized = False
+        self.engine = None
 
         # Set up hooks.
         class hooks(object):
@@ -190,6 +326,7 @@ class Kid(object):
                 self.on_val_log = []
                 self.on_train_begin = []
                 self.on_batch_begin = []
+                self.on_batch_end = []
                 self.on_epoch_end = []
                 self.add_default_hooks()
 
@@ -206,6 +343,9 @@ class Kid(object):
                 from .callbacks import on_batch_begin
                 self.on_batch_begin.append(on_batch_begin)
 
+                from .callbacks import on_batch_end
+                self.on_batch_end.append(on_batch_end)
+
         self.hooks = hooks()
 
         # Class members whose value depends on the state of the class.
@@ -213,6 +353,20 @@ class Kid(object):
         self.loss_value = None
         self.evals = None
         self.best_val_evals = None
+        # Timings in seconds and queue sizes of recent training steps.
+        self.feed_times = deque(maxlen=timing_window)
+        self.run_times = deque(maxlen=timing_window)
+        self.queue_wait_times = deque(maxlen=timing_window)
+        self.reduction_times = deque(maxlen=timing_window)
+        self.queue_sizes = deque(maxlen=timing_window)
+        self.run_metadata = None
+        self.traced_step = None
+        # The number of steps of the current run of `forward_backward`.
+        self.run_step_num = 1
+        # Serialized summaries fetched by the last training step, if any.
+        self.summary_str = None
+        # Learning rate fetched by the last step to log.
+        self.lr_value = None
 
     def validate(self):
         """Evaluating on validation set.
@@ -228,18 +382,35 @@ class Kid(object):
         if not self.initialized:
             self.init(continue_from_chk_point=True)
 
-        # Run one epoch of eval.
-        eval_metric_values = [0] * len(self.engine.eval(get_val=True))
+        self.loss_value, self.evals = self._run_val_epoch(self.sess)
+        self.on_val_log_step()
+
+        return self.loss_value
+
+    def _run_val_epoch(self, sess):
+        """
+        Run one epoch of validation in `sess`.
+
+        If `exact_val` of the sensor is True, each validation sample is
+        evaluated exactly once, and metrics of batches are averaged weighted
+        by their sizes, so the last partial batch counts as much as it holds.
+
+        Return:
+            A tuple of the validation loss and the list of evaluation metrics.
+        """
+        if self.sensor.exact_val:
+            return self._run_exact_val_epoch(sess)
+
+        eval_metric_values = [0] * len(self.val_eval_names)
         loss = 0
         steps_per_epoch = self.sensor.num_batches_per_epoch_val
+        feed_dict = None
 
         for step in xrange(steps_per_epoch):
             if type(self.sensor) is sensors.FeedSensor:
-                self.feed_dict = self.sensor.fill_feed_dict(get_val=True)
+                feed_dict = self.sensor.fill_feed_dict(get_val=True)
 
-            fetch = [self.engine.loss(get_val=True)]
-            fetch.extend(self.engine.eval(get_val=True))
-            result = self.sess.run(fetch, feed_dict=self.feed_dict)
+            result = sess.run(self._val_fetch, feed_dict=feed_dict)
 
             loss += result[0]
             for i, v in enumerate(result[1:]):
@@ -249,20 +420,169 @@ class Kid(object):
         for i, v in enumerate(eval_metric_values):
             eval_metric_values[i] = v / steps_per_epoch
 
-        self.loss_value = loss
-        self.evals = eval_metric_values
+        return loss, eval_metric_values
+
+    def _run_exact_val_epoch(self, sess):
+        eval_metric_values = [0] * len(self.val_eval_names)
+        loss = 0
+        num_val = self.sensor.source.num_val
+        batch_size = self.sensor.val_batch_size
+
+        for start in xrange(0, num_val, batch_size):
+            num = min(batch_size, num_val - start)
+            feed_dict = self.sensor.fill_exact_val_feed_dict(start, num)
+            # The sensor may cache the batch for later epochs.
+            cache_fetch = self.sensor.val_cache_fetch
+
+            result = sess.run(self._val_fetch + tuple(cache_fetch),
+                              feed_dict=feed_dict)
+            if cache_fetch:
+                val_fetch_num = len(self._val_fetch)
+                self.sensor.cache_val_batch(start, result[val_fetch_num:])
+                result = result[:val_fetch_num]
+
+            loss += result[0] * num
+            for i, v in enumerate(result[1:]):
+                eval_metric_values[i] += v * num
+
+        loss /= num_val
+        for i, v in enumerate(eval_metric_values):
+            eval_metric_values[i] = v / num_val
+
+        return loss, eval_metric_values
+
+    def _setup_val_session(self):
+        """
+        Create the session to validate in concurrently, and ops to load
+        weights into it.
+        """
+        self._val_variables = tf.global_variables()
+        self._val_placeholders = [
+            tf.placeholder(v.dtype.base_dtype, v.get_shape())
+            for v in self._val_variables]
+        self._val_load_op = tf.group(*[
+            tf.assign(v, p)
+            for v, p in zip(self._val_variables, self._val_placeholders)])
+
+        config = self._get_session_config()
+        if self.val_thread_num:
+            config.intra_op_parallelism_threads = self.val_thread_num
+            config.inter_op_parallelism_threads = self.val_thread_num
+        self.val_sess = tf.Session(graph=self.graph, config=config)
+
+    def _get_val_queue_runners(self):
+        """
+        Return queue runners that the validation data depend on, so the
+        validation session does not fill training queues.
+        """
+        runners = tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS)
+
+        def get_upstream_ops(ops):
+            upstream_ops = set()
+            ops = list(ops)
+            while ops:
+                op = ops.pop()
+                if op in upstream_ops:
+                    continue
+                upstream_ops.add(op)
+                ops.extend(t.op for t in op.inputs)
+                ops.extend(op.control_inputs)
+            return upstream_ops
+
+        val_ops = get_upstream_ops([self.sensor.val_data.op])
+        val_runners = []
+        found_new = True
+        while found_new:
+            found_new = False
+            for r in runners:
+                if r not in val_runners and r.queue.queue_ref.op in val_ops:
+                    val_runners.append(r)
+                    val_ops |= get_upstream_ops(r.enqueue_ops)
+                    found_new = True
+
+        return val_runners
+
+    def _start_async_validation(self, ckpt_step=None):
+        """
+        Snapshot weights into the validation session, and start validating
+        in a worker thread.
+
+        Args:
+            ckpt_step: int
+                The step of the checkpoint saved along, if any, so its
+                validation loss is recorded.
+        """
+        # Only one validation runs at a time.
+        self._report_async_validation(wait=True)
+
+        if self.val_sess is None:
+            with self.graph.as_default():
+                self._setup_val_session()
+            if type(self.sensor) is sensors.IntegratedSensor:
+                for r in self._get_val_queue_runners():
+                    r.create_threads(self.val_sess, daemon=True, start=True)
+
+        values = self.sess.run(self._val_variables)
+        self.val_sess.run(self._val_load_op,
+                          feed_dict=dict(zip(self._val_placeholders, values)))
+
+        step = self.step
+        log.info("Start validating step {} asynchronously.".format(step))
+
+        def validate():
+            try:
+                loss, evals = self._run_val_epoch(self.val_sess)
+                self._val_result = (step, ckpt_step, loss, evals, None)
+            except Exception as e:
+                self._val_result = (step, ckpt_step, None, None, e)
+
+        self._val_thread = threading.Thread(target=validate,
+                                            name="async_validation")
+        self._val_thread.daemon = True
+        self._val_thread.start()
+
+    def _report_async_validation(self, wait=False):
+        """
+        If the asynchronous validation has finished, or `wait` is True, call
+        hooks on its result.
+
+        Return:
+            The validation loss if reported, otherwise, None.
+        """
+        if self._val_thread is None:
+            return None
+        if self._val_thread.is_alive() and not wait:
+            return None
+
+        self._val_thread.join()
+        self._val_thread = None
+        step, ckpt_step, loss, evals, error = self._val_result
+        if error is not None:
+            raise error
+
+        log.info('Validation Data Eval of step {}:'.format(step))
+        train_state = (self.step, self.loss_value, self.evals)
+        self.step, self.loss_value, self.evals = step, loss, evals
         self.on_val_log_step()
+        self.step, self.loss_value, self.evals = train_state
+        self._record_val_loss(ckpt_step, loss)
 
         return loss
 
+    def _record_val_loss(self, ckpt_step, loss):
+        if ckpt_step is not None and self.async_saver:
+            self.async_saver.record_val_loss(ckpt_step, loss)
+
     def setup(self):
         """
         Set up logging and the computation graph.
         """
-        with self.graph.as_default():
+        self._setup_log()
+        if self.engine is None:
+            self._create_engine()
+        with self.graph.as_default(), tf.device(self.engine.device):
             common.init()
             self.global_step_tensor = common.global_step_tensor
-            self._setup_log()
             self._setup_sensor()
             self._setup_engine()
             self._setup_summary()
@@ -271,13 +591,106 @@ class Kid(object):
                 train_op_list = list(self.brain.train_op)
             else:
                 train_op_list = [self.brain.train_op]
+            self.accum_op = None
+            if self.engine.accum_op is not None:
+                # Train ops of the brain run on every micro-batch.
+                self.accum_op = tf.group(
+                    *(train_op_list + [self.engine.accum_op]))
             train_op_list.append(self.engine.train_op)
             self.train_op = tf.group(*train_op_list)
             self.saver = tf.train.Saver(tf.global_variables())
+            if self.async_save:
+                self.async_saver = savers.AsyncSaver(
+                    tf.global_variables(),
+                    self.model_dir,
+                    max_pending_save_num=self.max_pending_save_num,
+                    keep_last_num=self.keep_last_ckpt_num,
+                    keep_best=self.keep_best_ckpt)
             if self.sess is None:
-                config = tf.ConfigProto(allow_soft_placement=True)
-                config.gpu_options.allow_growth = True
-                self.sess = tf.Session(graph=self.graph, config=config)
+                self.sess = self._create_session()
+            self._compile_step_plan()
+
+    def _create_session(self):
+        return tf.Session(self.engine.session_target,
+                          graph=self.graph,
+                          config=self._get_session_config())
+
+    def _get_session_config(self):
+        config = tf.ConfigProto(allow_soft_placement=True)
+        config.gpu_options.allow_growth = True
+        cpu_device_num = self.engine.cpu_device_num
+        if cpu_device_num > 1:
+            log.info("Create {} CPU devices.".format(cpu_device_num))
+            config.device_count["CPU"] = cpu_device_num
+        return config
+
+    def _compile_step_plan(self):
+        """
+        Compile fetches, evaluation names, and whether feeds of training
+        steps are static, which do not change across steps.
+        """
+        self.eval_names = [g.op.name for g in self.engine.eval()]
+        self.val_eval_names = [g.op.name
+                               for g in self.engine.eval(get_val=True)]
+
+        self._val_fetch = tuple(
+            [self.engine.loss(get_val=True)]
+            + list(self.engine.eval(get_val=True)))
+
+        # Fetches of training steps are laid out as: train op, loss,
+        # evaluation metrics, then optionally the size of the training
+        # queue. Fetches of steps to log additionally have the learning rate
+        # and summaries, if any.
+        fetch = [self.train_op, self.engine.loss()]
+        fetch.extend(self.engine.eval())
+        self._eval_slice = slice(2, len(fetch))
+        train_queue = self._get_train_queue()
+        self._queue_size_idx = None
+        if train_queue:
+            self._queue_size_idx = len(fetch)
+            fetch.append(train_queue["size"])
+        self._fetch = tuple(fetch)
+
+        self._lr_idx = None
+        if self.kongfu.lr_scheme["name"] is LearningRateScheme.exp_decay:
+            self._lr_idx = len(fetch)
+            fetch.append(self.kongfu.learning_rate)
+        self._summary_idx = None
+        if self.do_summary:
+            self._summary_idx = len(fetch)
+            fetch.append(self.summary_op)
+        self._log_fetch = tuple(fetch)
+
+        # Data of `IntegratedSensor` are tensors in the graph, so only a
+        # learning rate placeholder needs feeding.
+        self._is_feed_static = type(self.sensor) is not sensors.FeedSensor \
+            and self.kongfu.lr_scheme["name"] \
+            is not LearningRateScheme.placeholder
+        self._make_callables()
+
+    def _make_callables(self):
+        """
+        Make callables of the step plan in the current session.
+        """
+        self._callables = {}
+        if self._is_feed_static and hasattr(self.sess, "make_callable"):
+            plan = [(self.train_op,), self._fetch, self._log_fetch]
+            if self.accum_op is not None:
+                plan.append((self.accum_op,))
+            for f in plan:
+                self._callables[f] = self.sess.make_callable(list(f))
+
+    def _run(self, fetch, options=None, run_metadata=None):
+        """
+        Run `fetch` of the step plan with current feed dict.
+        """
+        if fetch in self._callables and run_metadata is None:
+            return self._callables[fetch]()
+
+        return self.sess.run(list(fetch),
+                             feed_dict=self.feed_dict,
+                             options=options,
+                             run_metadata=run_metadata)
 
     def teardown(self):
         """
@@ -286,6 +699,10 @@ class Kid(object):
         This method has not been tested whether it works or not. It stays here
         to remind that any session created by kid may cause memory leak.
         """
+        if type(self.sensor) is sensors.FeedSensor:
+            self.sensor.stop_prefetching()
+        if self.val_sess:
+            self.val_sess.close()
         self.sess.close()
         self.sess.reset()
 
@@ -300,42 +717,103 @@ class Kid(object):
         Return:
             None
         """
+        recovery_num = 0
+        while True:
+            try:
+                return self._practice(continue_from_chk_point)
+            except tf.OpError as e:
+                log.info("Tensorflow error when running: {}".format(
+                    e.message))
+                if recovery_num >= self.max_recovery_num:
+                    # Raise, so job runners see the run has failed.
+                    raise
+                recovery_num += 1
+                log.info("Recover training in {} sec, attempt {} of"
+                         " {}.".format(self.recovery_interval,
+                                       recovery_num,
+                                       self.max_recovery_num))
+                time.sleep(self.recovery_interval)
+                continue_from_chk_point = self._recover()
+
+    def _recover(self):
+        """
+        Rebuild the session after a failure.
+
+        Return:
+            Whether there is a checkpoint to restore variables from.
+        """
         try:
-            self.init(continue_from_chk_point)
-            # And then after everything is built, start the training loop.
-            log.info("Begin training brain: " + self.brain.name)
-            previous_step = tf.train.global_step(self.sess,
-                                                 self.global_step_tensor)
-            self.step = previous_step
-            # Note the epoch estimation is not accurate if the batch size
-            # cannot divide total number of training samples.
-            self.epoch = previous_step \
-                // self.sensor.num_batches_per_epoch_train
-
-            self.on_train_begin()
-
-            while self.step < self.max_steps + 1:
-                if self.step % self.val_log_step == 0 or\
-                   self.step == self.max_steps:
-                    if self.save_chk_point:
-                        self.save_to_ckpt()
+            self.sess.close()
+        except Exception as e:
+            log.debug("Failed to close the session: {}".format(e))
+        self.sess = self._create_session()
+        self._make_callables()
+        # Queue runners need starting in the new session.
+        self.initialized = False
+
+        return self._has_ckpt()
+
+    def _has_ckpt(self):
+        """
+        Return whether there is a checkpoint under `model_dir` to restore
+        variables from.
+        """
+        if self.async_saver:
+            self.async_saver.join()
+        checkpoint = tf.train.get_checkpoint_state(self.model_dir)
+        return bool(checkpoint and checkpoint.model_checkpoint_path)
+
+    def _practice(self, continue_from_chk_point):
+        self.init(continue_from_chk_point)
+        # And then after everything is built, start the training loop.
+        log.info("Begin training brain: " + self.brain.name)
+        previous_step = tf.train.global_step(self.sess,
+                                             self.global_step_tensor)
+        self.step = previous_step
+        # Note the epoch estimation is not accurate if the batch size
+        # cannot divide total number of training samples.
+        self.epoch = previous_step // self.steps_per_epoch
+
+        self.on_train_begin()
+
+        loss = None
+        while self.step < self.max_steps + 1:
+            # Only the chief saves checkpoints and validates.
+            if self.engine.is_chief and\
+               (self.step % self.val_log_step == 0 or
+                    self.step == self.max_steps):
+                ckpt_step = None
+                if self.save_chk_point:
+                    ckpt_step = self.save_to_ckpt()
+                if self.async_val:
+                    self._start_async_validation(ckpt_step)
+                else:
                     loss = self.validate()
+                    self._record_val_loss(ckpt_step, loss)
+
+            if self.async_val:
+                val_loss = self._report_async_validation()
+                if val_loss is not None:
+                    loss = val_loss
+
+            step_num = self._get_run_step_num()
+            self.forward_backward(step_num)
 
-                self.forward_backward()
+            self.step += step_num
 
-                self.step += 1
+            if self.step % self.steps_per_epoch is 0:
+                self.epoch += 1
+                self.on_epoch_end()
 
-                if self.step % self.sensor.num_batches_per_epoch_train is 0:
-                    self.epoch += 1
-                    self.on_epoch_end()
+            if self.step % self.train_log_step == 0:
+                self.on_train_log_step()
 
-                if self.step % self.train_log_step == 0:
-                    self.on_train_log_step()
+        if self.async_val:
+            loss = self._report_async_validation(wait=True)
+        if self.async_saver:
+            self.async_saver.join()
 
-            return loss
-        except tf.OpError as e:
-            log.info("Tensorflow error when running: {}".format(e.message))
-            sys.exit(0)
+        return loss
 
     def _setup_log(self):
         if not os.path.exists(self.log_dir):
@@ -372,7 +850,7 @@ class Kid(object):
         # Build training graph.
         self.sensor.setup()
 
-    def _setup_engine(self):
+    def _create_engine(self):
         if type(self.engine_para) is str:
             engine_name = self.engine_para
         else:
@@ -387,14 +865,30 @@ class Kid(object):
         elif engine_name == "data_parallel":
             if type(self.engine_para) is str:
                 # TODO: automatically use the maximal even number of gpus.
-                num_gpu = 2
+                engine_para = {"num_gpu": 2}
             else:
-                num_gpu = self.engine_para["num_gpu"]
-            self.engine = engines.DataParallelEngine(num_gpu, kid=self)
+                engine_para = self.engine_para
+            self.engine = engines.DataParallelEngine(
+                engine_para.get("num_gpu", 2),
+                devices=engine_para.get("devices", None),
+                bucket_size=engine_para.get("bucket_size", None),
+                tower_weights=engine_para.get("tower_weights", None),
+                adapt_tower_weights=engine_para.get("adapt_tower_weights",
+                                                    False),
+                kid=self)
+        elif engine_name == "distributed":
+            self.engine = engines.DistributedEngine(
+                self.engine_para["cluster"],
+                task_index=self.engine_para.get("task_index", 0),
+                sync_replicas=self.engine_para.get("sync_replicas", False),
+                replicas_to_aggregate=self.engine_para.get(
+                    "replicas_to_aggregate", None),
+                kid=self)
         else:
             raise Exception('No engine "{}". Perhaps you have a typo.'.format(
                 engine_name))
 
+    def _setup_engine(self):
         self.engine.setup()
 
     def init(self, continue_from_chk_point=None):
@@ -408,14 +902,20 @@ class Kid(object):
                 folder named `model` must exist under `Kid`'s `log_dir`
                 with saved models.
         """
-        # Initialization.
-        if continue_from_chk_point:
-            # Train from pre-trained model.
-            self.restore_from_ckpt()
-        else:
-            with self.graph.as_default():
-                init = tf.global_variables_initializer()
-            self.sess.run(init)
+        # Initialization. The engine decides whether variables need to be
+        # initialized, and may ask to restore the latest checkpoint if there
+        # is one, as a restarted chief of distributed training does.
+        def init_variables(restore_if_any=False):
+            if continue_from_chk_point or \
+               (restore_if_any and self._has_ckpt()):
+                # Train from pre-trained model.
+                self.restore_from_ckpt()
+            else:
+                with self.graph.as_default():
+                    init = tf.global_variables_initializer()
+                self.sess.run(init)
+
+        self.engine.init_session(self.sess, init_variables)
 
         # Start queue runner if needed.
         if type(self.sensor) is sensors.IntegratedSensor:
@@ -426,16 +926,35 @@ class Kid(object):
 
         if self.max_epoch:
             # Convert the max epoch number to max steps.
-            self.max_steps \
-                = self.sensor.num_batches_per_epoch_train * self.max_epoch
+            self.max_steps = self.steps_per_epoch * self.max_epoch
+
+    @property
+    def steps_per_epoch(self):
+        """
+        The number of training steps in an epoch. A step takes
+        `accumulation_num` of `KongFu` batches.
+        """
+        return max(self.sensor.num_batches_per_epoch_train
+                   // self.kongfu.accumulation_num, 1)
 
     def save_to_ckpt(self):
+        """
+        Save a checkpoint, or queue it to be saved if `async_save` is True.
+
+        Return:
+            The training step of the checkpoint.
+        """
         step = tf.train.global_step(self.sess, self.global_step_tensor)
+        if self.async_saver:
+            self.async_saver.save(self.sess, step)
+            return step
+
         self.saver.save(self.sess,
                         self.model_dir + "/checkpoint",
                         global_step=step)
         log.info("Checkpoint at step {} saved to folder:"
                  " {}".format(step, self.model_dir))
+        return step
 
     def restore_from_ckpt(self):
         """
@@ -445,6 +964,9 @@ class Kid(object):
         Return:
             Training step of the checkpoint the net are recovering from.
         """
+        if self.async_saver:
+            # Make sure the latest checkpoint has been written.
+            self.async_saver.join()
         checkpoint = tf.train.get_checkpoint_state(self.model_dir)
         if checkpoint and checkpoint.model_checkpoint_path:
             log.info("Recovering net from checkpoint %s."
@@ -476,22 +998,191 @@ class Kid(object):
             else:
                 self.feed_dict = lr_dict
 
-    def forward_backward(self):
+    def _get_run_step_num(self):
+        """
+        Return the number of steps to run by the next `forward_backward`. It
+        is at most `steps_per_run`, and runs stop at validation, logging and
+        epoch boundaries, and `max_steps`.
+        """
+        if self.step >= self.max_steps:
+            return 1
+
+        step_num = min(self.steps_per_run, self.max_steps - self.step)
+        for interval in [self.val_log_step,
+                         self.train_log_step,
+                         self.steps_per_epoch]:
+            step_num = min(step_num, interval - self.step % interval)
+
+        return step_num
+
+    def forward_backward(self, step_num=1):
         """
-        Train for one step.
+        Train for `step_num` steps. Only the last step fetches loss,
+        evaluation metrics and so on, which are recorded, and is timed.
+        `forward_backward_time` is the average time of the steps.
+
+        If gradients are accumulated, a step accumulates gradients of all
+        micro-batches but the last one first, then applies them along with
+        the last one, on which loss and evaluation metrics are computed.
         """
-        # Run one step.
+        self.run_step_num = step_num
         self.on_batch_begin()
 
-        self.fill_train_feed_dict()
+        run_start_time = time.time()
+        for _ in xrange(step_num - 1):
+            self._accumulate_grads()
+            if not self._is_feed_static:
+                self.fill_train_feed_dict()
+            self._run((self.train_op,))
+        self._accumulate_grads()
+        # The index of the step the result of which is fetched.
+        step = self.step + step_num - 1
 
-        fetch = [self.train_op, self.engine.loss()]
-        fetch.extend(self.engine.eval())
         start_time = time.time()
-        result = self.sess.run(fetch, feed_dict=self.feed_dict)
-        self.forward_backward_time = time.time() - start_time
+        if not self._is_feed_static:
+            self.fill_train_feed_dict()
+        self.feed_times.append(time.time() - start_time)
+
+        # Summaries and the learning rate are fetched along with the step
+        # before logging, so the graph does not run again, and summaries are
+        # on the trained batch.
+        is_log_step = (step + 1) % self.train_log_step == 0
+        fetch = self._log_fetch if is_log_step else self._fetch
+
+        # Trace if a multiple of `trace_step` is among the steps run.
+        if self.trace_step \
+           and step // self.trace_step != (self.step - 1) // self.trace_step:
+            options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            run_metadata = tf.RunMetadata()
+        else:
+            options = None
+            run_metadata = None
+
+        start_time = time.time()
+        result = self._run(fetch, options, run_metadata)
+        self.run_times.append(time.time() - start_time)
+        self.forward_backward_time = (time.time() - run_start_time) / step_num
         self.loss_value = result[1]
-        self.evals = result[2:]
+        self.evals = result[self._eval_slice]
+
+        self.summary_str = None
+        if is_log_step:
+            if self._lr_idx is not None:
+                self.lr_value = result[self._lr_idx]
+            if self._summary_idx is not None:
+                self.summary_str = result[self._summary_idx]
+        if self._queue_size_idx is not None:
+            self.queue_sizes.append(result[self._queue_size_idx])
+        if run_metadata:
+            self.queue_wait_times.append(
+                self._get_queue_wait_time(run_metadata,
+                                          self._get_train_queue()))
+            reduction_time = self.engine.get_reduction_time(run_metadata)
+            if reduction_time is not None:
+                self.reduction_times.append(reduction_time)
+            self.engine.adapt_to_trace(self.sess, run_metadata)
+        self.run_metadata = run_metadata
+        self.traced_step = step if run_metadata else None
+
+        self.on_batch_end()
+
+    def _accumulate_grads(self):
+        """
+        Accumulate gradients of all micro-batches of a step but the last.
+        """
+        if self.accum_op is None:
+            return
+
+        for _ in xrange(self.kongfu.accumulation_num - 1):
+            if not self._is_feed_static:
+                self.fill_train_feed_dict()
+            self._run((self.accum_op,))
+
+    def _get_train_queue(self):
+        """
+        Return the training queue of the sensor, as described in `queues` of
+        `IntegratedSensor`, or None if the sensor does not have one.
+        """
+        if type(self.sensor) is sensors.IntegratedSensor:
+            return self.sensor.queues["train_data"]
+
+        return None
+
+    def _get_queue_wait_time(self, run_metadata, train_queue):
+        """
+        Return the time in seconds the dequeue op of `train_queue` runs in the
+        traced step, which is the time waiting on input. For sensors without
+        queues, it is zero.
+        """
+        if not train_queue:
+            return 0
+
+        dequeue_op_name = train_queue["dequeue_op"].name
+        for dev_stats in run_metadata.step_stats.dev_stats:
+            for node_stats in dev_stats.node_stats:
+                if node_stats.node_name == dequeue_op_name:
+                    return node_stats.all_end_rel_micros / 1e6
+
+        return 0
+
+    @property
+    def timing_stats(self):
+        """
+        Statistics of timings of the recent training steps.
+
+        Returns:
+            A dict. "feed_time", "queue_wait_time" and "run_time" map to
+            tuples of 50th and 90th percentiles of the time in seconds to
+            build the feed dict, to wait on the training queue and to run the
+            session. "queue_size" maps to a tuple of the 10th and 50th
+            percentiles of the size of the training queue, or None if there
+            is no such queue. "reduction_time" maps to a tuple of the 50th
+            and 90th percentiles of the time to reduce gradients across
+            towers in traced steps, or None if the engine does not reduce
+            gradients. "input_fraction" is the fraction of median
+            step time spent getting input. "verdict" is "input-bound" if it
+            is larger than `input_bound_threshold`, otherwise
+            "compute-bound". Waits on a training queue are only measured in
+            traced steps, so if no step is traced, the verdict is
+            "input-bound" if the 10th percentile of the queue size is at most
+            `min_after_dequeue` plus a batch, that is the queue is starved.
+            It is "unknown" if no step has run.
+        """
+        def percentiles(values, qs):
+            if not values:
+                return tuple(0. for _ in qs)
+            return tuple(np.percentile(values, q) for q in qs)
+
+        stats = {
+            "feed_time": percentiles(self.feed_times, [50, 90]),
+            "queue_wait_time": percentiles(self.queue_wait_times, [50, 90]),
+            "run_time": percentiles(self.run_times, [50, 90]),
+            "queue_size": percentiles(self.queue_sizes, [10, 50])
+            if self.queue_sizes else None,
+            "reduction_time": percentiles(self.reduction_times, [50, 90])
+            if self.reduction_times else None
+        }
+
+        # The queue wait is part of the session run time.
+        input_time = stats["feed_time"][0] + stats["queue_wait_time"][0]
+        step_time = stats["feed_time"][0] + stats["run_time"][0]
+        stats["input_fraction"] = input_time / step_time if step_time else 0.
+
+        train_queue = self._get_train_queue()
+        if not step_time:
+            stats["verdict"] = "unknown"
+        elif self.queue_wait_times or not train_queue:
+            stats["verdict"] = "input-bound" \
+                if stats["input_fraction"] > self.input_bound_threshold \
+                else "compute-bound"
+        else:
+            min_size = train_queue["min_after_dequeue"] \
+                + self.sensor.batch_size
+            stats["verdict"] = "input-bound" \
+                if stats["queue_size"][0] <= min_size \
+                else "compute-bound"
+
+        return stats
 
     def on_train_log_step(self):
         """
@@ -529,6 +1220,15 @@ class Kid(object):
         for func in self.hooks.on_batch_begin:
             func(self)
 
+    def on_batch_end(self):
+        """
+        Call hooks after a training step has run. `run_metadata` holds the
+        trace of the step if it is traced, and `traced_step` its index,
+        otherwise, both are None.
+        """
+        for func in self.hooks.on_batch_end:
+            func(self)
+
     def on_epoch_end(self):
         for func in self.hooks.on_epoch_end:
             func(self)
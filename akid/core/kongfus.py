@@ -31,6 +31,13 @@ class KongFu(ShadowableBlock):
 
     Any concrete `KongFu` should implement `_get_optimizer` to provide a
     concrete optimizer.
+
+    If `accumulation_num` is larger than 1, gradients are accumulated over
+    that many micro-batches in non-trainable accumulators, and their average
+    is applied once, so the effective batch size is `accumulation_num` times
+    the batch size, at the memory cost of one batch. See `accumulate`. The
+    global step, hence learning rate schedules, and max norm constraints
+    count applied updates, not micro-batches.
     """
     def __init__(self,
                  lr_scheme={"name": LearningRateScheme.exp_decay,
@@ -38,6 +45,7 @@ class KongFu(ShadowableBlock):
                             "decay_rate": 0.95,
                             "num_batches_per_epoch": 468,
                             "decay_epoch_num": 1},
+                 accumulation_num=1,
                  **kwargs):
         """
         Only exponential decay policy is supported now. Learning rate decays to
@@ -61,6 +69,9 @@ class KongFu(ShadowableBlock):
                         standalone, you need to feed a value to
                         `KongFu.learning_rate`.
                  See the default value for an example usage.
+            accumulation_num: int
+                 The number of micro-batches to accumulate gradients over
+                 before applying them.
         """
         # Since normally we do not care what the name of an optimizer is, just
         # give it a default name.
@@ -69,6 +80,9 @@ class KongFu(ShadowableBlock):
 
         super(KongFu, self).__init__(**kwargs)
         self.lr_scheme = lr_scheme
+        assert accumulation_num >= 1, \
+            "`accumulation_num` should be at least 1."
+        self.accumulation_num = accumulation_num
 
     def _setup(self, loss):
         """
@@ -117,6 +131,50 @@ class KongFu(ShadowableBlock):
     def data(self):
         return self._data
 
+    def accumulate(self, grads):
+        """
+        Build graphs to accumulate `grads`, which is a list of (gradient,
+        variable) pairs of a micro-batch, over `accumulation_num`
+        micro-batches.
+
+        Return:
+            A tuple of the op to add gradients of a micro-batch to
+            accumulators, and the list of (gradient, variable) pairs to apply,
+            where gradients average those accumulated and those of the
+            current micro-batch. So an update takes `accumulation_num - 1`
+            runs of the op, followed by one run that applies the gradients.
+            Accumulators should be cleared by the op of
+            `get_clear_accumulators_op` after gradients are applied.
+        """
+        self.accumulators = []
+        accum_ops = []
+        average_grads = []
+        with tf.variable_scope("grad_accum"):
+            for grad, var in grads:
+                if grad is None:
+                    average_grads.append((grad, var))
+                    continue
+                accumulator = tf.get_variable(
+                    var.op.name,
+                    var.get_shape(),
+                    dtype=var.dtype.base_dtype,
+                    initializer=tf.constant_initializer(0),
+                    trainable=False)
+                self.accumulators.append(accumulator)
+                accum_ops.append(tf.assign_add(accumulator, grad))
+                average_grads.append(
+                    ((accumulator + grad) / self.accumulation_num, var))
+
+        return tf.group(*accum_ops, name="accum_op"), average_grads
+
+    def get_clear_accumulators_op(self):
+        """
+        Return the op to zero accumulators created by `accumulate`.
+        """
+        return tf.group(*[tf.assign(a, tf.zeros_like(a))
+                          for a in self.accumulators],
+                        name="clear_accumulators")
+
     @abc.abstractmethod
     def _get_optimizer(self, lr):
         """
@@ -153,5 +211,147 @@ class AdamKongFu(KongFu):
         return tf.train.AdamOptimizer(lr)
 
 
+class LossScalingOptimizer(object):
+    """
+    A wrapper of a `tf.train.Optimizer` that scales the loss up before
+    computing gradients and scales gradients down afterwards, and only applies
+    gradients when they are all finite. It is created by `LossScalingKongFu`,
+    where the scaling policy is documented.
+    """
+    def __init__(self, opt, loss_scale, finite_step_num, scale_factor,
+                 scale_window):
+        self.opt = opt
+        self.loss_scale = loss_scale
+        self.finite_step_num = finite_step_num
+        self.scale_factor = scale_factor
+        self.scale_window = scale_window
+
+    def compute_gradients(self, loss, *args, **kwargs):
+        grads_and_vars = self.opt.compute_gradients(loss * self.loss_scale,
+                                                    *args,
+                                                    **kwargs)
+        with tf.name_scope("loss_unscale"):
+            return [(g / self.loss_scale if g is not None else None, v)
+                    for g, v in grads_and_vars]
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        grads_and_vars = list(grads_and_vars)
+        var_list = [v for g, v in grads_and_vars if g is not None]
+        is_finite = tf.reduce_all(
+            tf.pack([tf.reduce_all(tf.is_finite(g))
+                     for g, v in grads_and_vars if g is not None]),
+            name="is_finite")
+
+        # Slots are created out of `tf.cond`, since variables cannot be
+        # initialized in a branch of it. The optimizer reuses them later.
+        with tf.control_dependencies(None):
+            self.opt._create_slots(var_list)
+
+        def apply():
+            apply_op = self.opt.apply_gradients(grads_and_vars,
+                                                global_step,
+                                                name)
+            with tf.control_dependencies([apply_op]):
+                return tf.constant(True)
+
+        def skip():
+            if global_step is None:
+                return tf.constant(False)
+            # A skipped step still counts as a step.
+            with tf.control_dependencies([tf.assign_add(global_step, 1)]):
+                return tf.constant(False)
+
+        applied = tf.cond(is_finite, apply, skip)
+        with tf.control_dependencies([applied]):
+            return self._update_scale(is_finite)
+
+    def _update_scale(self, is_finite):
+        finite_step_num = tf.select(is_finite,
+                                    self.finite_step_num + 1,
+                                    tf.zeros_like(self.finite_step_num))
+        grow = tf.logical_and(is_finite,
+                              finite_step_num >= self.scale_window)
+        loss_scale = tf.select(
+            is_finite,
+            tf.select(grow,
+                      self.loss_scale * self.scale_factor,
+                      self.loss_scale),
+            tf.maximum(self.loss_scale / self.scale_factor, 1.))
+        finite_step_num = tf.select(grow,
+                                    tf.zeros_like(finite_step_num),
+                                    finite_step_num)
+        return tf.group(tf.assign(self.loss_scale, loss_scale),
+                        tf.assign(self.finite_step_num, finite_step_num),
+                        name="update_loss_scale")
+
+
+class LossScalingKongFu(KongFu):
+    """
+    A `KongFu` that trains with the optimizer of another `KongFu` with loss
+    scaling, which is needed to train a mixed precision `Brain`, since small
+    gradients underflow in float16 otherwise.
+
+    The loss is multiplied by `loss_scale` before gradients are computed, and
+    gradients are divided by it afterwards. The scale is adjusted
+    dynamically. If any gradient is not finite, the update of the step is
+    skipped, and the scale is divided by `scale_factor`. If gradients have
+    been finite for `scale_window` steps in a row, the scale is multiplied by
+    `scale_factor`. The learning rate scheme and the number of micro-batches
+    to accumulate gradients over are also those of the wrapped `KongFu`.
+    """
+    def __init__(self,
+                 kongfu,
+                 init_scale=2.**15,
+                 scale_factor=2.,
+                 scale_window=1000,
+                 **kwargs):
+        """
+        Args:
+            kongfu: KongFu
+                The `KongFu` whose optimizer to use.
+            init_scale: float
+                The initial loss scale.
+            scale_factor: float
+                The factor to multiply or divide the loss scale by.
+            scale_window: int
+                The number of steps with finite gradients in a row to increase
+                the loss scale.
+        """
+        super(LossScalingKongFu, self).__init__(
+            lr_scheme=kongfu.lr_scheme,
+            accumulation_num=kongfu.accumulation_num,
+            **kwargs)
+        self.kongfu = kongfu
+        self.init_scale = float(init_scale)
+        self.scale_factor = float(scale_factor)
+        self.scale_window = scale_window
+
+    def _pre_setup_shared(self):
+        self.loss_scale = tf.get_variable(
+            "loss_scale",
+            [],
+            initializer=tf.constant_initializer(self.init_scale),
+            trainable=False)
+        self.finite_step_num = tf.get_variable(
+            "finite_step_num",
+            [],
+            initializer=tf.constant_initializer(0),
+            trainable=False)
+
+    def _post_setup(self):
+        super(LossScalingKongFu, self)._post_setup()
+        if self.do_summary:
+            tf.summary.scalar("loss_scale",
+                              self.loss_scale,
+                              collections=[TRAINING_DYNAMICS_COLLECTION])
+
+    def _get_optimizer(self, lr):
+        return LossScalingOptimizer(self.kongfu._get_optimizer(lr),
+                                    self.loss_scale,
+                                    self.finite_step_num,
+                                    self.scale_factor,
+                                    self.scale_window)
+
+
 __all__ = [name for name, x in locals().items() if
            not inspect.ismodule(x) and not inspect.isabstract(x)]
@@ -770,7 +770,9 @@ class Observer(object):
             issubclass(block_type, InnerProductLayer), \
             "Block type {} is not supported!".format(block_type)
 
-        w, b = block.var_list[0].eval(sess), block.var_list[1].eval(sess)
+        # Weights may be partitioned into more than one variable, so they
+        # are fetched as a whole.
+        w, b = sess.run([block.weights, block.biases])
         if block.bag:
             if "filters_to_visual" in block.bag:
                 filters_to_visual = block.bag["filters_to_visual"]
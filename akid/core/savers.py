@@ -0,0 +1,218 @@
+"""
+This module contains savers that write checkpoints of variables for `Kid`.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+import inspect
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import tensorflow as tf
+
+from ..utils import glog as log
+
+
+class AsyncSaver(object):
+    """
+    A saver that writes checkpoints in a background thread, so training is
+    not blocked while variables are serialized to disk, which is slow on
+    network file systems.
+
+    To save, values of variables are snapshot to host memory by one
+    `sess.run`, and handed to a writer thread. The thread loads them into a
+    copy of the variables living in a graph and session of its own, and saves
+    the copy by a `tf.train.Saver` under the names of the original
+    variables, shards of partitioned variables being saved as slices of the
+    full ones. Thus checkpoints written could be restored by a
+    `tf.train.Saver` of the original variables. At most
+    `max_pending_save_num` snapshots wait to be written; saving blocks when
+    there are more.
+
+    Checkpoints are named `checkpoint-{step}` under `model_dir`. Only the
+    latest `keep_last_num` checkpoints and, if `keep_best` is True, the one
+    with the lowest validation loss recorded by `record_val_loss` are kept.
+    Others are deleted. If `keep_best` is True, checkpoints later than the
+    latest one validated are kept till their losses are recorded, since
+    validation could finish after later checkpoints are written, for
+    instance, when it runs asynchronously.
+    """
+    def __init__(self,
+                 variables,
+                 model_dir,
+                 max_pending_save_num=1,
+                 keep_last_num=5,
+                 keep_best=True):
+        """
+        Args:
+            variables: list
+                A list of `tf.Variable` to save.
+            model_dir: str
+                The folder to save checkpoints to.
+            max_pending_save_num: int
+                The maximal number of snapshots waiting to be written.
+            keep_last_num: int
+                The number of latest checkpoints to keep. It should be at
+                least one, so the checkpoint state file has a checkpoint to
+                point to.
+            keep_best: Boolean
+                Whether to keep the checkpoint with the lowest validation
+                loss.
+        """
+        if keep_last_num < 1:
+            raise ValueError("At least the latest checkpoint should be kept,"
+                             " but `keep_last_num` is {}.".format(
+                                 keep_last_num))
+
+        self.variables = variables
+        self.model_dir = model_dir
+        self.keep_last_num = keep_last_num
+        self.keep_best = keep_best
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._placeholders = []
+            var_dict = {}
+            mirrors = []
+            for i, v in enumerate(variables):
+                placeholder = tf.placeholder(v.dtype.base_dtype,
+                                             v.get_shape())
+                self._placeholders.append(placeholder)
+                mirror = tf.Variable(placeholder,
+                                     trainable=False,
+                                     name="var_{}".format(i))
+                mirrors.append(mirror)
+                save_slice_info = v._save_slice_info
+                if save_slice_info is None:
+                    var_dict[v.op.name] = mirror
+                else:
+                    # A shard of a partitioned variable is saved as a slice
+                    # of the full variable, as `tf.train.Saver` does.
+                    mirror._set_save_slice_info(save_slice_info)
+                    var_dict.setdefault(save_slice_info.full_name,
+                                        []).append(mirror)
+            self._load_op = tf.variables_initializer(mirrors)
+            # Checkpoints are deleted by the retention policy of this class.
+            self._saver = tf.train.Saver(var_dict, max_to_keep=0)
+        self._sess = tf.Session(graph=self._graph)
+
+        # Steps of checkpoints kept, in order of saving.
+        self._steps = []
+        self._val_losses = {}
+        self._lock = threading.Lock()
+
+        self._queue = queue.Queue(max_pending_save_num)
+        self._error = None
+        self._thread = threading.Thread(target=self._write,
+                                        name="async_saver")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, sess, step):
+        """
+        Snapshot variables in `sess` and queue them to be written as the
+        checkpoint of `step`.
+        """
+        if self._error is not None:
+            raise self._error
+
+        start_time = time.time()
+        values = sess.run(self.variables)
+        snapshot_time = time.time() - start_time
+
+        start_time = time.time()
+        self._queue.put((step, values))
+        log.info("Snapshot of step {} taken in {:.3f} sec; waited {:.3f} sec"
+                 " for pending saves.".format(step,
+                                              snapshot_time,
+                                              time.time() - start_time))
+
+    def join(self):
+        """
+        Wait till all queued checkpoints are written.
+        """
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def record_val_loss(self, step, loss):
+        """
+        Record the validation loss of the checkpoint of `step`, for keeping
+        the best checkpoint.
+        """
+        with self._lock:
+            self._val_losses[step] = loss
+        self._apply_retention()
+
+    def _write(self):
+        while True:
+            step, values = self._queue.get()
+            try:
+                start_time = time.time()
+                self._sess.run(self._load_op,
+                               feed_dict=dict(zip(self._placeholders,
+                                                  values)))
+                self._saver.save(self._sess,
+                                 self._get_path(step),
+                                 write_meta_graph=False)
+                with self._lock:
+                    self._steps.append(step)
+                self._apply_retention()
+                log.info("Checkpoint at step {} written to folder {} in"
+                         " {:.3f} sec.".format(step,
+                                               self.model_dir,
+                                               time.time() - start_time))
+            except Exception as e:
+                log.error("Failed to write checkpoint at step {}: {}".format(
+                    step, e))
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _get_path(self, step):
+        return os.path.join(self.model_dir, "checkpoint-{}".format(step))
+
+    def _apply_retention(self):
+        """
+        Delete checkpoints out of the retention policy, and point the
+        checkpoint state file to the kept ones. It is called by both the
+        writer thread and `record_val_loss`, so it runs under the lock.
+        """
+        with self._lock:
+            if not self._steps:
+                return
+
+            kept_steps = set(
+                self._steps[max(len(self._steps) - self.keep_last_num, 0):])
+            if self.keep_best:
+                val_losses = [(l, s) for s, l in self._val_losses.items()
+                              if s in self._steps]
+                if val_losses:
+                    kept_steps.add(min(val_losses)[1])
+                # Checkpoints are validated in order, so those later than
+                # the latest validated one may be waiting for their losses.
+                last_val_step = max(self._val_losses) \
+                    if self._val_losses else None
+                kept_steps.update(s for s in self._steps
+                                  if last_val_step is None or
+                                  s > last_val_step)
+
+            for step in self._steps:
+                if step not in kept_steps:
+                    path = self._get_path(step)
+                    for f in tf.gfile.Glob(path) + tf.gfile.Glob(path + ".*"):
+                        tf.gfile.Remove(f)
+            self._steps = [s for s in self._steps if s in kept_steps]
+
+            tf.train.update_checkpoint_state(
+                self.model_dir,
+                self._get_path(self._steps[-1]),
+                [self._get_path(s) for s in self._steps])
+
+
+__all__ = [name for name, x in locals().items() if
+           not inspect.ismodule(x) and not inspect.isabstract(x)]
@@ -38,13 +38,22 @@ from __future__ import absolute_import, division, print_function
 import sys
 import abc
 import inspect
-
+import time
+import threading
+import multiprocessing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
 import tensorflow as tf
 
 from .jokers import JokerSystem
 from .blocks import Block
 from ..utils import glog as log
 from . import sources
+from . import caches
 from .common import TRAIN_SUMMARY_COLLECTION, VALID_SUMMARY_COLLECTION
 
 
@@ -59,6 +68,7 @@ class Sensor(Block):
                  source_in,
                  batch_size=100,
                  val_batch_size=100,
+                 exact_val=False,
                  **kwargs):
         """
         Args:
@@ -71,13 +81,48 @@ class Sensor(Block):
             val_batch_size: int
                 The number of samples a time the sensor would provide when
                 doing validation. It is supposed to evenly divide the number of
-                validation samples.
+                validation samples, unless `exact_val` is True.
+            exact_val: Boolean
+                If True, validation data are provided in a deterministic order
+                without shuffling, so a validation epoch goes through each
+                validation sample exactly once, and the last batch holds the
+                remaining samples if `val_batch_size` does not divide the
+                number of validation samples. Consequently, the batch
+                dimension of validation data is of unknown size. Batches are
+                asked by `fill_exact_val_feed_dict`.
         """
         super(Sensor, self).__init__(self, **kwargs)
         self.batch_size = batch_size
         self.val_batch_size = val_batch_size
+        self.exact_val = exact_val
         self.source = source_in
 
+    def fill_exact_val_feed_dict(self, start, num):
+        """
+        Return the feed dict to get the batch of `num` validation samples
+        starting from the `start`th one when `exact_val` is True. Batches
+        should be asked in order.
+        """
+        raise NotImplementedError("Sensor {} does not support exact"
+                                  " validation.".format(self.name))
+
+    @property
+    def val_cache_fetch(self):
+        """
+        Tensors to fetch along with a validation batch asked by
+        `fill_exact_val_feed_dict`, whose values should be passed to
+        `cache_val_batch`. It is empty if nothing is to be cached.
+        """
+        return []
+
+    def cache_val_batch(self, start, values):
+        """
+        Cache `values` of `val_cache_fetch` of the batch of validation
+        samples starting from the `start`th one.
+        """
+        raise NotImplementedError("Sensor {} does not cache validation"
+                                  " data.".format(self.name))
+
     def data(self, get_val=False):
         """
         Args:
@@ -219,10 +264,94 @@ class IntegratedSensor(ShuffleQueueSensor):
     Optionally, it could also do data augmentation. It holds two
     `LinkedSystem`s, `training_jokers` and `val_jokers`, which do data
     processing on training datum and validation datum respectively.
+
+    If the source reads a batch of examples at a time (see `read_batch_size`
+    of `TFSource`), jokers are applied on the batch, and the batch is enqueued
+    as many examples into the shuffle queue.
+
+    If `exact_val` is True, validation examples go through a FIFO queue
+    filled by one thread, so they are batched in the order they are read, and
+    the number of examples to dequeue is fed for each batch. Each validation
+    epoch then takes exactly one pass of the validation source, given that
+    nothing else dequeues validation data, which is the case if
+    `summary_on_val` of `Kid` is False.
+
+    The right number of threads to fill the shuffle queues depends on the
+    host. If `auto_tune` is True, the fill fraction of the training queue is
+    sampled for the first `auto_tune_step_num` training steps, from the queue
+    size `Kid` fetches along with each run of steps. Every
+    `auto_tune_interval` steps, if the queue has drained below
+    `min_fill_fraction`, the number of enqueue threads is doubled, up to the
+    number of CPUs. At the end, the chosen number of threads and a matching
+    queue capacity, which cannot be changed once the queue is created, are
+    logged, so they could be passed in directly in later runs.
+
+    Since processing of validation data is usually deterministic, reading and
+    processing them again in each validation epoch, such as decoding JPEG
+    files, is a waste. If `val_cache_dir` is not None, validation batches,
+    processed by `val_jokers`, are cached by a `MemmapValCache` in that
+    folder in the first validation epoch, and later epochs are fed from the
+    cache, instead of from the validation queue. It needs `exact_val`, so
+    batches are in order. The cache is rewritten if the source, or the class
+    or any parameter of a validation joker, changes. See `MemmapValCache` for
+    `val_cache_dtype` and `val_cache_max_bytes`.
     """
-    def __init__(self, num_preprocess_threads=4,  **kwargs):
+    def __init__(self,
+                 num_preprocess_threads=4,
+                 auto_tune=False,
+                 auto_tune_step_num=300,
+                 auto_tune_interval=50,
+                 min_fill_fraction=0.1,
+                 val_cache_dir=None,
+                 val_cache_dtype="uint8",
+                 val_cache_max_bytes=8 * 2**30,
+                 **kwargs):
+        """
+        Args:
+            num_preprocess_threads: int
+                The number of threads to enqueue examples to each shuffle
+                queue. If `auto_tune` is True, it is the initial number of
+                threads of the training queue.
+            auto_tune: Boolean
+                Whether to tune the number of enqueue threads of the training
+                queue while training.
+            auto_tune_step_num: int
+                The number of training steps to tune for.
+            auto_tune_interval: int
+                The number of steps between two adjustments.
+            min_fill_fraction: float
+                The fraction of the queue, above `min_after_dequeue`, that the
+                training queue should not drain below.
+            val_cache_dir: str
+                The folder to cache processed validation data in. If None,
+                validation data are not cached.
+            val_cache_dtype: str
+                The dtype to cache validation data in.
+            val_cache_max_bytes: int
+                The maximal number of bytes the cache could take.
+        """
         super(IntegratedSensor, self).__init__(**kwargs)
         self.num_preprocess_threads = num_preprocess_threads
+        self.auto_tune = auto_tune
+        self.auto_tune_step_num = auto_tune_step_num
+        self.auto_tune_interval = auto_tune_interval
+        self.min_fill_fraction = min_fill_fraction
+        if val_cache_dir and not self.exact_val:
+            raise ValueError("Caching validation data needs `exact_val`.")
+        self.val_cache_dir = val_cache_dir
+        self.val_cache_dtype = val_cache_dtype
+        self.val_cache_max_bytes = val_cache_max_bytes
+        self.val_cache = None
+
+        # Shuffle queues and related information, keyed by the name of the
+        # batch they provide, that is "train_data" and "val_data". Each is a
+        # dict holding "queue", "enqueue_op", "dequeue_op", the "size" op,
+        # "capacity" and "min_after_dequeue".
+        self.queues = {}
+
+        self._tuned_step_num = 0
+        self._fill_fractions = []
+        self._max_fill_fractions = []
 
         # Keep two LinkedSystem to hold Jokers that may apply to training and
         # validation data.
@@ -231,6 +360,7 @@ class IntegratedSensor(ShuffleQueueSensor):
 
     def _setup_training_data(self):
         # TODO(Shuai): Handle the case where the source has no labels.
+        self.training_jokers.batch_mode = self.is_batch_read
         self.training_jokers.setup(self.source.training_datum)
         augmented_training_datum = self.training_jokers.data
         min_queue_examples = int(self.source.num_train *
@@ -249,8 +379,24 @@ class IntegratedSensor(ShuffleQueueSensor):
 
     def _setup_val_data(self):
         # TODO(Shuai): Handle the case where the source has no labels.
+        if self.val_cache_dir:
+            # Take the config before jokers are set up, when they only hold
+            # parameters.
+            val_cache_config = self._get_val_cache_config()
+        self.val_jokers.batch_mode = self.is_batch_read
         self.val_jokers.setup(self.source.val_datum)
         processed_val_datum = self.val_jokers.data
+
+        if self.exact_val:
+            batch_list = self._generate_ordered_image_and_label_batch(
+                self.val_batch_size,
+                processed_val_datum,
+                self.source.val_label,
+                "val_data")
+            if self.val_cache_dir:
+                self._setup_val_cache(val_cache_config, batch_list)
+            return batch_list[0], batch_list[1:]
+
         min_queue_examples = int(self.source.num_val *
                                  self.min_fraction_of_examples_in_queue)
 
@@ -265,6 +411,73 @@ class IntegratedSensor(ShuffleQueueSensor):
 
         return val_data, val_labels
 
+    def fill_exact_val_feed_dict(self, start, num):
+        if self.val_cache and self.val_cache.is_ready:
+            # Feed cached batches in place of those dequeued.
+            data, labels = self.val_cache.read(start, num)
+            feed_dict = {self.val_data: data}
+            feed_dict.update(zip(self.val_labels, labels))
+            return feed_dict
+
+        # Examples are in order in the queue, so only the number is needed.
+        return {self.val_batch_num: num}
+
+    @property
+    def val_cache_fetch(self):
+        if self.val_cache is None or not self.val_cache.is_enabled \
+           or self.val_cache.is_ready:
+            return []
+        return [self.val_data] + list(self.val_labels)
+
+    def cache_val_batch(self, start, values):
+        self.val_cache.write(start, values[0], values[1:])
+
+    def _get_val_cache_config(self):
+        """
+        Options that processed validation data depend on: the class and
+        parameters of the source, such as `work_dir`, `num_val` and options
+        of decoding, and those of each validation joker.
+        """
+        jokers = [self._get_block_config(j) for j in self.val_jokers.blocks]
+        return {"source": self._get_block_config(self.source),
+                "jokers": jokers}
+
+    def _get_block_config(self, block):
+        """
+        Return the class and public parameters of simple types of `block`.
+        """
+        paras = {}
+        for k, v in vars(block).items():
+            if not k.startswith("_") and \
+               type(v) in [bool, int, float, str, list, tuple, dict]:
+                paras[k] = v
+        return {"class": type(block).__name__, "paras": paras}
+
+    def _setup_val_cache(self, config, batch_list):
+        shapes = [t.get_shape()[1:] for t in batch_list]
+        for shape in shapes:
+            if not shape.is_fully_defined():
+                log.info("Shape {} of validation data is not fully defined."
+                         " Not cached.".format(shape))
+                return
+        self.val_cache = caches.MemmapValCache(
+            self.val_cache_dir,
+            config,
+            self.source.num_val,
+            shapes[0].as_list(),
+            batch_list[0].dtype.as_numpy_dtype,
+            [shape.as_list() for shape in shapes[1:]],
+            [t.dtype.as_numpy_dtype for t in batch_list[1:]],
+            dtype=self.val_cache_dtype,
+            max_bytes=self.val_cache_max_bytes)
+
+    @property
+    def is_batch_read(self):
+        """
+        Whether the source reads a batch of examples at a time.
+        """
+        return bool(self.source.read_batch_size)
+
     def attach(self, joker, to_val=False):
         """
         Attach a joker to a joker system. If `to_val` is True, attach to
@@ -291,9 +504,100 @@ class IntegratedSensor(ShuffleQueueSensor):
     def _raw_datum_summary(self, name, datum, collection):
         # Since image summary only takes image batches, we package each
         # image into a batch.
-        tf.summary.image(name,
-                         tf.expand_dims(datum, 0),
-                         collections=[collection])
+        if not self.is_batch_read:
+            datum = tf.expand_dims(datum, 0)
+        tf.summary.image(name, datum, collections=[collection])
+
+    def tune(self, sess, size, step_num=1):
+        """
+        Sample the fill fraction of the training queue, and add enqueue
+        threads if the queue drains. It is supposed to be called after each
+        run of training steps, and does nothing once `auto_tune_step_num`
+        steps have been tuned.
+
+        Args:
+            sess: tf.Session
+                The session the queue runners are running in.
+            size: int
+                The size of the training queue sampled in the run.
+            step_num: int
+                The number of training steps of the run.
+        """
+        if self._tuned_step_num >= self.auto_tune_step_num:
+            return
+
+        queue = self.queues["train_data"]
+        self._fill_fractions.append(self._get_fill_fraction(queue, size))
+        self._tuned_step_num += step_num
+
+        # An interval ends if its last step is among the steps run.
+        if self._tuned_step_num // self.auto_tune_interval != \
+           (self._tuned_step_num - step_num) // self.auto_tune_interval:
+            min_fill_fraction = min(self._fill_fractions)
+            self._max_fill_fractions.append(max(self._fill_fractions))
+            self._fill_fractions = []
+            log.info("Training queue fill fraction in the last {} steps:"
+                     " min {:.3f}, max {:.3f}.".format(
+                         self.auto_tune_interval,
+                         min_fill_fraction,
+                         self._max_fill_fractions[-1]))
+            # The first interval is skipped, since the queue is filling up
+            # from the minimal number of examples after dequeue.
+            if (self._tuned_step_num > self.auto_tune_interval and
+                    min_fill_fraction < self.min_fill_fraction):
+                self._add_enqueue_threads(sess, queue)
+
+        if self._tuned_step_num >= self.auto_tune_step_num:
+            self._report_tuning(queue)
+
+    def _add_enqueue_threads(self, sess, queue):
+        """
+        Double the number of threads that enqueue to `queue`, up to the number
+        of CPUs.
+        """
+        thread_num = min(self.num_preprocess_threads,
+                         multiprocessing.cpu_count()
+                         - self.num_preprocess_threads)
+        if thread_num <= 0:
+            log.info("Training queue drains, but enqueue threads have"
+                     " reached the number of CPUs.")
+            return
+
+        with sess.graph.as_default():
+            runner = tf.train.QueueRunner(queue["queue"],
+                                          [queue["enqueue_op"]] * thread_num)
+            # Added to the collection, the runner is started along with
+            # others in a new session, such as the one `Kid` rebuilds in
+            # recovery, so `num_preprocess_threads` threads keep running.
+            tf.train.add_queue_runner(runner)
+        runner.create_threads(sess, daemon=True, start=True)
+        self.num_preprocess_threads += thread_num
+        log.info("Training queue drains. Increased enqueue threads to"
+                 " {}.".format(self.num_preprocess_threads))
+
+    def _report_tuning(self, queue):
+        capacity = queue["min_after_dequeue"] \
+            + 2 * self.num_preprocess_threads * self.batch_size
+        log.info("Auto tuning finished. Chosen config: num_preprocess_threads"
+                 " = {}; capacity = {} (current capacity {}).".format(
+                     self.num_preprocess_threads,
+                     capacity,
+                     queue["capacity"]))
+        # If the queue has always been nearly full, producers outrun
+        # training, and fewer threads would do.
+        if self._max_fill_fractions and self.num_preprocess_threads > 1 \
+           and min(self._max_fill_fractions) > 1 - self.min_fill_fraction:
+            log.info("Training queue has been kept full. Consider reducing"
+                     " num_preprocess_threads to {}.".format(
+                         self.num_preprocess_threads // 2))
+
+    def _get_fill_fraction(self, queue, size):
+        """
+        Fraction of the part of `queue` above `min_after_dequeue` that is
+        filled when the queue holds `size` examples.
+        """
+        return max(0, size - queue["min_after_dequeue"]) \
+            / (queue["capacity"] - queue["min_after_dequeue"])
 
     def _generate_image_and_label_batch(
             self, batch_size, image, label, min_queue_examples, name):
@@ -302,6 +606,7 @@ class IntegratedSensor(ShuffleQueueSensor):
         Args:
             batch_size: An integer.
             image: 3-D Tensor of [IMAGE_SIZE, IMAGE_SIZE, 3] of type.float32.
+                Or 4-D Tensor holding a batch of them if `is_batch_read`.
             label: 1-D Tensor of type.int32 or a list of them.
             min_queue_examples: int32, minimum number of samples to retain
             in the queue that provides of batches of examples.
@@ -314,16 +619,100 @@ class IntegratedSensor(ShuffleQueueSensor):
         input_list = [image]
         input_list.extend(label) if type(label) is list \
             else input_list.append(label)
-        batch_list = tf.train.shuffle_batch(
-            input_list,
-            batch_size=batch_size,
-            num_threads=self.num_preprocess_threads,
-            capacity=min_queue_examples + 2 * self.num_preprocess_threads * batch_size,
-            min_after_dequeue=min_queue_examples,
-            name=name)
+        capacity = min_queue_examples \
+            + 2 * self.num_preprocess_threads * batch_size
+
+        # The same queue as the one built by `tf.train.shuffle_batch`. It is
+        # built by hand to keep hold of the queue and its enqueue op, so
+        # its size could be read, and threads could be added later.
+        with tf.name_scope(name):
+            if self.is_batch_read:
+                shapes = [t.get_shape()[1:] for t in input_list]
+            else:
+                shapes = [t.get_shape() for t in input_list]
+            queue = tf.RandomShuffleQueue(
+                capacity=capacity,
+                min_after_dequeue=min_queue_examples,
+                dtypes=[t.dtype for t in input_list],
+                shapes=shapes)
+            if self.is_batch_read:
+                enqueue_op = queue.enqueue_many(input_list)
+            else:
+                enqueue_op = queue.enqueue(input_list)
+            tf.train.add_queue_runner(tf.train.QueueRunner(
+                queue, [enqueue_op] * self.num_preprocess_threads))
+            size = queue.size()
+            self.queues[name] = {"queue": queue,
+                                 "enqueue_op": enqueue_op,
+                                 "size": size,
+                                 "capacity": capacity,
+                                 "min_after_dequeue": min_queue_examples}
+
+            fill_fraction = tf.cast(
+                tf.maximum(0, size - min_queue_examples),
+                tf.float32) * (1. / (capacity - min_queue_examples))
+            tf.summary.scalar(
+                "fraction_over_{}_of_{}_full".format(
+                    min_queue_examples, capacity - min_queue_examples),
+                fill_fraction,
+                collections=[VALID_SUMMARY_COLLECTION if name == "val_data"
+                             else TRAIN_SUMMARY_COLLECTION])
+            batch_list = list(queue.dequeue_many(batch_size, name=name))
+            self.queues[name]["dequeue_op"] = batch_list[0].op
+
+        return self._squeeze_batch_list(batch_list)
+
+    def _generate_ordered_image_and_label_batch(
+            self, batch_size, image, label, name):
+        """
+        Similar with `_generate_image_and_label_batch`, but examples are
+        batched in the order they are read, and the number of examples to
+        dequeue is a placeholder with default value `batch_size`, which is
+        saved as `val_batch_num`.
+        """
+        input_list = [image]
+        input_list.extend(label) if type(label) is list \
+            else input_list.append(label)
+        capacity = 3 * batch_size
 
+        with tf.name_scope(name):
+            if self.is_batch_read:
+                shapes = [t.get_shape()[1:] for t in input_list]
+            else:
+                shapes = [t.get_shape() for t in input_list]
+            queue = tf.FIFOQueue(capacity=capacity,
+                                 dtypes=[t.dtype for t in input_list],
+                                 shapes=shapes)
+            if self.is_batch_read:
+                enqueue_op = queue.enqueue_many(input_list)
+            else:
+                enqueue_op = queue.enqueue(input_list)
+            # Only one thread, so the order of examples is kept.
+            tf.train.add_queue_runner(tf.train.QueueRunner(queue,
+                                                           [enqueue_op]))
+            self.val_batch_num = tf.placeholder_with_default(
+                batch_size, [], name="batch_num")
+            batch_list = list(queue.dequeue_many(self.val_batch_num,
+                                                 name=name))
+            self.queues[name] = {"queue": queue,
+                                 "enqueue_op": enqueue_op,
+                                 "dequeue_op": batch_list[0].op,
+                                 "size": queue.size(),
+                                 "capacity": capacity,
+                                 "min_after_dequeue": 0}
+
+        return self._squeeze_batch_list(batch_list)
+
+    def _squeeze_batch_list(self, batch_list):
+        """
+        Remove dimensions of size 1 of tensors in `batch_list`, except the
+        batch dimension.
+        """
         for i, b in enumerate(batch_list):
-            batch_list[i] = tf.squeeze(b)
+            shape = b.get_shape().as_list()
+            squeeze_dims = [d for d in xrange(1, len(shape)) if shape[d] == 1]
+            if squeeze_dims:
+                batch_list[i] = tf.squeeze(b, squeeze_dims)
 
         return batch_list
 
@@ -331,17 +720,74 @@ class IntegratedSensor(ShuffleQueueSensor):
 class FeedSensor(Sensor):
     """
     Sense from a `FeedSource` to supply data to a `Kid`.
+
+    Optionally, training feed dicts could be prepared ahead of time by a pool
+    of background threads, so getting batches from the source, copying and
+    type conversion are overlapped with the training step running in
+    tensorflow. To use it, pass a positive `prefetch_num`, which is the
+    maximal number of ready-made feed dicts to keep in a queue. Statistics on
+    the prefetching queue are available through `prefetch_stats`, which are
+    useful to tell whether the input side is the bottleneck: if the training
+    thread often waits on an empty queue, it is.
+
+    Data placeholders are of `data_dtype`. Feeding float16 halves the bandwidth
+    needed to copy data to devices, which pairs well with a mixed precision
+    `Brain`. Sources better provide data in the dtype already, otherwise, the
+    conversion is done on the host when feeding.
     """
+    def __init__(self,
+                 prefetch_num=0,
+                 prefetch_thread_num=1,
+                 data_dtype="float32",
+                 **kwargs):
+        """
+        Args:
+            prefetch_num: int
+                The capacity of the queue holding prefetched training feed
+                dicts. If 0, no prefetching is done, and feed dicts are made
+                synchronously when asked.
+            prefetch_thread_num: int
+                The number of threads to make feed dicts.
+            data_dtype: str
+                "float32" or "float16". The dtype of data placeholders.
+        """
+        super(FeedSensor, self).__init__(**kwargs)
+        if data_dtype not in ["float32", "float16"]:
+            raise ValueError("Data dtype {} is not supported.".format(
+                data_dtype))
+        self.prefetch_num = prefetch_num
+        self.prefetch_thread_num = prefetch_thread_num
+        self.data_dtype = data_dtype
+
+        self._prefetch_threads = []
+        self._prefetch_error = None
+        # Lock to serialize access to the source, since sources keep states
+        # of where they are in an epoch, and are not thread safe.
+        self._source_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._reset_prefetch_stats()
+
     def _setup_training_data(self):
         return self._make_placeholder("train_data", self.batch_size)
 
     def _setup_val_data(self):
-        return self._make_placeholder("val_data", self.val_batch_size)
+        batch_size = None if self.exact_val else self.val_batch_size
+        return self._make_placeholder("val_data", batch_size)
+
+    def fill_exact_val_feed_dict(self, start, num):
+        # Slice validation samples in place, so no shuffling is involved.
+        data_set = self.source.get_all(train=False)
+        return {
+            self.val_data: data_set.images[start:start+num],
+            self.val_labels: data_set.labels[start:start+num],
+        }
 
     def _make_placeholder(self, name, batch_size):
         data_shape = self.source.shape
         data_shape.insert(0, batch_size)
-        data = tf.placeholder(tf.float32, shape=data_shape, name=name)
+        data = tf.placeholder(tf.as_dtype(self.data_dtype),
+                              shape=data_shape,
+                              name=name)
 
         if issubclass(type(self.source), sources.SupervisedSource):
             label_shape = self.source.label_shape
@@ -372,6 +818,9 @@ class FeedSensor(Sensor):
         Returns:
             feed_dict: The feed dictionary mapping from placeholders to values.
         """
+        if self.prefetch_num and not get_val:
+            return self._get_prefetched_feed_dict()
+
         # Create the feed_dict for the placeholders filled with the next
         # `batch size ` examples.
         batch_size = self.val_batch_size if get_val else self.batch_size
@@ -383,6 +832,149 @@ class FeedSensor(Sensor):
         }
         return feed_dict
 
+    @property
+    def prefetch_stats(self):
+        """
+        A dict of statistics on prefetching since prefetching started:
+
+            * `queue_depth`: the number of feed dicts ready in the queue.
+            * `producer_stall_num`, `producer_stall_time`: how many times and
+              how long in total producer threads waited on a full queue.
+            * `consumer_stall_num`, `consumer_stall_time`: how many times and
+              how long in total the training thread waited on an empty queue.
+        """
+        with self._stats_lock:
+            stats = dict(self._prefetch_stats)
+        stats["queue_depth"] = self._queue.qsize() \
+            if self._prefetch_threads else 0
+        return stats
+
+    def start_prefetching(self):
+        """
+        Start threads to prefetch training feed dicts. It is called
+        automatically the first time a training feed dict is asked.
+        """
+        if self._prefetch_threads:
+            return
+
+        self._queue = queue.Queue(maxsize=self.prefetch_num)
+        self._stop_event = threading.Event()
+        self._prefetch_error = None
+        self._reset_prefetch_stats()
+        log.info("Start {} threads to prefetch at most {} training"
+                 " batches.".format(self.prefetch_thread_num,
+                                    self.prefetch_num))
+        for i in xrange(0, self.prefetch_thread_num):
+            t = threading.Thread(target=self._prefetch,
+                                 name="{}_prefetch_{}".format(self.name, i))
+            t.daemon = True
+            t.start()
+            self._prefetch_threads.append(t)
+
+    def stop_prefetching(self):
+        """
+        Stop prefetching threads and drop any prefetched feed dicts.
+        """
+        if not self._prefetch_threads:
+            return
+
+        self._stop_event.set()
+        for t in self._prefetch_threads:
+            t.join()
+        self._prefetch_threads = []
+
+    def _reset_prefetch_stats(self):
+        self._prefetch_stats = {
+            "producer_stall_num": 0,
+            "producer_stall_time": 0.,
+            "consumer_stall_num": 0,
+            "consumer_stall_time": 0.,
+        }
+
+    def _make_train_feed_dict(self):
+        """
+        Make a training feed dict whose arrays are owned by the feed dict and
+        are of the dtype of placeholders, so nothing is left to do when it is
+        fed.
+        """
+        # Only take a batch inside the lock, so threads gather and convert
+        # examples in parallel. Numpy releases GIL when copying.
+        if isinstance(self.source, sources.InMemoryFeedSource) \
+           and self.source.shuffle_by_index:
+            # Batches are gathered into buffers reused across calls, so take
+            # indices instead, and gather into arrays of our own.
+            with self._source_lock:
+                data_set, index = self.source.get_batch_index(
+                    self.batch_size, False)
+            images = np.asarray(data_set.images.take(index, axis=0),
+                                dtype=self.data_dtype)
+            labels = np.asarray(data_set.labels.take(index, axis=0),
+                                dtype=np.int32)
+        else:
+            # Batches are slices of arrays that are replaced instead of
+            # modified in place when reshuffled, so they could be copied
+            # outside of the lock.
+            with self._source_lock:
+                images, labels = self.source.get_batch(self.batch_size,
+                                                       False)
+            images = np.array(images, dtype=self.data_dtype)
+            labels = np.array(labels, dtype=np.int32)
+
+        return {
+            self.data(): images,
+            self.labels(): labels,
+        }
+
+    def _prefetch(self):
+        try:
+            while not self._stop_event.is_set():
+                feed_dict = self._make_train_feed_dict()
+                try:
+                    self._queue.put_nowait(feed_dict)
+                    continue
+                except queue.Full:
+                    pass
+
+                start_time = time.time()
+                while not self._stop_event.is_set():
+                    try:
+                        self._queue.put(feed_dict, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                with self._stats_lock:
+                    self._prefetch_stats["producer_stall_num"] += 1
+                    self._prefetch_stats["producer_stall_time"] \
+                        += time.time() - start_time
+        except Exception as e:
+            log.error("Prefetching thread {} failed: {}".format(
+                threading.current_thread().name, e))
+            self._prefetch_error = e
+
+    def _get_prefetched_feed_dict(self):
+        self.start_prefetching()
+
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+        start_time = time.time()
+        while True:
+            if self._prefetch_error is not None:
+                raise self._prefetch_error
+            try:
+                feed_dict = self._queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        with self._stats_lock:
+            self._prefetch_stats["consumer_stall_num"] += 1
+            self._prefetch_stats["consumer_stall_time"] \
+                += time.time() - start_time
+
+        return feed_dict
+
 
 __all__ = [name for name, x in locals().items() if
            not inspect.ismodule(x) and not inspect.isabstract(x)]
@@ -40,11 +40,15 @@ import inspect
 import os
 import urllib
 import tarfile
+import json
+import time
+import multiprocessing
 
 import numpy as np
 import tensorflow as tf
 
 from .blocks import Block
+from ..utils import glog as log
 
 
 # Basic model parameters as external flags.
@@ -273,6 +277,18 @@ class InMemoryFeedSource(StaticSource, FeedSource):
 
     This class holds a private member `_data_sets` to hold all data.
     """
+    def __init__(self, shuffle_by_index=False, **kwargs):
+        """
+        Args:
+            shuffle_by_index: Boolean
+                If True, datasets loaded are reshuffled by permuting indices
+                instead of the data arrays, and batches are gathered into
+                reused buffers. It avoids copying the whole dataset at the end
+                of each epoch. Refer to `datasets.DataSet` for details.
+        """
+        super(InMemoryFeedSource, self).__init__(**kwargs)
+        self.shuffle_by_index = shuffle_by_index
+
     def _setup(self):
         """
         Call `_load` to load datasets into memory.
@@ -280,12 +296,28 @@ class InMemoryFeedSource(StaticSource, FeedSource):
         # Read the whole dateset into memory.
         self.data_sets = self._load()
 
+        if self.shuffle_by_index:
+            for d in [self.data_sets.training,
+                      self.data_sets.test,
+                      self.data_sets.validation]:
+                if d is not None:
+                    d.shuffle_by_index = True
+
     def get_batch(self, num, get_val):
         if get_val:
             return self.data_sets.test.next_batch(num)
         else:
             return self.data_sets.training.next_batch(num)
 
+    def get_batch_index(self, num, get_val):
+        """
+        Return the dataset to get `num` samples from and the indices of them
+        in the dataset, as `get_batch` would return. It is only supported if
+        `shuffle_by_index` is True.
+        """
+        data_set = self.get_all(train=not get_val)
+        return data_set, data_set.next_batch_index(num)
+
     def get_all(self, train):
         """
         Get all samples in the source.
@@ -315,6 +347,150 @@ class InMemoryFeedSource(StaticSource, FeedSource):
         sys.exit()
 
 
+class MemmapFeedSource(InMemoryFeedSource):
+    """
+    An abstract class that serves batches directly from memory mapped files
+    instead of holding the whole dataset in the memory of the process.
+
+    The first time it is set up, data loaded by `_load` are converted into a
+    flat layout in folder `memmap_dir` under `work_dir`: for each dataset in
+    the `DataSets` returned by `_load`, a raw file of images, a raw file of
+    labels, plus a JSON header holding their shapes and dtypes. Afterwards,
+    setting up only opens those files as `np.memmap`, so multiple training
+    processes on the same machine, such as those launched by
+    `akid.train.tuner.tune`, share the same page cache instead of each holding
+    a private copy, and datasets larger than RAM are usable.
+
+    Since the data are converted after `_load`, any pre-processing done in
+    `_load`, such as centering and scaling, is stored in the converted data. A
+    change in those options invalidates the converted data, which will be
+    converted again. Options are returned by `_get_config`, which
+    sub-classes whose `_load` depends on more options should extend.
+
+    Shuffling is always done by index permutation (see `datasets.DataSet`), so
+    the mapped data are never copied as a whole.
+
+    To use it, combine it with a concrete `InMemoryFeedSource` that implements
+    `_load`, for example::
+
+        class MNISTMemmapFeedSource(MemmapFeedSource, MNISTFeedSource):
+            pass
+    """
+    HEADER_FILENAME = "header.json"
+    SPLITS = ["training", "test", "validation"]
+
+    def __init__(self, memmap_dir="memmap", **kwargs):
+        """
+        Args:
+            memmap_dir: str
+                Name of the folder under `work_dir` to keep converted data.
+        """
+        kwargs["shuffle_by_index"] = True
+        super(MemmapFeedSource, self).__init__(**kwargs)
+        self.memmap_dir = os.path.join(self.work_dir, memmap_dir)
+
+    def _setup(self):
+        """
+        Convert data to memory mapped files if not done yet, then map them.
+        """
+        header = self._read_header()
+        if header is None or header["config"] != self._get_config():
+            log.info("Converting data to memory mapped files under"
+                     " {} ...".format(self.memmap_dir))
+            self._convert(self._load())
+            header = self._read_header()
+        log.info("Map data from {}.".format(self.memmap_dir))
+        self.data_sets = self._map(header)
+
+    def _get_config(self):
+        """
+        Options that the content of converted data depends on.
+        """
+        return {
+            "class": type(self).__name__,
+            "center": self.center,
+            "scale": self.scale,
+            "num_train": self.num_train,
+            "num_val": self.num_val,
+            "validation_rate": self.validation_rate,
+        }
+
+    def _read_header(self):
+        filepath = os.path.join(self.memmap_dir,
+                                MemmapFeedSource.HEADER_FILENAME)
+        if not os.path.exists(filepath):
+            return None
+        with open(filepath, "r") as f:
+            return json.load(f)
+
+    def _convert(self, data_sets):
+        """
+        Write datasets to raw files and their meta information to the header.
+
+        Files are written under temporary names then renamed, and the header
+        is written last, so a concurrent process would either see a complete
+        conversion or none.
+        """
+        if not os.path.exists(self.memmap_dir):
+            os.makedirs(self.memmap_dir)
+
+        header = {"config": self._get_config(), "splits": {}}
+        for split in MemmapFeedSource.SPLITS:
+            dataset = getattr(data_sets, split)
+            if dataset is None:
+                continue
+            meta = {}
+            for field, array in [("images", dataset.images),
+                                 ("labels", dataset.labels)]:
+                array = np.ascontiguousarray(array)
+                filename = "{}_{}.raw".format(split, field)
+                self._write_atomically(filename, array.tofile, "wb")
+                meta[field] = {"filename": filename,
+                               "shape": list(array.shape),
+                               "dtype": array.dtype.str}
+            header["splits"][split] = meta
+
+        self._write_atomically(
+            MemmapFeedSource.HEADER_FILENAME,
+            lambda f: json.dump(header, f, indent=2, sort_keys=True),
+            "w")
+
+    def _write_atomically(self, filename, write, mode):
+        filepath = os.path.join(self.memmap_dir, filename)
+        tmp_filepath = "{}.{}.tmp".format(filepath, os.getpid())
+        with open(tmp_filepath, mode) as f:
+            write(f)
+        os.rename(tmp_filepath, filepath)
+
+    def _map(self, header):
+        """
+        Map converted data to `datasets.DataSets`.
+        """
+        from ..datasets.datasets import DataSet, DataSets
+
+        datasets = {}
+        for split, meta in header["splits"].items():
+            arrays = []
+            for field in ["images", "labels"]:
+                shape = tuple(meta[field]["shape"])
+                dtype = np.dtype(str(meta[field]["dtype"]))
+                if shape[0] == 0:
+                    # Empty files cannot be mapped.
+                    arrays.append(np.empty(shape, dtype=dtype))
+                else:
+                    arrays.append(np.memmap(
+                        os.path.join(self.memmap_dir,
+                                     meta[field]["filename"]),
+                        dtype=dtype,
+                        mode="r",
+                        shape=shape))
+            datasets[split] = DataSet(arrays[0],
+                                      arrays[1],
+                                      shuffle_by_index=True)
+
+        return DataSets(**datasets)
+
+
 class TFSource(StaticSource):
     """
     An abstract class that uses Reader Op of tensorflow to supply data.
@@ -332,7 +508,17 @@ class TFSource(StaticSource):
 
     Note the optional properties of `Source`, is made abstract, consequently
     mandatory.
+
+    Parsing examples one at a time costs an op dispatch per example, which
+    dominates the input pipeline when examples are small. Sub-classes that are
+    able to read and parse a batch of serialized examples in one go set
+    `read_batch_size` to the maximal number of examples to read at a time. In
+    that case, `training_datum`, `val_datum` and the labels have an extra
+    leading dimension that holds a variable number of examples, and sensors
+    should enqueue them as many examples instead of one.
     """
+    read_batch_size = None
+
     @abc.abstractmethod
     def _setup(self):
         self._read()
@@ -377,19 +563,19 @@ class TFSource(StaticSource):
             value: list
                 A list that holds float values to store.
         """
-        return tf.train.Feature(float_list=tf.train.FloatList(value=value))
+        return _float_list_feature(value)
 
     def _int_feature(self, value):
         """
         See `_float_feature`.
         """
-        return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
+        return _int64_list_feature(value)
 
     def _bytes_feature(self, value):
         """
         See `_float_feature`.
         """
-        return tf.train.Feature(bytes_list=tf.train.BytesList(value=value))
+        return _bytes_list_feature(value)
 
 
 class ClassificationTFSource(TFSource, SupervisedSource):
@@ -398,7 +584,62 @@ class ClassificationTFSource(TFSource, SupervisedSource):
 
     It further makes concrete most of the abstract methods of its super
     classes.
+
+    Images and labels held in numpy arrays could be converted to tfrecords by
+    `_convert_to_tf`. The output is split into `shard_num` files, written in
+    parallel by `convert_process_num` processes. Each shard is written to a
+    temporary file and renamed when finished, so an interrupted conversion
+    resumes from the shards that have not been written.
+
+    Images are stored under key `image_raw` in one of the two formats:
+
+        * "float": a float list. It is the slowest and largest protobuf
+          encoding, roughly five bytes per float plus framing.
+        * "bytes": a single bytes string holding raw little endian float
+          values of `image_dtype`, decoded by `tf.decode_raw`. float16 halves
+          the size again at the cost of precision.
+
+    Sub-classes should use `_get_image_feature` and `_decode_image` to parse
+    images so both formats are handled, and `_parse_tfrecords` to read, so
+    batched reading is supported by passing `read_batch_size`.
     """
+    def __init__(self,
+                 shard_num=1,
+                 convert_process_num=None,
+                 image_format="float",
+                 image_dtype="float32",
+                 read_batch_size=None,
+                 **kwargs):
+        """
+        Args:
+            shard_num: int
+                The number of files tfrecords are split into when converting.
+            convert_process_num: int
+                The number of processes to use to convert. If None, use as
+                many processes as CPUs, but no more than `shard_num`.
+            image_format: str
+                "float" or "bytes". See the class docstring.
+            image_dtype: str
+                "float32" or "float16". The dtype to store images in when
+                `image_format` is "bytes".
+            read_batch_size: int
+                If not None, read and parse up to this number of records at a
+                time. See `TFSource`.
+        """
+        super(ClassificationTFSource, self).__init__(**kwargs)
+        self.shard_num = shard_num
+        self.convert_process_num = convert_process_num
+
+        if image_format not in ["float", "bytes"]:
+            raise ValueError("Image format {} is not supported.".format(
+                image_format))
+        if image_dtype not in ["float32", "float16"]:
+            raise ValueError("Image dtype {} is not supported.".format(
+                image_dtype))
+        self.image_format = image_format
+        self.image_dtype = image_dtype
+        self.read_batch_size = read_batch_size
+
     @property
     def training_datum(self):
         return self._training_datum
@@ -415,6 +656,35 @@ class ClassificationTFSource(TFSource, SupervisedSource):
     def val_label(self):
         return self._val_label
 
+    def _get_tfrecord_filenames(self, name):
+        """
+        Return the list of paths of tfrecord shards named by `name`. If there
+        is only one shard, the file is named `name.tfrecords`, otherwise,
+        `name-{shard No}-of-{shard num}.tfrecords`. If images are stored in
+        bytes, the format and dtype are appended to `name`, so tfrecords of
+        different formats could coexist.
+        """
+        if self.image_format != "float":
+            name = "{}_{}_{}".format(name, self.image_format, self.image_dtype)
+
+        if self.shard_num == 1:
+            return [os.path.join(self.work_dir, name + ".tfrecords")]
+
+        return [os.path.join(self.work_dir,
+                             "{}-{:05d}-of-{:05d}.tfrecords".format(
+                                 name, i, self.shard_num))
+                for i in xrange(0, self.shard_num)]
+
+    def _tfrecords_exist(self, name):
+        """
+        Whether all shards of tfrecords named by `name` have been written.
+        """
+        for f in self._get_tfrecord_filenames(name):
+            if not os.path.exists(f):
+                return False
+
+        return True
+
     def _convert_to_tf(self, images, labels, name):
         """
         Take a numpy array of images and corresponding labels and convert it to
@@ -426,30 +696,215 @@ class ClassificationTFSource(TFSource, SupervisedSource):
             labels: numpy array of shape [N] or list
                 corresponding labels
             name: a str
-                The output tfrecord file will be named `name.tfrecords`.
-        """
-        num_examples = labels.shape[0]
-        if images.shape[0] != num_examples:
-            raise ValueError("Images size %d does not match label size %d." %
-                             (images.shape[0], num_examples))
-        row = images.shape[1]
-        col = images.shape[2]
-        depth = images.shape[3]
-
-        filename = os.path.join(self.work_dir, name + '.tfrecords')
-        print('Writing', filename)
-        writer = tf.python_io.TFRecordWriter(filename)
-        for index in range(num_examples):
-            image_raw = np.reshape(images[index], -1).tolist()
-            example = tf.train.Example(features=tf.train.Features(
-                feature={
-                    'height': self._int_feature([row]),
-                    'width': self._int_feature([col]),
-                    'depth': self._int_feature([depth]),
-                    'label': self._int_feature([int(labels[index])]),
-                    'image_raw': self._float_feature(image_raw)}))
-            writer.write(example.SerializeToString())
-        writer.close()
+                The output tfrecord files will be named by `name`. See
+                `_get_tfrecord_filenames`.
+        """
+        self._write_tfrecords(images, {"label": labels}, name)
+
+    def _get_image_feature(self, shape):
+        """
+        Return the feature to parse images of `shape` stored under
+        `image_raw`.
+        """
+        if self.image_format == "float":
+            return tf.FixedLenFeature(shape, tf.float32)
+        else:
+            return tf.FixedLenFeature([], tf.string)
+
+    def _parse_tfrecords(self, filename_queue, features):
+        """
+        Read from tfrecord files in `filename_queue`, and parse by `features`.
+        If `read_batch_size` is set, up to that number of records are read and
+        parsed by one op, and each parsed tensor has an extra leading batch
+        dimension.
+
+        Returns:
+            A dict mapping feature keys to parsed tensors.
+        """
+        reader = tf.TFRecordReader()
+        if self.read_batch_size:
+            _, serialized_examples = reader.read_up_to(filename_queue,
+                                                       self.read_batch_size)
+            return tf.parse_example(serialized_examples, features=features)
+
+        _, serialized_example = reader.read(filename_queue)
+        return tf.parse_single_example(serialized_example, features=features)
+
+    def _decode_image(self, image_raw, shape):
+        """
+        Decode images parsed by the feature returned by `_get_image_feature`
+        to a float32 tensor of `shape`. If `read_batch_size` is set, the
+        tensor has an extra leading batch dimension.
+        """
+        if self.image_format == "float":
+            return image_raw
+
+        image = tf.decode_raw(image_raw,
+                              tf.as_dtype(self.image_dtype),
+                              little_endian=True)
+        if self.read_batch_size:
+            shape = [-1] + list(shape)
+        image = tf.reshape(image, shape)
+        if self.image_dtype != "float32":
+            image = tf.cast(image, tf.float32)
+
+        return image
+
+    def _write_tfrecords(self, images, int_features, name):
+        """
+        Convert images and integer features, such as labels, to tfrecords
+        shards in parallel. Shards already written are skipped. Images are
+        stored in `image_format` and `image_dtype`.
+
+        Args:
+            images: numpy array
+                images of shape of shape [N, H, w, C].
+            int_features: dict
+                A dict maps feature names to numpy arrays whose first dimension
+                is N. Each of them will be saved as int64 features.
+            name: a str
+                See `_get_tfrecord_filenames`.
+        """
+        num_examples = images.shape[0]
+        for k, v in int_features.items():
+            if v.shape[0] != num_examples:
+                raise ValueError("Images size %d does not match %s size %d." %
+                                 (num_examples, k, v.shape[0]))
+
+        filenames = self._get_tfrecord_filenames(name)
+        shards = []
+        end = 0
+        for i, filename in enumerate(filenames):
+            # Spread the remainder to the first shards.
+            start = end
+            end = start + num_examples // len(filenames)
+            if i < num_examples % len(filenames):
+                end += 1
+            if os.path.exists(filename):
+                log.info("Shard {} exists. Skip it.".format(filename))
+                continue
+            shards.append((filename,
+                           images[start:end],
+                           dict((k, v[start:end])
+                                for k, v in int_features.items()),
+                           self.image_format,
+                           self.image_dtype))
+        if not shards:
+            return
+
+        process_num = self.convert_process_num \
+            or min(multiprocessing.cpu_count(), len(shards))
+        log.info("Writing {} shards of {} with {} processes.".format(
+            len(shards), name, process_num))
+        start_time = time.time()
+        record_num = 0
+        pool = None
+        try:
+            if process_num == 1:
+                results = (_write_tfrecord_shard(s) for s in shards)
+            else:
+                pool = multiprocessing.Pool(process_num)
+                results = pool.imap_unordered(_write_tfrecord_shard, shards)
+            for filename, num, duration in results:
+                record_num += num
+                log.info("Wrote {} records to {} ({:.1f}"
+                         " records/sec).".format(num,
+                                                 filename,
+                                                 num / duration))
+            if pool is not None:
+                pool.close()
+                pool.join()
+        except BaseException:
+            # Stop workers, and remove partially written shards, so they are
+            # written again next time.
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            for s in shards:
+                tmp_filename = _get_tmp_filename(s[0])
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+            raise
+
+        duration = time.time() - start_time
+        log.info("Wrote {} records of {} in {:.1f} sec ({:.1f}"
+                 " records/sec).".format(record_num,
+                                         name,
+                                         duration,
+                                         record_num / duration))
+
+
+def _float_list_feature(value):
+    return tf.train.Feature(float_list=tf.train.FloatList(value=value))
+
+
+def _int64_list_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
+
+
+def _bytes_list_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=value))
+
+
+def _get_tmp_filename(filename):
+    """
+    Return the name a tfrecord shard is written to before it is complete.
+    """
+    return filename + ".tmp"
+
+
+def _write_tfrecord_shard(shard):
+    """
+    Write a shard of examples to a tfrecord file. It is a module level
+    function so it could be sent to worker processes. See
+    `ClassificationTFSource._write_tfrecords` for the meaning of the items in
+    `shard`.
+
+    Returns:
+        A tuple of the filename written, the number of records and the time
+        used.
+    """
+    filename, images, int_features, image_format, image_dtype = shard
+    start_time = time.time()
+    num_examples, row, col, depth = images.shape
+
+    # Do conversions on whole arrays instead of on each example.
+    if image_format == "bytes":
+        images = np.ascontiguousarray(
+            images, dtype=np.dtype(image_dtype).newbyteorder("<"))
+    elif image_format == "float":
+        images = np.reshape(images, [num_examples, -1])
+    else:
+        raise ValueError("Image format {} is not supported.".format(
+            image_format))
+    int_features = dict(
+        (k, np.reshape(v, [num_examples, -1]).astype(np.int64).tolist())
+        for k, v in int_features.items())
+    shape_features = {
+        'height': _int64_list_feature([row]),
+        'width': _int64_list_feature([col]),
+        'depth': _int64_list_feature([depth]),
+    }
+
+    tmp_filename = _get_tmp_filename(filename)
+    writer = tf.python_io.TFRecordWriter(tmp_filename)
+    for index in xrange(0, num_examples):
+        feature = dict(shape_features)
+        for k, v in int_features.items():
+            feature[k] = _int64_list_feature(v[index])
+        if image_format == "bytes":
+            feature['image_raw'] = _bytes_list_feature(
+                [images[index].tobytes()])
+        else:
+            feature['image_raw'] = _float_list_feature(
+                images[index].tolist())
+        example = tf.train.Example(
+            features=tf.train.Features(feature=feature))
+        writer.write(example.SerializeToString())
+    writer.close()
+    os.rename(tmp_filename, filename)
+
+    return filename, num_examples, time.time() - start_time
 
 
 # TODO:
@@ -14,6 +14,7 @@ import tensorflow as tf
 
 from ..core.sources import (
     InMemoryFeedSource,
+    MemmapFeedSource,
     SupervisedSource,
     ClassificationTFSource
 )
@@ -109,6 +110,17 @@ class Cifar10FeedSource(Cifar10Source, InMemoryFeedSource):
         return DataSets(training_dataset, test_dataset)
 
 
+class Cifar10MemmapFeedSource(MemmapFeedSource, Cifar10FeedSource):
+    """
+    A `Cifar10FeedSource` that serves data from memory mapped files. See
+    `MemmapFeedSource`.
+    """
+    def _get_config(self):
+        config = super(Cifar10MemmapFeedSource, self)._get_config()
+        config["use_zca"] = self.use_zca
+        return config
+
+
 class Cifar10TFSource(Cifar10Source, ClassificationTFSource):
     """
     A concrete `Source` for Cifar10 dataset.
@@ -126,15 +138,15 @@ class Cifar10TFSource(Cifar10Source, ClassificationTFSource):
         self._maybe_convert_to_tf()
 
         # Read and set up data tensors.
-        filename = os.path.join(self.work_dir, 'cifar10_training.tfrecords')
+        filenames = self._get_tfrecord_filenames('cifar10_training')
         with tf.name_scope('input'):
-            filename_queue = tf.train.string_input_producer([filename])
+            filename_queue = tf.train.string_input_producer(filenames)
         self._training_datum, self._training_label \
             = self._get_sample_tensors_from_tfrecords(filename_queue)
 
-        filename = os.path.join(self.work_dir, 'cifar10_test.tfrecords')
+        filenames = self._get_tfrecord_filenames('cifar10_test')
         with tf.name_scope('input'):
-            filename_queue = tf.train.string_input_producer([filename])
+            filename_queue = tf.train.string_input_producer(filenames)
         self._val_datum, self._val_label \
             = self._get_sample_tensors_from_tfrecords(filename_queue)
 
@@ -147,9 +159,7 @@ class Cifar10TFSource(Cifar10Source, ClassificationTFSource):
         pylearn2.
         """
         TRAINING_TF_FILENAME = "cifar10_training"
-        if not os.path.exists(
-                os.path.join(self.work_dir,
-                             TRAINING_TF_FILENAME + ".tfrecords")):
+        if not self._tfrecords_exist(TRAINING_TF_FILENAME):
             # Read the numpy data in and convert it to TFRecord.
             imgs = np.load(os.path.join(self.work_dir,
                                         "pylearn2_gcn_whitened",
@@ -166,8 +176,7 @@ class Cifar10TFSource(Cifar10Source, ClassificationTFSource):
             self._convert_to_tf(imgs, training_labels, TRAINING_TF_FILENAME)
 
         TEST_TF_FILENAME = "cifar10_test"
-        if not os.path.exists(
-                os.path.join(self.work_dir, TEST_TF_FILENAME + ".tfrecords")):
+        if not self._tfrecords_exist(TEST_TF_FILENAME):
             imgs = np.load(os.path.join(self.work_dir,
                                         "pylearn2_gcn_whitened",
                                         "test.npy"))
@@ -190,23 +199,23 @@ class Cifar10TFSource(Cifar10Source, ClassificationTFSource):
         Returns:
             (image, label): tuple of (rank-4 tf.float32 tensor and rank-1
                             tf.int32 tensor)
-                individual sample that may be later put into a batch.
+                individual sample that may be later put into a batch, or a
+                batch of them if `read_batch_size` is set.
         """
-        reader = tf.TFRecordReader()
-        _, serialized_example = reader.read(filename_queue)
-        features = tf.parse_single_example(
-            serialized_example,
+        features = self._parse_tfrecords(
+            filename_queue,
             # Defaults are not specified since both keys are required.
             features={
-                'image_raw': tf.FixedLenFeature(
-                    [Cifar10Source.IMAGE_SIZE, Cifar10Source.IMAGE_SIZE, 3],
-                    tf.float32),
+                'image_raw': self._get_image_feature(
+                    [Cifar10Source.IMAGE_SIZE, Cifar10Source.IMAGE_SIZE, 3]),
                 'label': tf.FixedLenFeature([], tf.int64),
             })
 
         # Convert label from a scalar uint8 tensor to an int32 scalar.
         label = tf.cast(features['label'], tf.int32)
-        image = features["image_raw"]
+        image = self._decode_image(
+            features["image_raw"],
+            [Cifar10Source.IMAGE_SIZE, Cifar10Source.IMAGE_SIZE, 3])
 
         return image, label
 
@@ -261,6 +270,10 @@ class Cifar10TFSource(Cifar10Source, ClassificationTFSource):
             label: an int32 Tensor with the label in the range 0..9.
             uint8image: a [height, width, depth] uint8 Tensor with the image
                 data
+
+            If `read_batch_size` is set, up to that number of examples are
+            read, and `key`, `label` and `uint8image` have an extra leading
+            batch dimension.
         """
 
         class CIFAR10Record(object):
@@ -283,6 +296,22 @@ class Cifar10TFSource(Cifar10Source, ClassificationTFSource):
         # header or footer in the CIFAR-10 format, so we leave header_bytes
         # and footer_bytes at their default of 0.
         reader = tf.FixedLengthRecordReader(record_bytes=record_bytes)
+        if self.read_batch_size:
+            # Read a batch of records, and decode them all at once. The
+            # processing is the same with the one below, except that there is
+            # an extra leading batch dimension.
+            result.key, value = reader.read_up_to(filename_queue,
+                                                  self.read_batch_size)
+            record_bytes = tf.decode_raw(value, tf.uint8)
+            result.label = tf.cast(
+                tf.slice(record_bytes, [0, 0], [-1, label_bytes]), tf.int32)
+            depth_major = tf.reshape(
+                tf.slice(record_bytes, [0, label_bytes], [-1, image_bytes]),
+                [-1, result.depth, result.height, result.width])
+            result.uint8image = tf.transpose(depth_major, [0, 2, 3, 1])
+
+            return result
+
         result.key, value = reader.read(filename_queue)
 
         # Convert from a string to a vector of uint8 that is record_bytes long.
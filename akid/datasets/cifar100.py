@@ -182,15 +182,15 @@ class Cifar100TFSource(ClassificationTFSource):
 
     def _read_from_tfrecord(self):
         # Read and set up data tensors.
-        filename = os.path.join(self.work_dir, 'cifar100_training.tfrecords')
+        filenames = self._get_tfrecord_filenames('cifar100_training')
         with tf.name_scope('input'):
-            filename_queue = tf.train.string_input_producer([filename])
+            filename_queue = tf.train.string_input_producer(filenames)
         self._training_datum, self._training_label \
             = self._get_sample_tensors_from_tfrecords(filename_queue)
 
-        filename = os.path.join(self.work_dir, 'cifar100_test.tfrecords')
+        filenames = self._get_tfrecord_filenames('cifar100_test')
         with tf.name_scope('input'):
-            filename_queue = tf.train.string_input_producer([filename])
+            filename_queue = tf.train.string_input_producer(filenames)
         self._val_datum, self._val_label \
             = self._get_sample_tensors_from_tfrecords(filename_queue)
 
@@ -203,9 +203,7 @@ class Cifar100TFSource(ClassificationTFSource):
         pylearn2.
         """
         TRAINING_TF_FILENAME = "cifar100_training"
-        if not os.path.exists(
-                os.path.join(self.work_dir,
-                             TRAINING_TF_FILENAME + ".tfrecords")):
+        if not self._tfrecords_exist(TRAINING_TF_FILENAME):
             # Read the numpy data in and convert it to TFRecord.
             imgs = np.load(os.path.join(self.work_dir,
                                         "pylearn2_gcn_whitened",
@@ -222,8 +220,7 @@ class Cifar100TFSource(ClassificationTFSource):
             self._convert_to_tf(imgs, training_labels, TRAINING_TF_FILENAME)
 
         TEST_TF_FILENAME = "cifar100_test"
-        if not os.path.exists(
-                os.path.join(self.work_dir, TEST_TF_FILENAME + ".tfrecords")):
+        if not self._tfrecords_exist(TEST_TF_FILENAME):
             imgs = np.load(os.path.join(self.work_dir,
                                         "pylearn2_gcn_whitened",
                                         "test.npy"))
@@ -246,23 +243,20 @@ class Cifar100TFSource(ClassificationTFSource):
         Returns:
             (image, label): tuple of (rank-4 tf.float32 tensor and rank-1
                             tf.int32 tensor)
-                individual sample that may be later put into a batch.
+                individual sample that may be later put into a batch, or a
+                batch of them if `read_batch_size` is set.
         """
-        reader = tf.TFRecordReader()
-        _, serialized_example = reader.read(filename_queue)
-        features = tf.parse_single_example(
-            serialized_example,
+        features = self._parse_tfrecords(
+            filename_queue,
             # Defaults are not specified since both keys are required.
             features={
-                'image_raw': tf.FixedLenFeature(
-                    [32, 32, 3],
-                    tf.float32),
+                'image_raw': self._get_image_feature([32, 32, 3]),
                 'label': tf.FixedLenFeature([], tf.int64),
             })
 
         # Convert label from a scalar uint8 tensor to an int32 scalar.
         label = tf.cast(features['label'], tf.int32)
-        image = features["image_raw"]
+        image = self._decode_image(features["image_raw"], [32, 32, 3])
 
         return image, label
 
@@ -346,8 +340,8 @@ class HCifar100TFSource(ClassificationTFSource):
     +------------------------------+------------------------------+
     """
     SAMPLE_NUM = 50000
-    TRAINING_TF_FILENAME = "hierarchical_cifar100_training.tfrecords"
-    TEST_TF_FILENAME = "hierarchical_cifar100_test.tfrecords"
+    TRAINING_TF_FILENAME = "hierarchical_cifar100_training"
+    TEST_TF_FILENAME = "hierarchical_cifar100_test"
 
     def __init__(self, **kwargs):
         super(HCifar100TFSource, self).__init__(**kwargs)
@@ -392,17 +386,17 @@ class HCifar100TFSource(ClassificationTFSource):
 
     def _read_from_tfrecord(self):
         # Read and set up data tensors.
-        filename = os.path.join(self.work_dir,
-                                HCifar100TFSource.TRAINING_TF_FILENAME)
+        filenames = self._get_tfrecord_filenames(
+            HCifar100TFSource.TRAINING_TF_FILENAME)
         with tf.name_scope('input'):
-            filename_queue = tf.train.string_input_producer([filename])
+            filename_queue = tf.train.string_input_producer(filenames)
         self._training_datum, self._training_label \
             = self._get_sample_tensors_from_tfrecords(filename_queue)
 
-        filename = os.path.join(self.work_dir,
-                                HCifar100TFSource.TEST_TF_FILENAME)
+        filenames = self._get_tfrecord_filenames(
+            HCifar100TFSource.TEST_TF_FILENAME)
         with tf.name_scope('input'):
-            filename_queue = tf.train.string_input_producer([filename])
+            filename_queue = tf.train.string_input_producer(filenames)
         self._val_datum, self._val_label \
             = self._get_sample_tensors_from_tfrecords(filename_queue)
 
@@ -414,10 +408,7 @@ class HCifar100TFSource(ClassificationTFSource):
         TODO: write the data pre-processing code so I won't need to rely on
         pylearn2.
         """
-        if not os.path.exists(
-                os.path.join(
-                    self.work_dir,
-                    HCifar100TFSource.TRAINING_TF_FILENAME)):
+        if not self._tfrecords_exist(HCifar100TFSource.TRAINING_TF_FILENAME):
             # Read the numpy data in and convert it to TFRecord.
             imgs = np.load(os.path.join(self.work_dir,
                                         "pylearn2_gcn_whitened",
@@ -437,10 +428,7 @@ class HCifar100TFSource(ClassificationTFSource):
                                 training_coarse_labels,
                                 HCifar100TFSource.TRAINING_TF_FILENAME)
 
-        if not os.path.exists(
-                os.path.join(
-                    self.work_dir,
-                    HCifar100TFSource.TEST_TF_FILENAME)):
+        if not self._tfrecords_exist(HCifar100TFSource.TEST_TF_FILENAME):
             imgs = np.load(os.path.join(self.work_dir,
                                         "pylearn2_gcn_whitened",
                                         "test.npy"))
@@ -482,30 +470,12 @@ class HCifar100TFSource(ClassificationTFSource):
 
         expanded_fine_labels = self._expand_fine_labels(fine_labels)
 
-        row = images.shape[1]
-        col = images.shape[2]
-        depth = images.shape[3]
-
-        filename = os.path.join(self.work_dir, name)
-        print('Writing', filename)
-        writer = tf.python_io.TFRecordWriter(filename)
-        for index in range(num_examples):
-            image_raw = np.reshape(images[index], -1).tolist()
-            expanded_fine_label = expanded_fine_labels[index].tolist()
-            example = tf.train.Example(features=tf.train.Features(
-                feature={
-                    'height': self._int_feature([row]),
-                    'width': self._int_feature([col]),
-                    'depth': self._int_feature([depth]),
-                    'coarse_label': self._int_feature(
-                        [int(coarse_labels[index])]),
-                    'expanded_fine_label': self._int_feature(
-                        expanded_fine_label),
-                    'fine_label': self._int_feature(
-                        [int(fine_labels[index])]),
-                    'image_raw': self._float_feature(image_raw)}))
-            writer.write(example.SerializeToString())
-        writer.close()
+        self._write_tfrecords(
+            images,
+            {'coarse_label': coarse_labels,
+             'expanded_fine_label': expanded_fine_labels,
+             'fine_label': fine_labels},
+            name)
 
     def _expand_fine_labels(self, labels):
         """
@@ -544,17 +514,14 @@ class HCifar100TFSource(ClassificationTFSource):
         Returns:
             A tuple of a tensor and a list. The tensor is the image, the list
             contains tensors of coarse label, fine label and expanded fine
-            labels respectively.
+            labels respectively. If `read_batch_size` is set, they hold a batch
+            of samples.
         """
-        reader = tf.TFRecordReader()
-        _, serialized_example = reader.read(filename_queue)
-        features = tf.parse_single_example(
-            serialized_example,
+        features = self._parse_tfrecords(
+            filename_queue,
             # Defaults are not specified since both keys are required.
             features={
-                'image_raw': tf.FixedLenFeature(
-                    [32, 32, 3],
-                    tf.float32),
+                'image_raw': self._get_image_feature([32, 32, 3]),
                 'coarse_label': tf.FixedLenFeature([], tf.int64),
                 'fine_label': tf.FixedLenFeature([], tf.int64),
                 'expanded_fine_label': tf.FixedLenFeature(
@@ -567,6 +534,6 @@ class HCifar100TFSource(ClassificationTFSource):
         fine_label = tf.cast(features['fine_label'], tf.int32)
         expanded_fine_label = tf.cast(
             features['expanded_fine_label'], tf.int32)
-        image = features["image_raw"]
+        image = self._decode_image(features["image_raw"], [32, 32, 3])
 
         return image, [coarse_label, fine_label, expanded_fine_label]
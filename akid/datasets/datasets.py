@@ -8,13 +8,34 @@ PIXEL_DEPTH = 255
 
 
 class DataSet(object):
+    """
+    An in memory dataset that supplies batches of images and labels.
 
+    By default, data are reshuffled at the end of each epoch by permuting the
+    whole `images` and `labels` arrays, and the samples that are not enough to
+    make up a full batch at the end of an epoch are dropped. If
+    `shuffle_by_index` is True, the arrays stay where they are; only an index
+    array is permuted every epoch, and batches are gathered from the arrays
+    into preallocated output buffers. The remaining samples of an epoch are
+    carried over to the first batch of the next epoch, so no sample is
+    dropped.
+    """
     def __init__(self,
                  images,
                  labels,
                  center=False,
                  scale=False,
-                 fake_data=False):
+                 fake_data=False,
+                 shuffle_by_index=False):
+        """
+        Args:
+            shuffle_by_index: Boolean
+                Use index permutation to shuffle data. Note that in this mode
+                the arrays returned by `next_batch` are buffers reused across
+                calls, so they are only valid till the next call of
+                `next_batch` with the same batch size. Copy them if you need
+                to keep them around.
+        """
         if fake_data:
             self._num_examples = 10000
         else:
@@ -33,6 +54,14 @@ class DataSet(object):
         self._epochs_completed = 0
         self._index_in_epoch = 0
 
+        self.shuffle_by_index = shuffle_by_index
+        # Index permutation of the current epoch, used when
+        # `shuffle_by_index` is True. The first epoch goes through data in its
+        # original order, as the default mode does.
+        self._perm = None
+        # Output buffers keyed by batch size.
+        self._batch_buffers = {}
+
     @property
     def images(self):
         return self._images
@@ -56,6 +85,8 @@ class DataSet(object):
             fake_label = 0
             return [fake_image for _ in xrange(batch_size)], [
                 fake_label for _ in xrange(batch_size)]
+        if self.shuffle_by_index:
+            return self._next_batch_by_index(batch_size)
         start = self._index_in_epoch
         self._index_in_epoch += batch_size
         if self._index_in_epoch > self._num_examples:
@@ -73,6 +104,69 @@ class DataSet(object):
         end = self._index_in_epoch
         return self._images[start:end], self._labels[start:end]
 
+    def _next_batch_by_index(self, batch_size):
+        """
+        Gather the next `batch_size` examples through the index permutation
+        into output buffers. If the current epoch does not have enough samples
+        left, the batch is completed with samples from the next epoch.
+        """
+        index = self.next_batch_index(batch_size)
+        images_buffer, labels_buffer = self._get_batch_buffers(batch_size)
+        # Indices are always valid, use `clip` mode so numpy writes to the
+        # output buffer directly instead of going through a temporary one,
+        # which is what the default `raise` mode does.
+        numpy.take(self._images, index, axis=0, out=images_buffer,
+                   mode="clip")
+        numpy.take(self._labels, index, axis=0, out=labels_buffer,
+                   mode="clip")
+
+        return images_buffer, labels_buffer
+
+    def next_batch_index(self, batch_size):
+        """
+        Return the indices in `images` and `labels` of the next `batch_size`
+        examples when `shuffle_by_index` is True, and move on as `next_batch`
+        does. The indices are owned by the caller, so examples could be
+        gathered by the caller, for instance, outside of a lock that
+        serializes the access to this dataset.
+        """
+        assert self.shuffle_by_index, \
+            "Batch indices are only available when shuffling by index."
+        if self._perm is None:
+            self._perm = numpy.arange(self._num_examples)
+
+        indices = []
+        filled = 0
+        while filled < batch_size:
+            if self._index_in_epoch == self._num_examples:
+                # Finished epoch
+                self._epochs_completed += 1
+                # Shuffle the indices
+                numpy.random.shuffle(self._perm)
+                self._index_in_epoch = 0
+            start = self._index_in_epoch
+            end = min(start + batch_size - filled, self._num_examples)
+            # Copy, since the permutation is shuffled in place.
+            indices.append(self._perm[start:end].copy())
+            filled += end - start
+            self._index_in_epoch = end
+
+        return numpy.concatenate(indices)
+
+    def _get_batch_buffers(self, batch_size):
+        """
+        Return the output buffers of images and labels for batches of size
+        `batch_size`. Buffers are allocated at the first request.
+        """
+        if batch_size not in self._batch_buffers:
+            self._batch_buffers[batch_size] = (
+                numpy.empty((batch_size,) + self._images.shape[1:],
+                            dtype=self._images.dtype),
+                numpy.empty((batch_size,) + self._labels.shape[1:],
+                            dtype=self._labels.dtype))
+
+        return self._batch_buffers[batch_size]
+
 
 class DataSets(object):
     """
@@ -12,6 +12,7 @@ import os
 import tensorflow as tf
 
 from akid import ClassificationTFSource
+from akid.utils import glog as log
 
 
 """Small library that points to a data set.
@@ -125,10 +126,52 @@ class ImagenetData(Dataset):
               'is 150 GB. Please ensure you have at least 500GB disk space.')
 
 
+# The number of serialized examples to buffer for each reader.
+_EXAMPLES_PER_READER = 256
+
+
 class ImagenetTFSource(ClassificationTFSource):
-    def __init__(self, has_super_label=True, **kwargs):
+    """
+    A source reads ImageNet from sharded TFRecord files.
+
+    One reader reads only one record at a time, so one reader feeds all
+    threads that decode and crop images. If `reader_num` is larger than one,
+    training shards are read by that many readers in parallel, interleaved
+    over shards. As `tf.train.shuffle_batch_join` does, each reader enqueues
+    to a shared shuffle queue by an enqueue op of its own, which is run by a
+    thread of its own. Serialized examples, instead of decoded images, are
+    queued, so decoding still fans out to enqueue threads of the sensor.
+
+    In distributed training, if `worker_num` is larger than one, training
+    shards are assigned to workers deterministically: sorted by name, the
+    shards of worker `worker_index` are every `worker_num`-th one starting
+    from the `worker_index`-th, so workers do not read overlapping data.
+    Validation shards are not assigned, since validation is done by the
+    chief.
+    """
+    def __init__(self,
+                 has_super_label=True,
+                 reader_num=1,
+                 worker_num=1,
+                 worker_index=0,
+                 **kwargs):
+        """
+        Args:
+            has_super_label: Boolean
+                Whether examples have super labels.
+            reader_num: int
+                The number of readers to read training shards in parallel.
+            worker_num: int
+                The number of workers to assign training shards to.
+            worker_index: int
+                The index of the worker this source reads for, usually the
+                task index of the worker.
+        """
         super(ImagenetTFSource, self).__init__(**kwargs)
         self.has_super_label = has_super_label
+        self.reader_num = reader_num
+        self.worker_num = worker_num
+        self.worker_index = worker_index
 
     def _setup(self):
         """
@@ -173,6 +216,7 @@ class ImagenetTFSource(ClassificationTFSource):
 
         # Create filename_queue
         if train:
+            data_files = self.get_worker_files(data_files)
             filename_queue = tf.train.string_input_producer(data_files,
                                                             shuffle=True,
                                                             capacity=16)
@@ -180,8 +224,12 @@ class ImagenetTFSource(ClassificationTFSource):
             filename_queue = tf.train.string_input_producer(data_files,
                                                             shuffle=False,
                                                             capacity=1)
-        reader = dataset.reader()
-        _, example_serialized = reader.read(filename_queue)
+        if train and self.reader_num > 1:
+            example_serialized = self._read_in_parallel(dataset,
+                                                        filename_queue)
+        else:
+            reader = dataset.reader()
+            _, example_serialized = reader.read(filename_queue)
         image_buffer, label, bbox, _ = self.parse_example_proto(
             example_serialized)
         if train:
@@ -196,6 +244,51 @@ class ImagenetTFSource(ClassificationTFSource):
 
         return out_tensor_list
 
+    def get_worker_files(self, data_files):
+        """
+        Return shards in `data_files` assigned to the worker of
+        `worker_index`.
+        """
+        if self.worker_num == 1:
+            return data_files
+
+        data_files = sorted(data_files)
+        if len(data_files) < self.worker_num:
+            raise ValueError("{} shards cannot be assigned to {}"
+                             " workers.".format(len(data_files),
+                                                self.worker_num))
+        worker_files = data_files[self.worker_index::self.worker_num]
+        log.info("Worker {} of {} reads {} of {} training shards.".format(
+            self.worker_index,
+            self.worker_num,
+            len(worker_files),
+            len(data_files)))
+        return worker_files
+
+    def _read_in_parallel(self, dataset, filename_queue):
+        """
+        Read serialized examples from `filename_queue` by `reader_num`
+        readers in parallel, and return a serialized example from the queue
+        they enqueue to.
+        """
+        # Serialized images are about 110KB each.
+        capacity = _EXAMPLES_PER_READER * self.reader_num
+        log.info("Read training shards by {} readers.".format(
+            self.reader_num))
+        with tf.name_scope("parallel_read"):
+            examples_queue = tf.RandomShuffleQueue(
+                capacity=capacity,
+                min_after_dequeue=capacity // 2,
+                dtypes=[tf.string])
+            enqueue_ops = []
+            for _ in range(self.reader_num):
+                reader = dataset.reader()
+                _, value = reader.read(filename_queue)
+                enqueue_ops.append(examples_queue.enqueue([value]))
+            tf.train.add_queue_runner(
+                tf.train.QueueRunner(examples_queue, enqueue_ops))
+            return examples_queue.dequeue()
+
     def decode_jpeg(self, image_buffer, scope=None):
         """Decode a JPEG string into one 3-D float image Tensor.
 
@@ -6,7 +6,11 @@ import zipfile
 import numpy as np
 
 from ..utils import glog as log
-from ..core.sources import InMemoryFeedSource, SupervisedSource
+from ..core.sources import (
+    InMemoryFeedSource,
+    MemmapFeedSource,
+    SupervisedSource
+)
 from .datasets import DataSet, DataSets
 
 
@@ -190,3 +194,11 @@ class RotatedMNISTFeedSource(InMemoryFeedSource, SupervisedSource):
                                scale=self.scale)
 
         return DataSets(training_dataset, test_dataset)
+
+
+class MNISTMemmapFeedSource(MemmapFeedSource, MNISTFeedSource):
+    """
+    A `MNISTFeedSource` that serves data from memory mapped files. See
+    `MemmapFeedSource`.
+    """
+    pass
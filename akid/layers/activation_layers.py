@@ -284,6 +284,13 @@ class BatchNormalizationLayer(ProcessingLayer):
         self.use_reference_bn = use_reference_bn
 
     def _setup(self, input):
+        if input.dtype.base_dtype == tf.float16:
+            # Statistics are computed in float32, since they overflow easily
+            # in float16.
+            self._setup(tf.cast(input, tf.float32))
+            self._data = tf.cast(self._data, tf.float16)
+            return
+
         if self.use_reference_bn:
             log.info("Using reference BN. `beta_init` is fixed to 0;"
                      " `gamma_init` to 1.")
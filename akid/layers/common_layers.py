@@ -22,11 +22,20 @@ class ReshapeLayer(ProcessingLayer):
         self.intrinsic_shape = shape
 
     def _setup(self, input):
-        batch_size = input.get_shape().as_list()[0]
+        input_shape = input.get_shape().as_list()
+        batch_size = input_shape[0]
         if self.intrinsic_shape:
             shape = list(self.intrinsic_shape)
         else:
             shape = [-1]
+        # The batch size is unknown for batches of varying sizes, in which
+        # case it is inferred, and the flattened dimension is computed.
+        if batch_size is None:
+            batch_size = -1
+            if not self.intrinsic_shape:
+                shape = [1]
+                for d in input_shape[1:]:
+                    shape[0] *= d
         shape.insert(0, batch_size)
         self._data = tf.reshape(input, shape)
 
@@ -54,6 +63,10 @@ class PaddingLayer(ProcessingLayer, Joker):
         super(PaddingLayer, self).__init__(**kwargs)
         self.padding = padding
 
+    def _support_batch(self, data_in):
+        # A full length padding of three elements is meant for one example.
+        return len(self.padding) != 3
+
     def _setup(self, input):
         shape = input.get_shape().as_list()
         assert len(shape) is 4 or 3,\
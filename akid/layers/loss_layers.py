@@ -13,18 +13,28 @@ class LossLayer(ProcessingLayer):
     """
     An abstract top level loss layer.
 
-    It is nothing here now. However, it has already been used to check whether
-    a layer is a loss layer or not.
+    It has already been used to check whether a layer is a loss layer or
+    not. Losses are computed in float32, so float16 inputs are cast to
+    float32 before passed to `_loss_layer_setup`.
     """
     def __init__(self, multiplier=1, **kwargs):
         super(LossLayer, self).__init__(**kwargs)
         self.multiplier = multiplier
 
-    def _setup(self, *args, **kwargs):
-        self._loss_layer_setup(*args, **kwargs)
+    def _setup(self, data_in, *args, **kwargs):
+        if type(data_in) is list:
+            data_in = [self._cast_to_float32(d) for d in data_in]
+        else:
+            data_in = self._cast_to_float32(data_in)
+        self._loss_layer_setup(data_in, *args, **kwargs)
         log.info("Using multiplier {}".format(self.multiplier))
         self._loss = self._loss * self.multiplier
 
+    def _cast_to_float32(self, data):
+        if data.dtype.base_dtype == tf.float16:
+            return tf.cast(data, tf.float32)
+        return data
+
     @abc.abstractmethod
     def _loss_layer_setup(self):
         raise Exception("Every loss layer should implement this for setup.")
@@ -35,6 +35,16 @@ class SynapseLayer(ProcessingLayer):
         * uniform
               Customizable parameters: range; A uniform initializer with range
               1 will have uniform distribution U(-1, 1).
+
+    Variables are always kept in float32. If the input is in float16, which
+    is the case in a mixed precision `Brain`, float16 copies of variables are
+    used to compute, and gradients flow back to the float32 master variables.
+
+    Weights could be partitioned into shards along the output channel
+    dimension by `partition`, so a large weight matrix is spread over
+    parameter servers instead of landing on one of them. Each shard holds
+    whole filters, thus max norm constrains and statistics on norms apply to
+    shards as they do to the whole weights.
     """
     def __init__(self,
                  out_channel_num,
@@ -43,6 +53,7 @@ class SynapseLayer(ProcessingLayer):
                  wd={"type": "l2", "scale": 5e-4},
                  max_norm=None,
                  do_stat_on_norm=False,
+                 partition=None,
                  **kwargs):
         """
         Args:
@@ -69,6 +80,17 @@ class SynapseLayer(ProcessingLayer):
                 `AUXILIARY_SUMMARY_COLLECTION`, which could be used further. It
                 is mainly used for quantitatively evaluate how many filters are
                 dead during training.
+            partition: dict
+                An dictionary that contains the name of the policy to
+                partition weights and its parameters. Supported policies are:
+
+                    {"name": "fixed", "shard_num": 4}
+                    {"name": "max_bytes", "max_shard_bytes": 64 << 20}
+
+                "fixed" partitions weights into `shard_num` shards, and
+                "max_bytes" into as few shards as possible, each of which is
+                no larger than `max_shard_bytes`. If None, weights are not
+                partitioned. Biases are never partitioned.
         """
         super(SynapseLayer, self).__init__(**kwargs)
         self.out_channel_num = out_channel_num
@@ -76,6 +98,7 @@ class SynapseLayer(ProcessingLayer):
         self.wd = wd
         self.max_norm = max_norm
         self.do_stat_on_norm = do_stat_on_norm
+        self.partition = partition
 
         # Only do float conversion if not None.
         self.initial_bias_value = float(initial_bias_value) \
@@ -104,8 +127,9 @@ class SynapseLayer(ProcessingLayer):
                                   " parameters!")
         sys.exit()
 
-    def _pre_setup(self, *args, **kwargs):
-        super(SynapseLayer, self)._pre_setup(*args, **kwargs)
+    def _pre_setup(self, input, *args, **kwargs):
+        super(SynapseLayer, self)._pre_setup(input, *args, **kwargs)
+        self.compute_dtype = input.dtype.base_dtype
 
         if not self.initial_bias_value:
             log.info("Bias is disabled.")
@@ -158,7 +182,12 @@ class SynapseLayer(ProcessingLayer):
             (Variable Tensor, Weight Decay Loss) If `self.wd` is `None`, then
             the returned weight decay loss would be `None`.
         """
-        var = self._get_variable(name, shape, self._get_initializer())
+        partitioner = self._get_partitioner(shape) if len(shape) > 1 \
+            else None
+        var = super(SynapseLayer, self)._get_variable(name,
+                                                      shape,
+                                                      self._get_initializer(),
+                                                      partitioner=partitioner)
         if len(shape) > 1:
             # Add non-bias filters to the collection.
             tf.add_to_collection(FILTER_WEIGHT_COLLECTION, var)
@@ -187,7 +216,59 @@ class SynapseLayer(ProcessingLayer):
                           " typos.".format(e.message))
                 sys.exit(1)
 
-        return var, weight_decay
+        return self._cast_to_compute_dtype(var), weight_decay
+
+    def _get_variable(self,
+                      name,
+                      shape,
+                      initializer,
+                      trainable=True,
+                      partitioner=None):
+        var = super(SynapseLayer, self)._get_variable(name,
+                                                      shape,
+                                                      initializer,
+                                                      trainable,
+                                                      partitioner)
+        return self._cast_to_compute_dtype(var)
+
+    def _get_partitioner(self, shape):
+        """
+        Return the partitioner of variables of `shape` according to
+        `partition`, which slices along the output channel dimension, or None
+        if variables are not partitioned.
+        """
+        if not self.partition:
+            return None
+
+        axis = len(shape) - 1
+        try:
+            name = self.partition["name"]
+            if name == "fixed":
+                # No more shards than output channels.
+                shard_num = min(self.partition["shard_num"], shape[axis])
+                log.info("Weights of {} are partitioned into {}"
+                         " shards.".format(self.name, shard_num))
+                return tf.fixed_size_partitioner(shard_num, axis=axis)
+            elif name == "max_bytes":
+                max_shard_bytes = self.partition["max_shard_bytes"]
+                log.info("Weights of {} are partitioned into shards of at"
+                         " most {} bytes.".format(self.name,
+                                                  max_shard_bytes))
+                return tf.variable_axis_size_partitioner(max_shard_bytes,
+                                                         axis=axis)
+            else:
+                raise ValueError("Partition policy {} is not"
+                                 " supported.".format(name))
+        except KeyError as e:
+            log.error("`{}` not found in the provided partition parameters,"
+                      " `partition`. Perhaps you have some"
+                      " typos.".format(e.message))
+            raise e
+
+    def _cast_to_compute_dtype(self, var):
+        if var.dtype.base_dtype != self.compute_dtype:
+            return tf.cast(var, self.compute_dtype)
+        return var
 
     def _get_default_initializer(self):
         # By default, we use the most preliminary initialization (for
@@ -320,7 +401,9 @@ class InnerProductLayer(SynapseLayer):
             in_channel_num = 1
             for i in input_shape[1:]:
                 in_channel_num *= i
-            flattened = tf.reshape(input, [input_shape[0], in_channel_num])
+            # The batch size is left to be inferred, since it is unknown
+            # for batches of varying sizes.
+            flattened = tf.reshape(input, [-1, in_channel_num])
             reshaped_input = flattened
 
         self.shape = [in_channel_num, self.out_channel_num]
@@ -359,7 +442,6 @@ class InvariantInnerProductLayer(SynapseLayer):
     def _preprocess(self, input):
         # Gather some info.
         input_shape = input.get_shape().as_list()
-        batch_size = input_shape[0]
         fmap_h = input_shape[1]
         fmap_w = input_shape[2]
         in_channel_num = input_shape[3]
@@ -369,7 +451,7 @@ class InvariantInnerProductLayer(SynapseLayer):
                                        [1, fmap_h, fmap_w, 1],
                                        "VALID")
         # Reshape input to remove the one dim axes.
-        object_vector = tf.reshape(object_vector, [batch_size, in_channel_num])
+        object_vector = tf.reshape(object_vector, [-1, in_channel_num])
         return object_vector
 
     def _para_init(self, input):
@@ -20,7 +20,14 @@ class AlexNet(Brain):
     """
     A class for alex net specifically.
     """
-    def __init__(self, **kwargs):
+    def __init__(self, ip_partition=None, **kwargs):
+        """
+        Args:
+            ip_partition: dict
+                The policy to partition weights of hidden inner product
+                layers over parameter servers. See `partition` of
+                `SynapseLayer`.
+        """
         super(AlexNet, self).__init__(**kwargs)
 
         self.attach(ConvolutionLayer([5, 5],
@@ -61,6 +68,7 @@ class AlexNet(Brain):
                                           "stddev": 0.04},
                                       wd={"type": "l2", "scale": 0.004},
                                       out_channel_num=384,
+                                      partition=ip_partition,
                                       name='ip1'))
         self.attach(ReLULayer(name='relu3'))
 
@@ -70,6 +78,7 @@ class AlexNet(Brain):
                                           "stddev": 0.04},
                                       wd={"type": "l2", "scale": 0.004},
                                       out_channel_num=192,
+                                      partition=ip_partition,
                                       name='ip2'))
         self.attach(InnerProductLayer(initial_bias_value=0,
                                       init_para={
@@ -219,6 +228,7 @@ class VGGNet(Brain):
                  class_num=10,
                  padding="SAME",
                  loss_layer=None,
+                 ip_partition=None,
                  **kwargs):
         """
         Args:
@@ -227,6 +237,10 @@ class VGGNet(Brain):
                 the class of the loss layer, and the second is extra parameters
                 of this layer, besides `name`. If None, a softmax cross_entropy
                 loss will be used.
+            ip_partition: dict
+                The policy to partition weights of the hidden inner product
+                layer over parameter servers. See `partition` of
+                `SynapseLayer`.
         """
         super(VGGNet, self).__init__(**kwargs)
         self.padding = padding
@@ -284,6 +298,7 @@ class VGGNet(Brain):
                                       init_para={
                                           "name": "truncated_normal",
                                           "stddev": 1e-4},
+                                      partition=ip_partition,
                                       name="ip1"))
         self.attach(
             BatchNormalizationLayer(name="bn{}".format(self.top_layer_No)))
@@ -116,5 +116,48 @@ class TestBrain(AKidTestCase):
             print(W_norm)
             assert W_norm <= 1
 
+    def test_mixed_precision(self):
+        from akid.models.brains import OneLayerBrain
+        brain = OneLayerBrain(mixed_precision=True, name="test_brain")
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, data_dtype="float16", name='data'),
+            brain,
+            MomentumKongFu(),
+            max_steps=900)
+        kid.setup()
+
+        # Master variables are in float32, while computation is in float16.
+        for v in brain.get_filters():
+            assert v.dtype.base_dtype == tf.float32
+        report = dict((r["name"], r) for r in brain.memory_report)
+        assert report["conv1"]["dtype"] == "float16"
+        assert report["conv1"]["para_bytes"] == (5 * 5 * 32 + 32) * 4
+        assert report["conv1"]["activation_bytes"] == 28 * 28 * 32 * 2
+        assert brain.loss.dtype.base_dtype == tf.float32
+
+        # Float16 computation should be close to that in float32.
+        kid.init()
+        feed_dict = kid.sensor.fill_feed_dict()
+        data, logits = kid.sess.run(
+            [kid.sensor.data(), brain.get_layer_by_name("ip1").data],
+            feed_dict=feed_dict)
+        conv1 = brain.get_layer_by_name("conv1")
+        ip1 = brain.get_layer_by_name("ip1")
+        with kid.graph.as_default():
+            x = tf.nn.conv2d(tf.cast(data, tf.float32),
+                             conv1.var_list[0],
+                             conv1.strides,
+                             conv1.padding) + conv1.var_list[1]
+            x = tf.nn.max_pool(tf.nn.relu(x),
+                               [1, 5, 5, 1],
+                               [1, 5, 5, 1],
+                               "SAME")
+            x = tf.matmul(tf.reshape(x, [data.shape[0], -1]),
+                          ip1.var_list[0]) + ip1.var_list[1]
+        logits_fp32 = kid.sess.run(x)
+        assert abs(logits - logits_fp32).max() < 1e-2
+
+
 if __name__ == "__main__":
     main()
@@ -1,3 +1,8 @@
+import socket
+import threading
+
+import tensorflow as tf
+
 from akid import (
     Kid,
     FeedSensor,
@@ -8,6 +13,7 @@ from akid import (
 from akid.models import LeNet
 
 from akid.utils.test import AKidTestCase, TestFactory, main
+from akid.utils import glog as log
 
 
 class TestEngine(AKidTestCase):
@@ -31,6 +37,219 @@ class TestEngine(AKidTestCase):
         loss = kid.practice()
         assert loss < 3
 
+    def test_bucketed_data_parallel(self):
+        brain = LeNet(name="LeNet")
+        source = MNISTFeedSource(name="MNIST",
+                                 url='http://yann.lecun.com/exdb/mnist/',
+                                 work_dir=AKID_DATA_PATH + '/mnist',
+                                 center=True,
+                                 scale=True,
+                                 num_train=50000,
+                                 num_val=10000)
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            brain,
+            MomentumKongFu(name="opt"),
+            engine={"name": "data_parallel",
+                    "num_gpu": 2,
+                    "bucket_size": 2**20},
+            max_steps=1000,
+            trace_step=100)
+        kid.setup()
+
+        # Large weights take buckets alone, and small ones share.
+        grads = kid.kongfu.data
+        buckets = kid.engine._get_buckets(grads)
+        assert len(buckets) < len([g for g, v in grads if g is not None])
+
+        loss = kid.practice()
+        assert loss < 3
+        assert kid.timing_stats["reduction_time"] is not None
+
+    def test_cpu_towers(self):
+        """
+        Benchmark training throughput with 1, 2 and 4 CPU towers.
+        """
+        from akid import IntegratedSensor, CropJoker, WhitenJoker
+        from akid.models import CifarResNet
+
+        throughputs = {}
+        for tower_num in [1, 2, 4]:
+            source = TestFactory.get_test_tf_source()
+            sensor = IntegratedSensor(source_in=source,
+                                      batch_size=128,
+                                      val_batch_size=100,
+                                      name='data')
+            sensor.attach(CropJoker(height=24, width=24,
+                                    center=True, name="crop"),
+                          to_val=True)
+            sensor.attach(WhitenJoker(name="per_image_whitening"),
+                          to_val=True)
+            sensor.attach(CropJoker(height=24, width=24, name="crop"))
+            sensor.attach(WhitenJoker(name="per_image_whitening"))
+            brain = CifarResNet(depth=10, width=1, name="ResNet")
+            kid = Kid(
+                sensor,
+                brain,
+                MomentumKongFu(name="opt"),
+                engine={"name": "data_parallel",
+                        "devices": ["/cpu:{}".format(i)
+                                    for i in xrange(tower_num)]},
+                max_steps=60,
+                val_log_step=1000)
+            times = []
+            kid.hooks.on_batch_end.append(
+                lambda kid: times.append(kid.forward_backward_time))
+            kid.setup()
+            kid.practice()
+
+            assert kid.engine.cpu_device_num == tower_num
+            # Leave out warming up steps.
+            throughputs[tower_num] = 128 / (sum(times[10:]) / len(times[10:]))
+
+        log.info("Examples per sec with 1, 2, 4 CPU towers: {:.1f}, {:.1f},"
+                 " {:.1f}".format(throughputs[1],
+                                  throughputs[2],
+                                  throughputs[4]))
+
+    def test_uneven_split(self):
+        brain = LeNet(name="LeNet")
+        source = TestFactory.get_test_feed_source()
+        # The batch size is not divisible by the number of towers.
+        kid = Kid(
+            FeedSensor(source_in=source, batch_size=99, name='data'),
+            brain,
+            MomentumKongFu(name="opt"),
+            engine={"name": "data_parallel",
+                    "devices": ["/cpu:0", "/cpu:1"],
+                    "tower_weights": [2, 1]},
+            max_steps=1000)
+        kid.setup()
+
+        assert kid.engine._train_fractions == [66 / 99., 33 / 99.]
+        loss = kid.practice()
+        assert loss < 3
+
+    def test_adapt_tower_weights(self):
+        brain = LeNet(name="LeNet")
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            brain,
+            MomentumKongFu(name="opt"),
+            engine={"name": "data_parallel",
+                    "devices": ["/cpu:0", "/cpu:1"],
+                    "adapt_tower_weights": True},
+            max_steps=1000,
+            trace_step=100)
+        kid.setup()
+
+        loss = kid.practice()
+        assert loss < 3
+        weights = kid.sess.run(kid.engine.tower_weights_var)
+        self.assertAlmostEqual(sum(weights), 1, places=5)
+        for w, v in zip(kid.engine.tower_weights, weights):
+            self.assertAlmostEqual(w, v, places=5)
+
+    def test_adapt_tower_weights_to_trace(self):
+        kid = Kid(
+            FeedSensor(source_in=TestFactory.get_test_feed_source(),
+                       name='data'),
+            LeNet(name="LeNet"),
+            MomentumKongFu(name="opt"),
+            engine={"name": "data_parallel",
+                    "devices": ["/cpu:0", "/cpu:1"],
+                    "adapt_tower_weights": True},
+            max_steps=1000)
+        kid.setup()
+        engine = kid.engine
+
+        # Towers run on the same device here, so they are told apart by name
+        # scopes. Ops out of towers are not counted.
+        run_metadata = tf.RunMetadata()
+        dev_stats = run_metadata.step_stats.dev_stats.add(
+            device="/job:localhost/replica:0/task:0/cpu:0")
+        for name, micros in [
+                (engine._tower_scopes[0] + "/conv1/Conv2D", 1000),
+                ("gradients/" + engine._tower_scopes[0] + "/conv1/grad", 1000),
+                (engine._tower_scopes[1] + "/conv1/Conv2D", 10**9),
+                ("gradient_average/AddN", 10**9),
+                ("opt/update/ApplyMomentum", 10**9)]:
+            dev_stats.node_stats.add(node_name=name,
+                                     all_end_rel_micros=micros)
+        times = engine._get_tower_times(run_metadata)
+        self.assertAlmostEqual(times[0], 0.002)
+        self.assertAlmostEqual(times[1], 1000)
+
+        # The slow tower still gets at least one example.
+        for _ in xrange(20):
+            engine.adapt_to_trace(kid.sess, run_metadata)
+        batch_size = kid.sensor.batch_size
+        self.assertAlmostEqual(sum(engine.tower_weights), 1, places=5)
+        assert round(batch_size * engine.tower_weights[1]) >= 1
+
+    def _run_cluster(self, sync_replicas):
+        """
+        Train a kid on each of two workers of an in-process localhost
+        cluster, and return the loss of the chief.
+        """
+        ports = []
+        sockets = []
+        for i in xrange(3):
+            sock = socket.socket()
+            sock.bind(("localhost", 0))
+            ports.append(sock.getsockname()[1])
+            sockets.append(sock)
+        for sock in sockets:
+            sock.close()
+        cluster = {"ps": ["localhost:{}".format(ports[0])],
+                   "worker": ["localhost:{}".format(p) for p in ports[1:]]}
+        ps_server = tf.train.Server(tf.train.ClusterSpec(cluster),
+                                    job_name="ps",
+                                    task_index=0)
+
+        kids = []
+        for task_index in xrange(2):
+            kid = Kid(
+                FeedSensor(source_in=TestFactory.get_test_feed_source(),
+                           name='data'),
+                TestFactory.get_test_brain(),
+                MomentumKongFu(name="opt"),
+                engine={"name": "distributed",
+                        "cluster": cluster,
+                        "task_index": task_index,
+                        "sync_replicas": sync_replicas},
+                log_dir="log_distributed/worker_{}".format(task_index),
+                max_steps=900)
+            kid.setup()
+            kids.append(kid)
+
+        losses = {}
+
+        def practice(i):
+            losses[i] = kids[i].practice()
+
+        threads = [threading.Thread(target=practice, args=(i,))
+                   for i in xrange(2)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join(600)
+
+        assert kids[0].engine.is_chief and not kids[1].engine.is_chief
+        assert 0 in losses, "The chief does not finish training."
+        del ps_server
+        return losses[0]
+
+    def test_distributed(self):
+        loss = self._run_cluster(sync_replicas=False)
+        assert loss < 0.5
+
+    def test_distributed_sync_replicas(self):
+        loss = self._run_cluster(sync_replicas=True)
+        assert loss < 0.5
+
 
 if __name__ == "__main__":
     main()
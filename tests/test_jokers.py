@@ -1,3 +1,6 @@
+import numpy as np
+import tensorflow as tf
+
 from akid.utils.test import AKidTestCase, TestFactory, main
 from akid import (
     IntegratedSensor,
@@ -5,6 +8,12 @@ from akid import (
     Kid,
     GradientDescentKongFu
 )
+from akid.core.jokers import (
+    CropJoker,
+    FlipJoker,
+    WhitenJoker,
+    ResizeJoker
+)
 from akid.models.brains import AlexNet
 from akid import LearningRateScheme
 
@@ -41,6 +50,56 @@ class TestJoker(AKidTestCase):
         loss = kid.practice()
         assert loss < 3
 
+    def _run_joker(self, get_joker, batch_mode):
+        """
+        Run the joker returned by `get_joker` on a fixed batch of images, in
+        batch mode or mapped over examples, and return the input and the
+        output.
+        """
+        images = np.random.RandomState(0).uniform(
+            size=[16, 8, 6, 3]).astype(np.float32)
+        with tf.Graph().as_default():
+            data_in = tf.constant(images)
+            if batch_mode:
+                joker = get_joker()
+                joker.batch_mode = True
+                joker.setup(data_in)
+                data = joker.data
+            else:
+                def process_example(datum):
+                    joker = get_joker()
+                    joker.setup(datum)
+                    return joker.data
+                data = tf.map_fn(process_example, data_in, back_prop=False)
+            with tf.Session() as sess:
+                return images, sess.run(data)
+
+    def test_batch_mode(self):
+        """
+        Batch mode of jokers should do what they do to each example.
+        """
+        get_jokers = [
+            lambda: CropJoker(height=4, width=4, center=True, name="crop"),
+            lambda: WhitenJoker(name="whiten"),
+            lambda: ResizeJoker(height=4, width=3, name="resize")]
+        for get_joker in get_jokers:
+            _, data = self._run_joker(get_joker, True)
+            _, expected_data = self._run_joker(get_joker, False)
+            assert np.allclose(data, expected_data, atol=1e-5)
+
+        # Flips are random, so each example should be either the original one
+        # or the one flipped along the right axis.
+        for flip_left_right in [True, False]:
+            images, data = self._run_joker(
+                lambda: FlipJoker(flip_left_right=flip_left_right,
+                                  name="flip"),
+                True)
+            for image, datum in zip(images, data):
+                flipped_image = image[:, ::-1] if flip_left_right \
+                    else image[::-1]
+                assert (datum == image).all() or \
+                    (datum == flipped_image).all()
+
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,64 @@
 import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+
+import tensorflow as tf
 
 from akid import (
     Kid,
     FeedSensor,
+    IntegratedSensor,
     MomentumKongFu
 )
+from akid.core.jokers import Joker, CropJoker
 
+from akid.core.callbacks import profile_blocks
 from akid.utils.test import AKidTestCase, TestFactory, main
+from akid.utils import glog as log
+
+
+# A script that runs a kid as a worker of a distributed cluster, and writes
+# the global step it begins training from and the final loss to
+# `result.json` under its log dir.
+WORKER_SCRIPT = """
+import json
+from akid import Kid, FeedSensor, MomentumKongFu
+from akid.utils.test import TestFactory
+
+kid = Kid(
+    FeedSensor(source_in=TestFactory.get_test_feed_source(), name='data'),
+    TestFactory.get_test_brain(),
+    MomentumKongFu(),
+    engine={{"name": "distributed",
+            "cluster": {cluster},
+            "task_index": {task_index}}},
+    log_dir="{log_dir}",
+    max_steps={max_steps},
+    val_log_step=100)
+begin_steps = []
+kid.hooks.on_train_begin.append(lambda kid: begin_steps.append(kid.step))
+kid.setup()
+loss = kid.practice()
+with open("{log_dir}/result.json", "w") as f:
+    # Only the chief validates, so other workers have no loss.
+    json.dump({{"begin_step": begin_steps[0],
+               "loss": float(loss) if loss is not None else None}}, f)
+"""
+
+
+def get_free_ports(num):
+    ports = []
+    for i in xrange(num):
+        sock = socket.socket()
+        sock.bind(("localhost", 0))
+        ports.append(sock.getsockname()[1])
+        sock.close()
+    return ports
 
 
 class TestKid(AKidTestCase):
@@ -46,6 +98,455 @@ class TestKid(AKidTestCase):
 
         assert not os.path.exists(kid.log_dir + "/training.log)")
 
+    def test_timing_stats(self):
+        brain = TestFactory.get_test_brain()
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            brain,
+            MomentumKongFu(),
+            max_steps=200,
+            trace_step=20,
+            timing_window=50)
+        kid.setup()
+        kid.practice()
+
+        assert len(kid.run_times) == 50
+        # Step 0 to 200 are traced.
+        assert len(kid.queue_wait_times) == 11
+        stats = kid.timing_stats
+        assert stats["run_time"][0] <= stats["run_time"][1]
+        # A feed sensor has no queue to wait on.
+        assert stats["queue_wait_time"] == (0, 0)
+        assert stats["queue_size"] is None
+
+    def test_timing_stats_starved_queue(self):
+        """
+        A training queue filled slower than the brain trains should be found
+        input-bound from queue sizes, without traced steps.
+        """
+        class SlowJoker(Joker):
+            def _setup(self, data_in):
+                def sleep(datum):
+                    time.sleep(0.001)
+                    return datum
+                data = tf.py_func(sleep, [data_in], data_in.dtype)
+                data.set_shape(data_in.get_shape())
+                self._data = data
+
+        sensor = IntegratedSensor(
+            source_in=TestFactory.get_test_tf_source(),
+            batch_size=128,
+            val_batch_size=100,
+            num_preprocess_threads=1,
+            name='data')
+        sensor.attach(CropJoker(height=24, width=24, name="crop"))
+        sensor.attach(SlowJoker(name="slow"))
+        sensor.attach(CropJoker(height=24, width=24,
+                                center=True, name="crop"),
+                      to_val=True)
+        kid = Kid(
+            sensor,
+            TestFactory.get_test_brain(),
+            MomentumKongFu(),
+            max_steps=50,
+            val_log_step=1000,
+            timing_window=50)
+        kid.setup()
+        kid.practice()
+
+        stats = kid.timing_stats
+        assert len(kid.queue_wait_times) == 0
+        assert stats["queue_size"] is not None
+        assert stats["verdict"] == "input-bound"
+
+    def test_profile_blocks(self):
+        brain = TestFactory.get_test_brain()
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            brain,
+            MomentumKongFu(),
+            max_steps=100,
+            trace_step=50)
+        kid.hooks.on_batch_end.append(profile_blocks)
+        kid.setup()
+        kid.practice()
+
+        for step in [0, 50, 100]:
+            assert os.path.exists(os.path.join(
+                kid.log_dir, "timeline_step_{}.json".format(step)))
+
+        # With several steps a run, the traced step is the last one of the
+        # run that a multiple of `trace_step` is in.
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            TestFactory.get_test_brain(),
+            MomentumKongFu(),
+            max_steps=100,
+            trace_step=50,
+            steps_per_run=8)
+        traced_steps = []
+        kid.hooks.on_batch_end.append(
+            lambda kid: kid.traced_step is not None and
+            traced_steps.append(kid.traced_step))
+        kid.hooks.on_batch_end.append(profile_blocks)
+        kid.setup()
+        kid.practice()
+
+        assert len(traced_steps) == 3
+        for i, step in enumerate(traced_steps):
+            assert 50 * i <= step < 50 * i + 8
+            assert os.path.exists(os.path.join(
+                kid.log_dir, "timeline_step_{}.json".format(step)))
+
+    def test_steps_per_run(self):
+        """
+        Benchmark training steps per second against the number of steps run
+        by each `forward_backward`.
+        """
+        for steps_per_run in [1, 10, 50]:
+            brain = TestFactory.get_test_brain()
+            source = TestFactory.get_test_feed_source()
+            kid = Kid(
+                FeedSensor(source_in=source, name='data'),
+                brain,
+                MomentumKongFu(),
+                max_steps=900,
+                steps_per_run=steps_per_run)
+            kid.setup()
+
+            start_time = time.time()
+            loss = kid.practice()
+            duration = time.time() - start_time
+            log.info("steps_per_run {}: {:.1f} steps/sec".format(
+                steps_per_run, kid.max_steps / duration))
+
+            assert loss < 0.2
+            assert kid.step == kid.max_steps + 1
+
+    def test_step_overhead(self):
+        """
+        Microbenchmark of host overhead per training step, that is the time
+        of `forward_backward` not spent in running the session.
+        """
+        step_num = 500
+        brain = TestFactory.get_test_brain()
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            brain,
+            MomentumKongFu(),
+            max_steps=step_num,
+            trace_step=None,
+            timing_window=step_num)
+        kid.setup()
+        kid.init()
+
+        start_time = time.time()
+        for kid.step in xrange(step_num):
+            kid.forward_backward()
+        duration = time.time() - start_time
+
+        overhead = (duration - sum(kid.run_times)) / step_num
+        log.info("Host overhead per step: {:.3f} ms, of which {:.3f} ms"
+                 " building feed dicts.".format(
+                     overhead * 1000,
+                     sum(kid.feed_times) / step_num * 1000))
+        assert overhead > 0
+
+    def test_async_save(self):
+        brain = TestFactory.get_test_brain()
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            brain,
+            MomentumKongFu(),
+            max_steps=900,
+            val_log_step=200,
+            async_save=True,
+            keep_last_ckpt_num=2)
+        kid.setup()
+
+        loss = kid.practice()
+        assert loss < 0.2
+
+        checkpoint = tf.train.get_checkpoint_state(kid.model_dir)
+        assert checkpoint.model_checkpoint_path.endswith("checkpoint-900")
+        # The last two and the best.
+        assert len(checkpoint.all_model_checkpoint_paths) <= 3
+
+        kid.restore_from_ckpt()
+        loss = kid.validate()
+        assert loss < 0.2
+
+        # Checkpoints kept always include the latest one.
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            TestFactory.get_test_brain(),
+            MomentumKongFu(),
+            async_save=True,
+            keep_last_ckpt_num=0)
+        self.assertRaises(ValueError, kid.setup)
+
+    def test_async_val(self):
+        brain = TestFactory.get_test_brain()
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            brain,
+            MomentumKongFu(),
+            max_steps=900,
+            val_log_step=200,
+            async_val=True,
+            val_thread_num=1)
+
+        val_steps = []
+        kid.hooks.on_val_log.append(lambda kid: val_steps.append(kid.step))
+        kid.setup()
+
+        loss = kid.practice()
+        assert loss < 0.2
+        # Results are reported in order with the steps validated.
+        assert val_steps == [0, 200, 400, 600, 800, 900]
+        assert kid.step == kid.max_steps + 1
+
+        self.assertRaises(AssertionError,
+                          Kid,
+                          FeedSensor(source_in=source, name='data'),
+                          TestFactory.get_test_brain(),
+                          MomentumKongFu(),
+                          max_steps=900,
+                          async_val=True,
+                          summary_on_val=True)
+
+    def test_async_save_and_val(self):
+        """
+        The best checkpoint should be kept even if it is validated after
+        later checkpoints are written.
+        """
+        kid = Kid(
+            FeedSensor(source_in=TestFactory.get_test_feed_source(),
+                       name='data'),
+            TestFactory.get_test_brain(),
+            MomentumKongFu(),
+            max_steps=900,
+            val_log_step=200,
+            async_save=True,
+            keep_last_ckpt_num=1,
+            async_val=True)
+
+        val_losses = {}
+
+        def record_val_loss(kid):
+            val_losses[kid.step] = kid.loss_value
+        kid.hooks.on_val_log.append(record_val_loss)
+        kid.setup()
+        kid.practice()
+
+        best_step = min(val_losses, key=lambda s: val_losses[s])
+        checkpoint = tf.train.get_checkpoint_state(kid.model_dir)
+        assert checkpoint.model_checkpoint_path.endswith("checkpoint-900")
+        assert any(p.endswith("checkpoint-{}".format(best_step))
+                   for p in checkpoint.all_model_checkpoint_paths)
+        assert len(checkpoint.all_model_checkpoint_paths) <= 2
+
+    def test_exact_val(self):
+        brain = TestFactory.get_test_brain()
+        source = TestFactory.get_test_feed_source()
+        # 300 does not divide the number of validation samples.
+        sensor = FeedSensor(source_in=source,
+                            val_batch_size=300,
+                            exact_val=True,
+                            name='data')
+        kid = Kid(sensor, brain, MomentumKongFu(), max_steps=900)
+        kid.setup()
+
+        loss = kid.practice()
+        assert loss < 0.2
+
+        # Validation in batches should equal the one in a whole batch.
+        feed_dict = sensor.fill_exact_val_feed_dict(0, source.num_val)
+        loss_value = kid.sess.run(kid._val_fetch[0], feed_dict=feed_dict)
+        self.assertAlmostEqual(loss, loss_value, places=4)
+
+    def test_recovery(self):
+        """
+        Kill the parameter server of a distributed kid mid-run, restart it,
+        and check training resumes from the latest checkpoint.
+        """
+        ports = get_free_ports(2)
+        cluster = {"ps": ["localhost:{}".format(ports[0])],
+                   "worker": ["localhost:{}".format(ports[1])]}
+        ps_script = ("import tensorflow as tf;"
+                     "tf.train.Server(tf.train.ClusterSpec({}),"
+                     " job_name='ps', task_index=0).join()".format(cluster))
+
+        def start_ps():
+            return subprocess.Popen([sys.executable, "-c", ps_script])
+
+        ps = [start_ps()]
+        val_log_step = 100
+        kid = Kid(
+            FeedSensor(source_in=TestFactory.get_test_feed_source(),
+                       name='data'),
+            TestFactory.get_test_brain(),
+            MomentumKongFu(),
+            engine={"name": "distributed", "cluster": cluster},
+            max_steps=900,
+            val_log_step=val_log_step,
+            max_recovery_num=3,
+            recovery_interval=2)
+
+        begin_steps = []
+        failed_steps = []
+
+        def kill_ps(kid):
+            if kid.step == 450 and not failed_steps:
+                failed_steps.append(kid.step)
+                ps[0].kill()
+                ps[0].wait()
+                ps[0] = start_ps()
+
+        kid.hooks.on_train_begin.append(
+            lambda kid: begin_steps.append(kid.step))
+        kid.hooks.on_batch_end.append(kill_ps)
+        kid.setup()
+
+        try:
+            loss = kid.practice()
+        finally:
+            ps[0].kill()
+
+        assert len(begin_steps) == 2
+        lost_step_num = failed_steps[0] - begin_steps[1]
+        assert 0 <= lost_step_num <= val_log_step
+        assert loss < 0.2
+
+    def test_recovery_gives_up(self):
+        """
+        Errors should be raised once recoveries are used up, so job runners
+        see the run has failed.
+        """
+        kid = Kid(
+            FeedSensor(source_in=TestFactory.get_test_feed_source(),
+                       name='data'),
+            TestFactory.get_test_brain(),
+            MomentumKongFu(),
+            max_steps=900,
+            max_recovery_num=1,
+            recovery_interval=0)
+        begin_steps = []
+
+        def fail(kid):
+            raise tf.errors.UnavailableError(None, None, "Failed on purpose.")
+        kid.hooks.on_train_begin.append(
+            lambda kid: begin_steps.append(kid.step))
+        kid.hooks.on_batch_end.append(fail)
+        kid.setup()
+
+        self.assertRaises(tf.errors.UnavailableError, kid.practice)
+        # Training begins once, and once more after the recovery.
+        assert len(begin_steps) == 2
+
+    def _start_cluster(self, worker_num):
+        """
+        Start an in-process parameter server of a localhost cluster of
+        `worker_num` workers, and return the server and a function that
+        starts a worker subprocess of the cluster given the task index and
+        the max steps to train.
+        """
+        ports = get_free_ports(worker_num + 1)
+        cluster = {"ps": ["localhost:{}".format(ports[0])],
+                   "worker": ["localhost:{}".format(p) for p in ports[1:]]}
+        ps_server = tf.train.Server(tf.train.ClusterSpec(cluster),
+                                    job_name="ps",
+                                    task_index=0)
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, True)
+        workers = []
+
+        def start_worker(task_index, max_steps):
+            log_dir = os.path.join(work_dir, "worker_{}".format(task_index))
+            script = WORKER_SCRIPT.format(cluster=cluster,
+                                          task_index=task_index,
+                                          log_dir=log_dir,
+                                          max_steps=max_steps)
+            worker = subprocess.Popen([sys.executable, "-c", script])
+            workers.append(worker)
+            return worker, log_dir
+
+        def kill_workers():
+            for w in workers:
+                if w.poll() is None:
+                    w.kill()
+        self.addCleanup(kill_workers)
+
+        return ps_server, start_worker
+
+    def _wait_for_ckpt(self, worker, log_dir, min_step, timeout=600):
+        """
+        Wait till the chief `worker` saves a checkpoint at `min_step` or
+        later, and return its step.
+        """
+        model_dir = os.path.join(log_dir, "model")
+        start_time = time.time()
+        while time.time() - start_time < timeout:
+            checkpoint = tf.train.get_checkpoint_state(model_dir)
+            if checkpoint and checkpoint.model_checkpoint_path:
+                step = int(checkpoint.model_checkpoint_path.split('-')[-1])
+                if step >= min_step:
+                    return step
+            assert worker.poll() is None, \
+                "The chief exits before saving a checkpoint."
+            time.sleep(1)
+        assert False, "The chief does not save a checkpoint in time."
+
+    def _get_result(self, worker, log_dir, timeout=600):
+        start_time = time.time()
+        while worker.poll() is None and time.time() - start_time < timeout:
+            time.sleep(1)
+        assert worker.returncode == 0, "The worker fails or does not finish."
+        with open(os.path.join(log_dir, "result.json"), "r") as f:
+            return json.load(f)
+
+    def test_restart_chief(self):
+        """
+        Kill the chief of a distributed kid mid-run, restart it, and check it
+        rejoins with variables kept on the parameter server, instead of
+        initializing them again.
+        """
+        ps_server, start_worker = self._start_cluster(1)
+
+        chief, log_dir = start_worker(0, 2000)
+        ckpt_step = self._wait_for_ckpt(chief, log_dir, 500)
+        chief.kill()
+        chief.wait()
+
+        chief, log_dir = start_worker(0, 2000)
+        result = self._get_result(chief, log_dir)
+        assert result["begin_step"] >= ckpt_step
+        assert result["loss"] < 0.2
+        del ps_server
+
+    def test_late_worker(self):
+        """
+        Start a worker after the chief has trained a while, and check it
+        joins training from the global step.
+        """
+        ps_server, start_worker = self._start_cluster(2)
+
+        chief, chief_log_dir = start_worker(0, 2000)
+        ckpt_step = self._wait_for_ckpt(chief, chief_log_dir, 500)
+        worker, worker_log_dir = start_worker(1, 2000)
+
+        chief_result = self._get_result(chief, chief_log_dir)
+        worker_result = self._get_result(worker, worker_log_dir)
+        assert chief_result["begin_step"] == 0
+        assert worker_result["begin_step"] >= ckpt_step
+        assert chief_result["loss"] < 0.2
+        del ps_server
+
 
 if __name__ == "__main__":
     main()
@@ -58,6 +58,48 @@ class TestKongFu(AKidTestCase):
             lr = sess.run(kid.kongfu.learning_rate)
         assert abs(lr - 0.0095) <= 0.0001
 
+    def test_loss_scaling(self):
+        from akid import LossScalingKongFu
+        from akid.models.brains import OneLayerBrain
+        brain = OneLayerBrain(mixed_precision=True, name="test_brain")
+        source = TestFactory.get_test_feed_source()
+        # The initial scale is so large that float16 gradients overflow.
+        kongfu = LossScalingKongFu(MomentumKongFu(),
+                                   init_scale=2.**40,
+                                   scale_window=200)
+        kid = Kid(
+            FeedSensor(source_in=source, data_dtype="float16", name='data'),
+            brain,
+            kongfu,
+            max_steps=900)
+        kid.setup()
+
+        loss = kid.practice()
+        assert loss < 0.2
+        loss_scale = kid.sess.run(kongfu.loss_scale)
+        assert 1 <= loss_scale < 2.**40
+
+    def test_gradient_accumulation(self):
+        import tensorflow as tf
+        brain = TestFactory.get_test_brain()
+        source = TestFactory.get_test_feed_source()
+        # An effective batch size of 100, which is the default one.
+        kongfu = MomentumKongFu(accumulation_num=4)
+        kid = Kid(
+            FeedSensor(source_in=source, batch_size=25, name='data'),
+            brain,
+            kongfu,
+            max_steps=900)
+        kid.setup()
+
+        loss = kid.practice()
+        assert loss < 0.2
+        # The global step counts applied updates.
+        assert tf.train.global_step(kid.sess, kid.global_step_tensor) \
+            == kid.step
+        for a in kid.sess.run(kongfu.accumulators):
+            assert (a == 0).all()
+
 
 if __name__ == "__main__":
     main()
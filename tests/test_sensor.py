@@ -1,3 +1,10 @@
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
 from akid.utils.test import AKidTestCase, TestFactory, main
 from akid import (
     IntegratedSensor,
@@ -10,11 +17,13 @@ from akid.core.jokers import (
     CropJoker,
     WhitenJoker,
     FlipJoker,
-    LightJoker
+    LightJoker,
+    RescaleJoker
 )
 
 from akid.models.brains import AlexNet
 from akid import LearningRateScheme
+from akid.utils import glog as log
 
 
 class TestFeedSensor(AKidTestCase):
@@ -44,6 +53,27 @@ class TestFeedSensor(AKidTestCase):
 
         assert loss < 0.2
 
+    def test_prefetch(self):
+        source = TestFactory.get_test_feed_source()
+        sensor = FeedSensor(source_in=source,
+                            batch_size=128,
+                            val_batch_size=100,
+                            prefetch_num=8,
+                            prefetch_thread_num=2,
+                            name="data")
+        kid = Kid(
+            sensor,
+            self.brain,
+            MomentumKongFu(),
+            max_steps=900)
+        kid.setup()
+        loss = kid.practice()
+
+        assert loss < 0.2
+        stats = sensor.prefetch_stats
+        assert stats["queue_depth"] <= 8
+        sensor.stop_prefetching()
+
     def test_summary_on_val(self):
         """
         Test whether validation summaries has been written to event file
@@ -69,11 +99,14 @@ class TestIntegratedSensor(AKidTestCase):
         # integrated sensor instead of using data augmented cifar10.
         self.brain = AlexNet(name="AlexNet")
         source = TestFactory.get_test_tf_source()
+        self.sensor = self._get_sensor(source)
 
+    def _get_sensor(self, source, **kwargs):
         sensor = IntegratedSensor(source_in=source,
                                   batch_size=128,
                                   val_batch_size=100,
-                                  name='data')
+                                  name='data',
+                                  **kwargs)
         sensor.attach(CropJoker(height=24, width=24,
                                 center=True, name="crop"),
                       to_val=True)
@@ -84,7 +117,7 @@ class TestIntegratedSensor(AKidTestCase):
         sensor.attach(LightJoker(name="brightness_contrast"))
         sensor.attach(WhitenJoker(name="per_image_whitening"))
 
-        self.sensor = sensor
+        return sensor
 
     def test_core(self):
         kid = Kid(
@@ -118,5 +151,181 @@ class TestIntegratedSensor(AKidTestCase):
 
         kid.practice()
 
+    def test_batch_read(self):
+        source = TestFactory.get_test_tf_source()
+        source.read_batch_size = 128
+        kid = Kid(
+            self._get_sensor(source),
+            self.brain,
+            GradientDescentKongFu(
+                lr_scheme={"name": LearningRateScheme.exp_decay,
+                           "base_lr": 0.1,
+                           "decay_rate": 0.1,
+                           "num_batches_per_epoch": 391,
+                           "decay_epoch_num": 350}),
+            max_steps=1000)
+        kid.setup()
+
+        loss = kid.practice()
+        assert loss < 3.4
+
+    def test_auto_tune(self):
+        source = TestFactory.get_test_tf_source()
+        sensor = self._get_sensor(source,
+                                  num_preprocess_threads=1,
+                                  auto_tune=True,
+                                  auto_tune_step_num=200,
+                                  auto_tune_interval=50)
+        kid = Kid(
+            sensor,
+            self.brain,
+            GradientDescentKongFu(
+                lr_scheme={"name": LearningRateScheme.exp_decay,
+                           "base_lr": 0.1,
+                           "decay_rate": 0.1,
+                           "num_batches_per_epoch": 391,
+                           "decay_epoch_num": 350}),
+            max_steps=300)
+        kid.setup()
+        kid.practice()
+
+        queue = sensor.queues["train_data"]
+        size = kid.sess.run(queue["size"])
+        assert size <= queue["capacity"]
+        assert sensor.num_preprocess_threads >= 1
+        # Threads are at most doubled at each of the three intervals after
+        # the first one.
+        assert sensor.num_preprocess_threads <= 8
+
+        # Added threads are started along with others in a new session.
+        with kid.graph.as_default():
+            runners = tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS)
+        thread_num = sum(len(r.enqueue_ops) for r in runners
+                         if r.queue is queue["queue"])
+        assert thread_num == sensor.num_preprocess_threads
+
+    def test_batch_read_throughput(self):
+        """
+        Benchmark examples per second of the training input pipeline when
+        examples are read one at a time and in batches.
+        """
+        def get_examples_per_sec(read_batch_size, step_num=200):
+            with tf.Graph().as_default():
+                source = TestFactory.get_test_tf_source()
+                source.read_batch_size = read_batch_size
+                sensor = IntegratedSensor(source_in=source,
+                                          batch_size=128,
+                                          val_batch_size=100,
+                                          name='data')
+                sensor.attach(FlipJoker(name="left_right_flip"))
+                sensor.attach(WhitenJoker(name="per_image_whitening"))
+                sensor.setup()
+
+                with tf.Session() as sess:
+                    coord = tf.train.Coordinator()
+                    threads = tf.train.start_queue_runners(sess=sess,
+                                                           coord=coord)
+                    # Wait till the shuffle queue is filled.
+                    sess.run(sensor.training_data)
+                    start_time = time.time()
+                    for _ in xrange(step_num):
+                        sess.run(sensor.training_data)
+                    duration = time.time() - start_time
+                    coord.request_stop()
+                    coord.join(threads, stop_grace_period_secs=10)
+
+            return step_num * sensor.batch_size / duration
+
+        per_example_speed = get_examples_per_sec(None)
+        batch_speed = get_examples_per_sec(128)
+        log.info("Read one at a time: {:.1f} examples/sec; read in batches:"
+                 " {:.1f} examples/sec.".format(per_example_speed,
+                                                batch_speed))
+
+    def test_val_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        source = TestFactory.get_test_tf_source()
+        # Whitened data are out of [0, 1], so they are cached in float32.
+        sensor = self._get_sensor(source,
+                                  exact_val=True,
+                                  val_cache_dir=cache_dir,
+                                  val_cache_dtype="float32")
+        kid = Kid(
+            sensor,
+            self.brain,
+            GradientDescentKongFu(),
+            val_log_step=100,
+            max_steps=200)
+        val_losses = []
+        kid.hooks.on_val_log.append(
+            lambda kid: val_losses.append(kid.loss_value))
+        kid.setup()
+        kid.practice()
+
+        # The first validation epoch fills the cache, and later ones are fed
+        # from it.
+        assert len(val_losses) == 3
+        assert sensor.val_cache.is_ready
+        assert sensor.val_cache_fetch == []
+
+        # Cached batches are the same as those from the validation queue.
+        loss = kid.validate()
+        sensor.val_cache = None
+        self.assertAlmostEqual(loss, kid.validate(), places=4)
+
+        # A change in validation jokers invalidates the cache.
+        with tf.Graph().as_default():
+            sensor = IntegratedSensor(
+                source_in=TestFactory.get_test_tf_source(),
+                val_batch_size=100,
+                exact_val=True,
+                val_cache_dir=cache_dir,
+                val_cache_dtype="float32",
+                name='data')
+            sensor.attach(CropJoker(height=28, width=28,
+                                    center=True, name="crop"),
+                          to_val=True)
+            sensor.setup()
+        assert not sensor.val_cache.is_ready
+
+    def test_val_cache_uint8(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        # Rescaled images are in [0, 1], so they could be cached in uint8.
+        sensor = IntegratedSensor(
+            source_in=TestFactory.get_test_tf_source(),
+            batch_size=128,
+            val_batch_size=100,
+            exact_val=True,
+            val_cache_dir=cache_dir,
+            val_cache_dtype="uint8",
+            name='data')
+        sensor.attach(CropJoker(height=24, width=24,
+                                center=True, name="crop"),
+                      to_val=True)
+        sensor.attach(RescaleJoker(name="rescale"), to_val=True)
+        sensor.attach(CropJoker(height=24, width=24, name="crop"))
+        sensor.attach(RescaleJoker(name="rescale"))
+        kid = Kid(
+            sensor,
+            self.brain,
+            GradientDescentKongFu(),
+            val_log_step=100,
+            max_steps=200)
+        kid.setup()
+        kid.practice()
+        assert sensor.val_cache.is_ready
+
+        # Cached data differ from those from the validation queue by at most
+        # a quantization step. Cached epochs do not dequeue, so the queue
+        # starts from the first example.
+        data = kid.sess.run(sensor.val_data,
+                            feed_dict={sensor.val_batch_num: 100})
+        cached_data = sensor.val_cache.read(0, 100)[0]
+        assert cached_data.dtype == data.dtype
+        assert np.abs(cached_data - data).max() <= 1. / 255
+
+
 if __name__ == "__main__":
     main()
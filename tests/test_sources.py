@@ -1,3 +1,5 @@
+import os
+
 import seaborn as sns
 import matplotlib.pyplot as plt
 import numpy as np
@@ -6,12 +8,43 @@ import tensorflow as tf
 from akid import AKID_DATA_PATH
 from akid.utils.test import AKidTestCase, main
 from akid.datasets import Cifar10FeedSource, Cifar10TFSource
+from akid.datasets import Cifar10MemmapFeedSource
 from akid.datasets import Cifar100TFSource
 from akid.datasets import MNISTFeedSource, RotatedMNISTFeedSource
+from akid.datasets import MNISTMemmapFeedSource
 from akid import LearningRateScheme
 
 
 class TestSource(AKidTestCase):
+    def test_dataset_shuffle_by_index(self):
+        from akid.datasets.datasets import DataSet
+        images = np.arange(10 * 4, dtype=np.float32).reshape([10, 2, 2, 1])
+        labels = np.arange(10)
+        dataset = DataSet(images, labels, shuffle_by_index=True)
+
+        seen = []
+        for i in xrange(0, 10):
+            imgs, batch_labels = dataset.next_batch(3)
+            # Images and labels should stay paired.
+            assert (imgs[:, 0, 0, 0] // 4 == batch_labels).all()
+            seen.extend(batch_labels.tolist())
+
+        # Samples at the tail of an epoch are carried over instead of being
+        # dropped, so all three epochs go through each sample exactly once.
+        assert dataset.epochs_completed == 2
+        for i in xrange(0, 3):
+            assert sorted(seen[i*10:(i+1)*10]) == range(0, 10)
+        # Original arrays should not be touched.
+        assert (dataset.labels == np.arange(10)).all()
+
+        # Indices of batches go on from where batches stop, and are not
+        # changed by later batches.
+        index = dataset.next_batch_index(3)
+        assert (dataset.labels.take(index) == index).all()
+        index_copy = index.copy()
+        dataset.next_batch(3)
+        assert (index == index_copy).all()
+
     def test_mnist_feed_source(self):
         source = MNISTFeedSource(
             name="MNIST_feed",
@@ -33,6 +66,50 @@ class TestSource(AKidTestCase):
         print("The class label is {}.".format(labels[0]))
         plt.show()
 
+    def test_mnist_memmap_feed_source(self):
+        source = MNISTFeedSource(
+            name="MNIST_feed",
+            url='http://yann.lecun.com/exdb/mnist/',
+            num_train=50000,
+            num_val=5000,
+            scale=True)
+        source.setup()
+
+        # The first set up converts data, and the second one maps converted
+        # data. Both should give the same data as the in memory source.
+        for i in xrange(0, 2):
+            memmap_source = MNISTMemmapFeedSource(
+                name="MNIST_memmap_feed",
+                url='http://yann.lecun.com/exdb/mnist/',
+                num_train=50000,
+                num_val=5000,
+                scale=True)
+            memmap_source.setup()
+            assert type(memmap_source.get_all(True).images) is np.memmap
+
+            imgs, labels = memmap_source.get_batch(100, True)
+            assert np.allclose(imgs, source.get_all(False).images[:100])
+            assert (labels == source.get_all(False).labels[:100]).all()
+
+    def test_cifar10_memmap_feed_source_config(self):
+        def get_source(use_zca):
+            return Cifar10MemmapFeedSource(
+                use_zca=use_zca,
+                name="CIFAR10_memmap",
+                url='http://www.cs.toronto.edu/~kriz/cifar-10-binary.tar.gz',
+                work_dir=AKID_DATA_PATH + '/cifar10',
+                num_train=50000,
+                num_val=10000)
+
+        source = get_source(False)
+        source.setup()
+        header = source._read_header()
+        assert header["config"]["use_zca"] is False
+        assert header["config"] == source._get_config()
+        # Converted data without ZCA whitening should not be used for a
+        # source with it.
+        assert header["config"] != get_source(True)._get_config()
+
     def test_rotated_mnist_feed_source(self):
         source = RotatedMNISTFeedSource(
             name="Rotated_MNIST_feed",
@@ -97,6 +174,69 @@ class TestSource(AKidTestCase):
             print("The class label is {}.".format(labels[0]))
             plt.show()
 
+    def test_sharded_tfrecord_conversion(self):
+        import shutil
+        import tempfile
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, True)
+        images = np.random.uniform(size=[10, 32, 32, 3]).astype(np.float32)
+        labels = np.arange(10)
+
+        for image_format, image_dtype in [("float", "float32"),
+                                          ("bytes", "float32"),
+                                          ("bytes", "float16")]:
+            source = Cifar10TFSource(
+                name="CIFAR10",
+                url=None,
+                work_dir=work_dir,
+                shard_num=4,
+                convert_process_num=2,
+                image_format=image_format,
+                image_dtype=image_dtype,
+                num_train=50000,
+                num_val=10000)
+            source._convert_to_tf(images, labels, "test")
+            assert source._tfrecords_exist("test")
+            filenames = source._get_tfrecord_filenames("test")
+            assert len(filenames) == 4
+
+            # Read them back.
+            with tf.Graph().as_default():
+                filename_queue = tf.train.string_input_producer(
+                    filenames, shuffle=False, num_epochs=1)
+                image, label = source._get_sample_tensors_from_tfrecords(
+                    filename_queue)
+                with tf.Session() as sess:
+                    sess.run(tf.local_variables_initializer())
+                    coord = tf.train.Coordinator()
+                    threads = tf.train.start_queue_runners(sess=sess,
+                                                           coord=coord)
+                    for i in xrange(0, 10):
+                        image_value, label_value = sess.run([image, label])
+                        assert np.allclose(image_value,
+                                           images[label_value],
+                                           atol=1e-3)
+                    coord.request_stop()
+                    coord.join(threads)
+
+        # A conversion failed in worker processes is raised, and leaves no
+        # partial shards behind. Images without the channel dimension fail.
+        source = Cifar10TFSource(
+            name="CIFAR10",
+            url=None,
+            work_dir=work_dir,
+            shard_num=4,
+            convert_process_num=2,
+            num_train=50000,
+            num_val=10000)
+        self.assertRaises(ValueError,
+                          source._convert_to_tf,
+                          images[..., 0],
+                          labels,
+                          "failed")
+        assert not source._tfrecords_exist("failed")
+        assert not [f for f in os.listdir(work_dir) if f.endswith(".tmp")]
+
     def test_cifar10_zca_tf_source(self):
         from akid.models.brains import VGGNet
         from akid import IntegratedSensor, Kid, GradientDescentKongFu
@@ -253,5 +393,60 @@ class TestSource(AKidTestCase):
                       source.val_datum,
                       source.val_label])
 
+    def test_imagenet_parallel_read(self):
+        """
+        Check shards assigned to workers do not overlap, and benchmark
+        decoding and cropping training images read by parallel readers.
+        """
+        import time
+        from akid import ImagenetTFSource
+        from akid.datasets.imagenet import ImagenetData
+        from akid.utils import glog as log
+
+        sources = []
+        for worker_index in xrange(2):
+            source = ImagenetTFSource(
+                reader_num=4,
+                worker_num=2,
+                worker_index=worker_index,
+                name="Imagenet",
+                url=None,
+                work_dir=AKID_DATA_PATH + "/small_imagenet",
+                num_train=84321,
+                num_val=3300)
+            sources.append(source)
+
+        data_files = ImagenetData(work_dir=AKID_DATA_PATH + "/small_imagenet",
+                                  subset="train",
+                                  name="Imagenet").data_files()
+        files = [set(s.get_worker_files(data_files)) for s in sources]
+        assert not files[0] & files[1]
+        assert files[0] | files[1] == set(data_files)
+
+        # Decode and crop in one thread to measure the throughput per core.
+        source = sources[0]
+        graph = tf.Graph()
+        with graph.as_default():
+            source.setup()
+        config = tf.ConfigProto(intra_op_parallelism_threads=1,
+                                inter_op_parallelism_threads=1)
+        with tf.Session(graph=graph, config=config) as sess:
+            coord = tf.train.Coordinator()
+            threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+            # Warm up.
+            for _ in xrange(10):
+                sess.run(source.training_datum)
+            image_num = 100
+            start_time = time.time()
+            for _ in xrange(image_num):
+                sess.run(source.training_datum)
+            duration = time.time() - start_time
+            coord.request_stop()
+            coord.join(threads, stop_grace_period_secs=5)
+
+        log.info("Decoded and cropped {:.1f} training images per sec per"
+                 " core.".format(image_num / duration))
+
+
 if __name__ == "__main__":
     main()
@@ -1,8 +1,10 @@
+import tensorflow as tf
+
 from akid.utils.test import AKidTestCase, main, TestFactory
-from akid import Brain
+from akid import Kid, Brain, FeedSensor, MomentumKongFu
 from akid.sugar import cnn_block
 from akid import sugar
-from akid.layers import SoftmaxWithLossLayer
+from akid.layers import SoftmaxWithLossLayer, InnerProductLayer
 
 
 class TestSynapseLayers(AKidTestCase):
@@ -129,5 +131,82 @@ class TestSynapseLayers(AKidTestCase):
         loss = kid.practice()
         assert loss < 1
 
+    def test_partitioned_weights(self):
+        brain = Brain(moving_average_decay=0.9, name="test_brain")
+        brain.attach(InnerProductLayer(out_channel_num=512,
+                                       max_norm=1,
+                                       partition={"name": "fixed",
+                                                  "shard_num": 4},
+                                       name="ip1"))
+        # 512 * 10 float32 weights take 20480 bytes.
+        brain.attach(InnerProductLayer(out_channel_num=10,
+                                       partition={"name": "max_bytes",
+                                                  "max_shard_bytes": 16384},
+                                       name="ip2"))
+        brain.attach(SoftmaxWithLossLayer(
+            class_num=10,
+            inputs=[{"name": "ip2", "idxs": [0]},
+                    {"name": "system_in", "idxs": [1]}],
+            name="loss"))
+
+        source = TestFactory.get_test_feed_source()
+        kid = TestFactory.get_test_kid(source, brain)
+        kid.setup()
+
+        ip1, ip2 = brain.blocks[0], brain.blocks[1]
+        # Shards of weights, and biases.
+        assert len(ip1.var_list) == 5
+        for v in ip1.var_list[:4]:
+            assert v.get_shape().as_list() == [784, 128]
+        assert len(ip2.var_list) > 2
+        assert ip1.weights.get_shape().as_list() == [784, 512]
+
+        loss = kid.practice()
+        assert loss < 1
+
+        # Max norm constrains apply to filters in all shards.
+        with kid.graph.as_default():
+            norms = tf.sqrt(tf.reduce_sum(tf.square(ip1.weights), 0))
+        norms = kid.sess.run(norms)
+        assert (norms < 1 + 1e-5).all()
+
+    def test_partitioned_weights_async_save(self):
+        brain = Brain(name="test_brain")
+        brain.attach(InnerProductLayer(out_channel_num=512,
+                                       partition={"name": "fixed",
+                                                  "shard_num": 4},
+                                       name="ip1"))
+        brain.attach(InnerProductLayer(out_channel_num=10, name="ip2"))
+        brain.attach(SoftmaxWithLossLayer(
+            class_num=10,
+            inputs=[{"name": "ip2", "idxs": [0]},
+                    {"name": "system_in", "idxs": [1]}],
+            name="loss"))
+
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            brain,
+            MomentumKongFu(),
+            max_steps=900,
+            async_save=True)
+        kid.setup()
+
+        loss = kid.practice()
+        assert loss < 1
+
+        # Shards are saved as slices of the full weights, as the synchronous
+        # saver does.
+        checkpoint = tf.train.get_checkpoint_state(kid.model_dir)
+        reader = tf.train.NewCheckpointReader(
+            checkpoint.model_checkpoint_path)
+        shape_map = reader.get_variable_to_shape_map()
+        full_name = brain.blocks[0].var_list[0]._save_slice_info.full_name
+        assert shape_map[full_name] == [784, 512]
+
+        kid.restore_from_ckpt()
+        self.assertAlmostEqual(loss, kid.validate(), places=4)
+
+
 if __name__ == "__main__":
     main()